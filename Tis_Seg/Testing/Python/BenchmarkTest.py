@@ -0,0 +1,60 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from Tis_SegLib import Benchmark
+
+
+def case(name, seconds, stages):
+  return {'name': name, 'seconds': seconds, 'stages': stages}
+
+
+class BenchmarkTest(unittest.TestCase):
+  """
+  Sizes, ranges and comparison with a baseline of the benchmark (the cases themselves need Slicer).
+  """
+
+  def test_parseSize(self):
+    self.assertEqual(Benchmark.parseSize('small'), Benchmark.SIZES['small'])
+    self.assertEqual(Benchmark.parseSize('128x96x30'), (128, 96, 30))
+    self.assertEqual(Benchmark.parseSize('128X96X30'), (128, 96, 30))
+    with self.assertRaises(ValueError):
+      Benchmark.parseSize('128x96')
+    with self.assertRaises(ValueError):
+      Benchmark.parseSize('huge')
+
+  def test_caseRange(self):
+    self.assertEqual(Benchmark.caseRange((256, 256, 40), 0.5), (10, 29))
+    self.assertEqual(Benchmark.caseRange((256, 256, 40), 1.0), (0, 39))
+    self.assertEqual(Benchmark.caseRange((256, 256, 41), 0.5), (10, 29))
+    # At least one slice, at most all of them
+    self.assertEqual(Benchmark.caseRange((256, 256, 40), 0.0), (19, 19))
+    self.assertEqual(Benchmark.caseRange((256, 256, 40), 2.0), (0, 39))
+
+  def test_compare(self):
+    baseline = {'cases': [
+      case('a', 10.0, {'Segmentation': 8.0, 'Import': 1.0, 'Cache lookup': 0.01}),
+      case('b', 5.0, {'Segmentation': 4.0}),
+      ]}
+    self.assertEqual(Benchmark.compare(baseline, baseline), [])
+
+    results = {'cases': [
+      # Total and segmentation slower, import within the tolerance, lookup slower but below MINIMUM_REGRESSION_SECONDS
+      case('a', 13.0, {'Segmentation': 11.0, 'Import': 1.1, 'Cache lookup': 0.03, 'New stage': 2.0}),
+      # Faster
+      case('b', 4.0, {'Segmentation': 3.0}),
+      # Not in the baseline
+      case('c', 100.0, {'Segmentation': 100.0}),
+      ]}
+    regressions = Benchmark.compare(results, baseline)
+    self.assertEqual(len(regressions), 2, regressions)
+    self.assertTrue(regressions[0].startswith('a total: 13.00 s, baseline 10.00 s (+30%)'), regressions)
+    self.assertTrue(regressions[1].startswith('a Segmentation: 11.00 s, baseline 8.00 s'), regressions)
+    self.assertEqual(Benchmark.compare(results, baseline, tolerance=0.5), [])
+    self.assertEqual(Benchmark.compare(results, {}), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,154 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+import numpy as np
+import SimpleITK as sitk
+
+from Tis_SegLib import CohortStore
+from Tis_SegLib import Pipeline
+
+
+def chunkFiles(path):
+  return sorted(name for name in os.listdir(path) if not name.startswith('.'))
+
+
+class CohortStoreTest(unittest.TestCase):
+  """
+  Chunked arrays, tissue tables and studies of the cohort store.
+  """
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.directory, True)
+    random = np.random.default_rng(0)
+    self.labels = random.choice([0, 6, 8, 15], size=(20, 30, 17)).astype(np.uint8)
+
+  def test_roundTrip(self):
+    path = os.path.join(self.directory, 'labels')
+    CohortStore.writeArray(path, self.labels, (8, 16, 16))
+    array = CohortStore.LazyArray(path)
+    self.assertEqual((array.shape, array.chunks, array.dtype, len(array)), ((20, 30, 17), (8, 16, 16), np.dtype(np.uint8), 20))
+    self.assertTrue(np.array_equal(array[...], self.labels))
+    self.assertTrue(np.array_equal(np.asarray(array), self.labels))
+    for key in (np.s_[3:17], np.s_[7:9, 15:30, 16], np.s_[-1], np.s_[5, 2, 3], np.s_[10:5], np.s_[18:100, :, -3:]):
+      self.assertTrue(np.array_equal(array[key], self.labels[key]), key)
+    with self.assertRaises(IndexError):
+      array[20]
+    with self.assertRaises(ValueError):
+      array[::2]
+
+    # A 1-D array and a chunk shape larger than the array
+    values = np.linspace(0.0, 1.0, 11)
+    CohortStore.writeArray(os.path.join(self.directory, 'values'), values, (100,))
+    self.assertTrue(np.array_equal(CohortStore.LazyArray(os.path.join(self.directory, 'values'))[...], values))
+
+  def test_zeroChunksAreSkipped(self):
+    labels = np.zeros((20, 30, 17), np.uint8)
+    labels[9:11, 20:22, 3] = 8
+    path = os.path.join(self.directory, 'labels')
+    CohortStore.writeArray(path, labels, (8, 16, 16))
+    self.assertEqual(chunkFiles(path), ['1.1.0'])
+    array = CohortStore.LazyArray(path)
+    self.assertTrue(np.array_equal(array[...], labels))
+    self.assertFalse(array[:8].any())
+
+  def test_stringColumns(self):
+    rows = [
+      {'region': 'thigh', 'side': 'left', 'label': 8, 'tissue': 'Muscle', 'voxels': 10, 'volumeMl': 0.03, 'meanFatFraction': 0.1},
+      {'region': 'thigh', 'side': '', 'label': 15, 'tissue': 'SAT', 'voxels': 0, 'volumeMl': 0.0, 'meanFatFraction': float('nan')},
+      ]
+    CohortStore._createGroup(self.directory)
+    tablePath = os.path.join(self.directory, 's1', CohortStore.TABLE_NAME)
+    CohortStore.writeTable(tablePath, rows)
+    _, _, files = next(os.walk(os.path.join(tablePath, 'side')))
+    # String chunks are written even if all their values are empty
+    self.assertIn('0', files)
+    os.makedirs(os.path.join(self.directory, 's2'))
+    CohortStore._createGroup(os.path.join(self.directory, 's1'), {'id': 's1'})
+
+    table = CohortStore.CohortStore(self.directory).table()
+    self.assertEqual(sorted(table), sorted(['id'] + CohortStore.TABLE_FIELDS))
+    self.assertEqual(table['tissue'].tolist(), ['Muscle', 'SAT'])
+    self.assertEqual(table['side'].tolist(), ['left', ''])
+    self.assertEqual(table['id'].tolist(), ['s1', 's1'])
+    self.assertEqual(table['label'].dtype, np.int64)
+    self.assertTrue(np.isnan(table['meanFatFraction'][1]))
+    self.assertEqual(sorted(CohortStore.CohortStore(self.directory).table(['voxels'])), ['id', 'voxels'])
+
+  def record(self, region=Pipeline.THIGH):
+    return {'id': 's1', 'region': region, 'minSlice': 10, 'maxSlice': 29, 'message': None, 'outputs': {},
+      'segmentSuffixes': {'l': '_left'}}
+
+  def labelmap(self, labels):
+    label_img = sitk.GetImageFromArray(labels)
+    label_img.SetSpacing((1.0, 2.0, 3.0))
+    label_img.SetOrigin((10.0, 20.0, 30.0))
+    return label_img
+
+  def test_writeStudy(self):
+    storePath = os.path.join(self.directory, 'cohort.zarr')
+    label_img = self.labelmap(self.labels)
+    studyPath = CohortStore.writeStudy(storePath, self.record(), {'l': CohortStore.mapImage(label_img)}, (8, 16, 16))
+    self.assertEqual(studyPath, os.path.join(storePath, 's1'))
+
+    store = CohortStore.CohortStore(storePath)
+    self.assertEqual(store.studies(), ['s1'])
+    attributes = store.attributes('s1')
+    self.assertEqual((attributes['region'], attributes['minSlice'], attributes['maxSlice']), (Pipeline.THIGH, 10, 29))
+    self.assertEqual(attributes['labelmaps']['l']['size'], [17, 30, 20])
+    self.assertTrue(np.array_equal(store.labelmap('s1', 'l')[...], self.labels))
+    image = store.image('s1', 'l', 5, 9)
+    self.assertTrue(np.array_equal(sitk.GetArrayViewFromImage(image), self.labels[5:9]))
+    self.assertEqual(image.GetOrigin(), label_img.TransformIndexToPhysicalPoint((0, 0, 5)))
+
+    table = store.table(['side', 'label', 'voxels', 'volumeMl'])
+    muscle = table['label'].tolist().index(8)
+    self.assertEqual(table['side'][muscle], 'left')
+    self.assertEqual(table['voxels'][muscle], int((self.labels == 8).sum()))
+    self.assertAlmostEqual(table['volumeMl'][muscle], (self.labels == 8).sum() * 6.0 / 1000.0)
+
+  def test_rewriteReplacesStudy(self):
+    storePath = os.path.join(self.directory, 'cohort.zarr')
+    label_img = self.labelmap(self.labels)
+    CohortStore.writeStudy(storePath, self.record(), {'l': CohortStore.mapImage(label_img)}, (8, 16, 16))
+    # The study is segmented again with an empty first half
+    labels = self.labels.copy()
+    labels[:10] = 0
+    label_img = self.labelmap(labels)
+    record = self.record()
+    record['maxSlice'] = 30
+    CohortStore.writeStudy(storePath, record, {'l': CohortStore.mapImage(label_img)}, (8, 16, 16))
+
+    store = CohortStore.CohortStore(storePath)
+    self.assertEqual(store.studies(), ['s1'])
+    self.assertEqual(store.attributes('s1')['maxSlice'], 30)
+    self.assertTrue(np.array_equal(store.labelmap('s1', 'l')[...], labels))
+    # No chunk of the previous version is left
+    self.assertFalse(any(name.startswith('0.') for name in chunkFiles(os.path.join(storePath, 's1', 'l'))))
+    self.assertEqual(store.table(['voxels'])['voxels'].sum(), int((labels != 0).sum()))
+    self.assertEqual(sorted(os.listdir(storePath)), ['.zgroup', 's1'])
+
+  def test_studyIdOutsideStore(self):
+    storePath = os.path.join(self.directory, 'cohort.zarr')
+    other = os.path.join(self.directory, 'other')
+    os.makedirs(other)
+    os.makedirs(storePath)
+    os.symlink(other, os.path.join(storePath, 'link'))
+    label_img = self.labelmap(self.labels)
+    for studyId in ('../other', 'a/../../other', '..', '.', '', other, 'link'):
+      record = dict(self.record(), id=studyId)
+      with self.assertRaises(ValueError):
+        CohortStore.writeStudy(storePath, record, {'l': CohortStore.mapImage(label_img)}, (8, 16, 16))
+    # Nothing was written or removed
+    self.assertTrue(os.path.isdir(other))
+    self.assertEqual(os.listdir(other), [])
+    self.assertEqual(sorted(os.listdir(storePath)), ['link'])
+
+
+if __name__ == '__main__':
+  unittest.main()
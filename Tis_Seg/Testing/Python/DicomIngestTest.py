@@ -0,0 +1,119 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+import numpy as np
+import SimpleITK as sitk
+
+from Tis_SegLib import DicomIngest
+
+
+def series(contrast, seriesNumber, imageType='ORIGINAL\\PRIMARY', description='', frame='1.2.3', numberOfFiles=3):
+  return {'patient': 'P1', 'study': '1.2', 'studyDate': '20240102', 'series': '1.2.{0}'.format(seriesNumber),
+    'seriesNumber': str(seriesNumber), 'description': description, 'imageType': imageType, 'frame': frame,
+    'instance': '1', 'position': '0\\0\\0', 'orientation': '1\\0\\0\\0\\1\\0', 'rows': '8', 'columns': '8',
+    'files': ['{0}_{1}.dcm'.format(seriesNumber, index) for index in range(numberOfFiles)], 'firstPosition': 0.0,
+    'lastPosition': 3.0 * (numberOfFiles - 1), 'contrast': contrast}
+
+
+def writeSlice(path, index, description, seriesUid='1.2.826.0.1.3680043.2.1125.1'):
+  image = sitk.GetImageFromArray(np.full((8, 8), index, np.int16))
+  tags = {
+    '0010|0020': 'P1',
+    '0020|000d': '1.2.826.0.1.3680043.2.1125.2',
+    '0008|0020': '20240102',
+    '0020|000e': seriesUid,
+    '0020|0011': '3',
+    '0008|103e': description,
+    '0008|0008': 'ORIGINAL\\PRIMARY',
+    '0020|0052': '1.2.826.0.1.3680043.2.1125.3',
+    '0020|0013': str(index + 1),
+    '0020|0032': '0\\0\\{0}'.format(3.0 * index),
+    '0020|0037': '1\\0\\0\\0\\1\\0',
+    }
+  for tag, value in tags.items():
+    image.SetMetaData(tag, value)
+  writer = sitk.ImageFileWriter()
+  writer.KeepOriginalImageUIDOn()
+  writer.SetFileName(path)
+  writer.Execute(image)
+
+
+class DicomIngestTest(unittest.TestCase):
+  """
+  Dixon contrasts, pairing of the series of an acquisition and incremental scans of the header index.
+  """
+
+  def test_dixonContrast(self):
+    self.assertEqual(DicomIngest.dixonContrast('DERIVED\\PRIMARY\\DIXON\\WATER', ''), 'water')
+    self.assertEqual(DicomIngest.dixonContrast('ORIGINAL\\PRIMARY\\M\\F', ''), 'fat')
+    self.assertEqual(DicomIngest.dixonContrast('DERIVED\\PRIMARY\\IP', 'anything'), 'inPhase')
+    self.assertEqual(DicomIngest.dixonContrast('DERIVED\\PRIMARY\\OP', ''), 'outPhase')
+    # The image type comes first, then the words of the description
+    self.assertEqual(DicomIngest.dixonContrast('ORIGINAL\\PRIMARY', 't1_vibe_dixon_W'), 'water')
+    self.assertEqual(DicomIngest.dixonContrast('ORIGINAL\\PRIMARY', 'T1 Dixon fat'), 'fat')
+    self.assertEqual(DicomIngest.dixonContrast('ORIGINAL\\PRIMARY', 'dixon_in_phase'), 'inPhase')
+    self.assertEqual(DicomIngest.dixonContrast('ORIGINAL\\PRIMARY', 'Dixon opp-phase'), 'outPhase')
+    # Fat-suppressed and other series are not Dixon images
+    self.assertIsNone(DicomIngest.dixonContrast('ORIGINAL\\PRIMARY', 'T2 FAT SAT'))
+    self.assertIsNone(DicomIngest.dixonContrast('ORIGINAL\\PRIMARY', 't1_tse_fs'))
+    self.assertIsNone(DicomIngest.dixonContrast('ORIGINAL\\PRIMARY', 'T1 TSE'))
+
+  def test_pairSeries(self):
+    seriesList = [
+      series('water', 3), series('fat', 4), series('inPhase', 5), series('fat', 6),
+      # Another voxel grid: another acquisition, without fat
+      series('water', 7, numberOfFiles=5),
+      # Another frame of reference
+      series('water', 8, frame='4.5.6'), series('fat', 9, frame='4.5.6'),
+      series(None, 10),
+      ]
+    acquisitions = DicomIngest.pairSeries(seriesList)
+    self.assertEqual([acquisition['id'] for acquisition in acquisitions], ['P1_20240102_3', 'P1_20240102_8'])
+    first, second = acquisitions
+    self.assertEqual((first['water']['seriesNumber'], first['fat']['seriesNumber']), ('3', '4'))
+    self.assertEqual(first['inPhase']['seriesNumber'], '5')
+    self.assertIsNone(first['outPhase'])
+    self.assertEqual((second['water']['seriesNumber'], second['fat']['seriesNumber']), ('8', '9'))
+    self.assertEqual(DicomIngest.pairSeries([series('water', 3)]), [])
+
+  def test_scan(self):
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory, True)
+    dicomDirectory = os.path.join(directory, 'dicom')
+    os.makedirs(dicomDirectory)
+    paths = [os.path.join(dicomDirectory, 'slice{0}.dcm'.format(index)) for index in range(3)]
+    for index, path in enumerate(paths):
+      writeSlice(path, index, 'Dixon W')
+    with open(os.path.join(dicomDirectory, 'notes.txt'), 'w') as f:
+      f.write('not a DICOM file')
+
+    with DicomIngest.DicomIndex(os.path.join(directory, DicomIngest.DEFAULT_INDEX_NAME)) as index:
+      self.assertEqual(index.scan(dicomDirectory, 2), (4, 0))
+      seriesList = index.series(dicomDirectory)
+      self.assertEqual(len(seriesList), 1)
+      self.assertEqual(seriesList[0]['contrast'], 'water')
+      self.assertEqual(seriesList[0]['files'], paths)
+      self.assertEqual(index.scan(dicomDirectory, 2), (0, 4))
+
+      # A file rewritten in place does not change the modification time of its folder
+      directoryTimes = os.stat(dicomDirectory)
+      fileTimes = os.stat(paths[1])
+      writeSlice(paths[1], 1, 'Dixon F', seriesUid='1.2.826.0.1.3680043.2.1125.4')
+      os.utime(paths[1], ns=(fileTimes.st_atime_ns, fileTimes.st_mtime_ns + 10 ** 9))
+      os.utime(dicomDirectory, ns=(directoryTimes.st_atime_ns, directoryTimes.st_mtime_ns))
+      self.assertEqual(index.scan(dicomDirectory, 2), (1, 3))
+      contrasts = sorted((series['contrast'], len(series['files'])) for series in index.series(dicomDirectory))
+      self.assertEqual(contrasts, [('fat', 1), ('water', 2)])
+
+      os.remove(paths[0])
+      self.assertEqual(index.scan(dicomDirectory, 2), (0, 3))
+      self.assertEqual(sum(len(series['files']) for series in index.series(dicomDirectory)), 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,121 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from Tis_SegLib import BatchProcessing
+from Tis_SegLib import JobQueue
+
+
+def study(studyId, partitions=10):
+  return {'id': studyId, 'region': 'thigh', 'water': studyId + '_water.nrrd', 'fat': studyId + '_fat.nrrd', 'roi': None,
+    'master': None, 'minSlice': 20, 'maxSlice': 59, 'partitions': partitions, 'incomplete': False, 'autoRange': False}
+
+
+def record(study, status='done'):
+  return {'id': study['id'], 'region': study['region'], 'minSlice': study['minSlice'], 'maxSlice': study['maxSlice'],
+    'status': status, 'message': None, 'error': 'Segmentation failed' if status == 'failed' else None,
+    'outputs': {'l': study['id'] + '_l.nrrd'} if status == 'done' else {}, 'segmentSuffixes': {}, 'seconds': 1.0}
+
+
+class JobQueueTest(unittest.TestCase):
+  """
+  Resuming an interrupted cohort run and writing its outputs atomically (does not need Slicer).
+  """
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.directory, True)
+    self.path = os.path.join(self.directory, JobQueue.DEFAULT_QUEUE_NAME)
+    self.studies = [study('a'), study('b'), study('c')]
+
+  def test_resumeAfterCrash(self):
+    queue = JobQueue.JobQueue(self.path)
+    queue.add(self.studies)
+    claimed = queue.claim(queue.studies())
+    queue.finish(record(next(claimed)))
+    next(claimed)
+    # The run stops while 'b' is running, without closing the queue
+    self.assertEqual(queue.counts(), {JobQueue.PENDING: 1, JobQueue.RUNNING: 1, JobQueue.DONE: 1, JobQueue.FAILED: 0})
+    del claimed, queue
+
+    with JobQueue.JobQueue(self.path) as queue:
+      queue.add(self.studies)
+      self.assertEqual(queue.counts(), {JobQueue.PENDING: 2, JobQueue.RUNNING: 0, JobQueue.DONE: 1, JobQueue.FAILED: 0})
+      self.assertEqual([item['id'] for item in queue.studies()], ['b', 'c'])
+      processed = []
+
+      def processStudies(studies):
+        for item in studies:
+          processed.append(item['id'])
+          yield record(item)
+
+      records = list(BatchProcessing.processQueue(queue, self.studies, processStudies))
+      self.assertEqual(processed, ['b', 'c'])
+      self.assertEqual([item['id'] for item in records], ['a', 'b', 'c'])
+      self.assertEqual(queue.counts()[JobQueue.DONE], 3)
+      attempts = dict(queue.connection.execute('SELECT id, attempts FROM jobs'))
+      self.assertEqual(attempts, {'a': 1, 'b': 2, 'c': 1})
+
+  def test_changedStudy(self):
+    with JobQueue.JobQueue(self.path) as queue:
+      queue.add(self.studies, {'format': 'nrrd'})
+      for item in queue.claim(queue.studies()):
+        queue.finish(record(item))
+      # Other parameters for 'b', then other settings for all the studies
+      queue.add([self.studies[0], study('b', partitions=5), self.studies[2]], {'format': 'nrrd'})
+      self.assertEqual([item['id'] for item in queue.studies()], ['b'])
+      self.assertEqual(queue.studies()[0]['partitions'], 5)
+      queue.add(self.studies, {'format': 'nii.gz'})
+      self.assertEqual([item['id'] for item in queue.studies()], ['a', 'b', 'c'])
+      with self.assertRaises(ValueError):
+        queue.add([study('a'), study('a')])
+
+  def test_retryFailed(self):
+    with JobQueue.JobQueue(self.path) as queue:
+      queue.add(self.studies)
+      for item in queue.claim(queue.studies()):
+        queue.finish(record(item, 'failed' if item['id'] == 'b' else 'done'))
+      self.assertEqual(queue.counts()[JobQueue.FAILED], 1)
+      self.assertEqual([item['id'] for item in queue.records((JobQueue.FAILED,))], ['b'])
+
+      # Failed studies are kept unless they are retried
+      queue.add(self.studies)
+      self.assertEqual(queue.studies(), [])
+      queue.add(self.studies, retryFailed=True)
+      self.assertEqual([item['id'] for item in queue.studies()], ['b'])
+      self.assertEqual(queue.records((JobQueue.FAILED,)), [])
+      self.assertEqual(queue.counts(), {JobQueue.PENDING: 1, JobQueue.RUNNING: 0, JobQueue.DONE: 2, JobQueue.FAILED: 0})
+
+  def test_atomicPath(self):
+    path = os.path.join(self.directory, 'a_l.nrrd')
+    with JobQueue.atomicPath(path) as partialPath:
+      self.assertNotEqual(partialPath, path)
+      self.assertEqual(os.path.dirname(partialPath), self.directory)
+      self.assertTrue(partialPath.endswith('.nrrd'))
+      with open(partialPath, 'w') as f:
+        f.write('first')
+    self.assertEqual(os.listdir(self.directory), ['a_l.nrrd'])
+
+    # A failed write leaves the previous file and no partial one
+    with self.assertRaises(RuntimeError):
+      with JobQueue.atomicPath(path) as partialPath:
+        with open(partialPath, 'w') as f:
+          f.write('second')
+        raise RuntimeError('Write failed')
+    self.assertEqual(os.listdir(self.directory), ['a_l.nrrd'])
+    with open(path) as f:
+      self.assertEqual(f.read(), 'first')
+
+    # Also when nothing was written
+    with self.assertRaises(KeyboardInterrupt):
+      with JobQueue.atomicPath(os.path.join(self.directory, 'b_l.nrrd')):
+        raise KeyboardInterrupt()
+    self.assertEqual(os.listdir(self.directory), ['a_l.nrrd'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,87 @@
+import concurrent.futures
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from Tis_SegLib import ParallelProcessing
+from Tis_SegLib import Scheduling
+
+
+class ParallelProcessingTest(unittest.TestCase):
+  """
+  Admission of the jobs of a ParallelRunner, driven with futures that finish when the test decides.
+  """
+
+  # Estimated memory of the items, the budget of the runner is 10
+  MEMORY = [4, 4, 4, 9, 20, 1, 2, 3]
+
+  def schedule(self, ordered, finishFirst=max):
+    """
+    Run ParallelRunner._schedule with 3 workers. Each time the runner waits, the running item chosen by
+    finishFirst (from the indices) finishes. Returns the delivered indices and the running items at each wait.
+    """
+    runner = ParallelProcessing.ParallelRunner(3, ordered=ordered, threadsPerWorker=1,
+      memoryBudget=3 * Scheduling.WORKER_MEMORY + 10)
+    indices = {}
+    waits = []
+
+    def submit(index, item):
+      future = concurrent.futures.Future()
+      indices[future] = index
+      return future
+
+    def wait(futures, return_when):
+      self.assertEqual(return_when, concurrent.futures.FIRST_COMPLETED)
+      running = sorted(indices[future] for future in futures)
+      waits.append(running)
+      index = finishFirst(running)
+      future = [future for future in futures if indices[future] == index][0]
+      future.set_result(index)
+      return {future}, set(futures) - {future}
+
+    delivered = []
+    with mock.patch.object(concurrent.futures, 'wait', side_effect=wait):
+      for index, future in runner._schedule(self.MEMORY, submit, lambda memory: memory):
+        self.assertEqual(future.result(), index)
+        delivered.append(index)
+    return delivered, waits
+
+  def test_memoryBudget(self):
+    delivered, waits = self.schedule(ordered=False)
+    self.assertEqual(sorted(delivered), list(range(len(self.MEMORY))))
+    for running in waits:
+      self.assertLessEqual(len(running), 3)
+      # Only an item larger than the budget runs alone over it
+      if len(running) > 1:
+        self.assertLessEqual(sum(self.MEMORY[index] for index in running), 10, running)
+    # The items start in order: 2 waits for the memory of 1, 3 for all the others and 4 (over the budget) runs alone
+    self.assertEqual(waits, [[0, 1], [0, 2], [0], [3], [4], [5, 6, 7], [5, 6], [5]])
+
+  def test_orderedDelivery(self):
+    # The last submitted item finishes first
+    delivered, _ = self.schedule(ordered=True, finishFirst=max)
+    self.assertEqual(delivered, list(range(len(self.MEMORY))))
+    delivered, _ = self.schedule(ordered=False, finishFirst=max)
+    self.assertNotEqual(delivered, list(range(len(self.MEMORY))))
+
+  def test_noBudget(self):
+    runner = ParallelProcessing.ParallelRunner(2, threadsPerWorker=1)
+    runner.memoryBudget = None
+    submitted = []
+
+    def submit(index, item):
+      submitted.append(index)
+      future = concurrent.futures.Future()
+      future.set_result(item)
+      return future
+
+    results = [future.result() for _, future in runner._schedule(['a', 'b', 'c'], submit, lambda item: 10 ** 15)]
+    self.assertEqual(results, ['a', 'b', 'c'])
+    self.assertEqual(submitted, [0, 1, 2])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,169 @@
+import importlib.util
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from Tis_SegLib import PartitionProcessing
+from Tis_SegLib import Pipeline
+
+
+def fakeSegmentJob(job):
+  """
+  Stand-in for Pipeline.segmentJob that labels each voxel of the range from its own water value.
+  """
+  import SimpleITK as sitk
+  water = job['water']
+  if not isinstance(water, Pipeline.SlabImage):
+    water = Pipeline.SlabImage(water, 0, water.GetSize())
+  first = job['RangeSlice'][0] - water.first
+  last = job['RangeSlice'][1] - water.first
+  labels = sitk.Cast(water.slab[:, :, first:last] > 0.5, sitk.sitkUInt8)
+  return {'out_l': labels, 'out_r': labels, 'left_full_Q': True, 'right_full_Q': True, 'sum_left': 1, 'sum_right': 1}
+
+
+def hasLibrary():
+  try:
+    return importlib.util.find_spec('tisseglibrary') is not None
+  except Exception:
+    return False
+
+
+class PartitionProcessingTest(unittest.TestCase):
+  """
+  Chunks of PartitionProcessing and equivalence of the chunked and serial runs on the Benchmark phantoms.
+  """
+
+  SIZE = (96, 96, 40)
+
+  def test_incrementalChunkRanges(self):
+    chunks = PartitionProcessing.incrementalChunkRanges([10, 110], 10, chunkSlices=30)
+    self.assertEqual(chunks, [(10, 40), (40, 70), (70, 110)])
+    # Widening the range does not move the chunks before the last one
+    self.assertEqual(PartitionProcessing.incrementalChunkRanges([10, 140], 10, chunkSlices=30)[:2], chunks[:2])
+    self.assertEqual(PartitionProcessing.incrementalChunkRanges([0, 20], 10, chunkSlices=30), [(0, 20)])
+
+  def test_chunkMargin(self):
+    self.assertEqual(PartitionProcessing.chunkMargin(1), PartitionProcessing.MORPHOLOGY_MARGIN)
+    self.assertEqual(PartitionProcessing.chunkMargin(5), 10)
+    self.assertEqual(PartitionProcessing.chunkMargin(10), 10)
+
+  def job(self, region):
+    from Tis_SegLib import Benchmark, Pipeline
+    if region == Pipeline.THIGH:
+      water, fat = Benchmark.thighPhantom(self.SIZE)
+      roi = None
+    else:
+      water, fat, roi = Benchmark.abdomenPhantom(self.SIZE)
+    minSlice, maxSlice = Benchmark.caseRange(self.SIZE, 1.0)
+    return {
+      'region': region,
+      'fat': fat,
+      'water': water,
+      'roi': roi,
+      'RangeSlice': Pipeline.sliceRange(minSlice, maxSlice),
+      'partitions': 5,
+      'incomplete': False,
+      }
+
+  def assertSameResult(self, result, expected):
+    import SimpleITK as sitk
+    self.assertEqual(sorted(result), sorted(expected))
+    for key in expected:
+      if key.startswith('out_'):
+        self.assertTrue(sitk.GetArrayViewFromImage(expected[key]).any(), key)
+        self.assertEqual(result[key].GetSize(), expected[key].GetSize(), key)
+        self.assertEqual(result[key].GetOrigin(), expected[key].GetOrigin(), key)
+        different = (sitk.GetArrayViewFromImage(result[key]) != sitk.GetArrayViewFromImage(expected[key])).sum()
+        self.assertEqual(different, 0, '{0}: {1} voxels differ from the serial run'.format(key, different))
+      else:
+        self.assertEqual(result[key], expected[key], key)
+
+  def checkChunkedRun(self, region):
+    import tempfile
+    from Tis_SegLib import Pipeline, ResultCache
+    job = self.job(region)
+    expected = Pipeline.segmentJob(dict(job))
+    self.assertSameResult(PartitionProcessing.segmentInChunks(dict(job), 2), expected)
+    # The range fits in a single incremental chunk, which is segmented like the whole range
+    with tempfile.TemporaryDirectory() as directory:
+      cache = ResultCache.ResultCache(directory)
+      self.assertSameResult(PartitionProcessing.segmentInChunks(dict(job), 2, incremental=True, cache=cache), expected)
+
+  def incrementalJob(self, water):
+    import SimpleITK as sitk
+    image = sitk.GetImageFromArray(water)
+    return {
+      'region': Pipeline.THIGH,
+      'fat': image,
+      'water': image,
+      'RangeSlice': [0, water.shape[0]],
+      'partitions': 10,
+      'incomplete': False,
+      }
+
+  def test_incrementalCache(self):
+    import numpy as np
+    import SimpleITK as sitk
+    from Tis_SegLib import ResultCache
+    water = np.random.default_rng(0).random((100, 16, 16)).astype(np.float32)
+    expected = (water > 0.5).astype(np.uint8)
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory, True)
+    cache = ResultCache.ResultCache(directory)
+
+    with mock.patch.object(Pipeline, 'segmentJob', side_effect=fakeSegmentJob) as segmentJob:
+      # Chunks [0, 30), [30, 60) and [60, 100) with margins of 10 slices
+      result = PartitionProcessing.segmentInChunks(self.incrementalJob(water), 1, incremental=True, cache=cache)
+      self.assertEqual(segmentJob.call_count, 3)
+      self.assertTrue(np.array_equal(sitk.GetArrayViewFromImage(result['out_l']), expected))
+      self.assertEqual(result['sum_left'], 3)
+
+      # An unchanged range is read from the cache
+      segmentJob.reset_mock()
+      result = PartitionProcessing.segmentInChunks(self.incrementalJob(water), 1, incremental=True, cache=cache)
+      self.assertEqual(segmentJob.call_count, 0)
+      self.assertTrue(np.array_equal(sitk.GetArrayViewFromImage(result['out_l']), expected))
+
+      # Slice 45 is only seen by the second chunk (slices 20 to 70 with its margins)
+      segmentJob.reset_mock()
+      water[45] = 1 - water[45]
+      result = PartitionProcessing.segmentInChunks(self.incrementalJob(water), 1, incremental=True, cache=cache)
+      self.assertEqual(segmentJob.call_count, 1)
+      self.assertEqual(segmentJob.call_args[0][0]['RangeSlice'], [20, 70])
+      self.assertTrue(np.array_equal(sitk.GetArrayViewFromImage(result['out_l']), (water > 0.5).astype(np.uint8)))
+
+  def test_incrementalDisagreement(self):
+    import numpy as np
+
+    def segmentJob(job):
+      result = fakeSegmentJob(job)
+      # The library finds an incomplete left thigh in the last chunk only
+      result['left_full_Q'] = job['RangeSlice'][1] < 100 or job['RangeSlice'][0] == 0
+      return result
+
+    water = np.random.default_rng(0).random((100, 16, 16)).astype(np.float32)
+    with mock.patch.object(Pipeline, 'segmentJob', side_effect=segmentJob) as patched:
+      result = PartitionProcessing.segmentInChunks(self.incrementalJob(water), 1, incremental=True)
+    # The chunks cannot be stitched, the whole range is segmented again
+    self.assertEqual(patched.call_count, 4)
+    self.assertEqual(patched.call_args[0][0]['RangeSlice'], [0, 100])
+    self.assertTrue(result['left_full_Q'])
+
+  @unittest.skipUnless(hasLibrary(), 'tisseglibrary is not installed')
+  def test_chunkedThighMatchesSerial(self):
+    from Tis_SegLib import Pipeline
+    self.checkChunkedRun(Pipeline.THIGH)
+
+  @unittest.skipUnless(hasLibrary(), 'tisseglibrary is not installed')
+  def test_chunkedAbdomenMatchesSerial(self):
+    from Tis_SegLib import Pipeline
+    self.checkChunkedRun(Pipeline.ABDOMEN)
+
+
+if __name__ == '__main__':
+  unittest.main()
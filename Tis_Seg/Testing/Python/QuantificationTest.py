@@ -0,0 +1,87 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+import numpy as np
+
+from Tis_SegLib import Pipeline
+from Tis_SegLib import Quantification
+
+
+class QuantificationTest(unittest.TestCase):
+  """
+  Slice statistics of the labelmaps and rows of the quantification table.
+  """
+
+  def setUp(self):
+    random = np.random.default_rng(0)
+    tissues = [label for label, _ in Quantification.tissueLabels(Pipeline.THIGH)]
+    # Tissue labels, background and a label that is not a tissue
+    self.labels = random.choice(tissues + [0, 3], size=(23, 12, 10)).astype(np.uint8)
+    self.fat = random.random(self.labels.shape).astype(np.float32)
+    self.water = random.random(self.labels.shape).astype(np.float32)
+    self.water[0, 0, 0] = self.fat[0, 0, 0] = 0
+
+  def naiveStatistics(self):
+    tissues = Quantification.tissueLabels(Pipeline.THIGH)
+    counts = np.zeros((self.labels.shape[0], len(tissues)), np.int64)
+    sums = np.zeros((self.labels.shape[0], len(tissues)))
+    for k in range(self.labels.shape[0]):
+      for column, (label, _) in enumerate(tissues):
+        mask = self.labels[k] == label
+        counts[k, column] = mask.sum()
+        total = self.fat[k][mask].astype(np.float64) + self.water[k][mask]
+        fatFraction = np.where(total > 0, self.fat[k][mask] / np.where(total > 0, total, 1), 0)
+        sums[k, column] = fatFraction.sum()
+    return counts, sums
+
+  def test_sliceStatistics(self):
+    counts, sums = Quantification.sliceStatistics(self.labels, self.fat, self.water, Pipeline.THIGH)
+    expectedCounts, expectedSums = self.naiveStatistics()
+    self.assertTrue(np.array_equal(counts, expectedCounts))
+    self.assertTrue(np.allclose(sums, expectedSums, rtol=1e-5))
+    with self.assertRaises(ValueError):
+      Quantification.sliceStatistics(self.labels[1:], self.fat, self.water, Pipeline.THIGH)
+
+  def test_partitionStarts(self):
+    self.assertEqual(Quantification.partitionStarts(40, 10), [0, 10, 20, 30])
+    # The slices that do not fill a partition go to the last one
+    self.assertEqual(Quantification.partitionStarts(23, 10), [0, 10])
+    self.assertEqual(Quantification.partitionStarts(5, 10), [0])
+    self.assertEqual(Quantification.partitionStarts(3, 1), [0, 1, 2])
+
+  def test_statisticsRows(self):
+    counts, sums = Quantification.sliceStatistics(self.labels, self.fat, self.water, Pipeline.THIGH)
+    rows = Quantification.statisticsRows(counts, sums, (1.0, 2.0, 5.0), [30, 53], 10, Pipeline.THIGH, 'left')
+    tissues = Quantification.tissueLabels(Pipeline.THIGH)
+    byScope = {}
+    for row in rows:
+      byScope.setdefault(row['scope'], []).append(row)
+    self.assertEqual(sorted(byScope), ['nominalPartition', 'slice', 'total'])
+    self.assertEqual(len(byScope['slice']), 23 * len(tissues))
+    self.assertEqual(len(byScope['total']), len(tissues))
+
+    partitions = sorted(set((row['index'], row['firstSlice'], row['lastSlice']) for row in byScope['nominalPartition']))
+    self.assertEqual(partitions, [(0, 30, 39), (1, 40, 52)])
+    for column, (label, tissue) in enumerate(tissues):
+      total = [row for row in byScope['total'] if row['label'] == label][0]
+      self.assertEqual((total['firstSlice'], total['lastSlice'], total['tissue'], total['side']), (30, 52, tissue, 'left'))
+      self.assertEqual(total['voxels'], counts[:, column].sum())
+      self.assertAlmostEqual(total['volumeMl'], total['voxels'] * 10.0 / 1000.0)
+      self.assertAlmostEqual(total['meanFatFraction'], sums[:, column].sum() / counts[:, column].sum())
+      partitionVoxels = [row['voxels'] for row in byScope['nominalPartition'] if row['label'] == label]
+      self.assertEqual(partitionVoxels, [counts[:10, column].sum(), counts[10:, column].sum()])
+      sliceRows = [row for row in byScope['slice'] if row['label'] == label]
+      self.assertEqual([row['index'] for row in sliceRows], list(range(30, 53)))
+      self.assertEqual([row['voxels'] for row in sliceRows], counts[:, column].tolist())
+
+  def test_emptyTissue(self):
+    counts = np.zeros((4, len(Quantification.tissueLabels(Pipeline.ABDOMEN))), np.int64)
+    rows = Quantification.statisticsRows(counts, counts.astype(float), (1.0, 1.0, 1.0), [0, 4], 2, Pipeline.ABDOMEN)
+    self.assertTrue(all(row['voxels'] == 0 and row['meanFatFraction'] is None for row in rows))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,123 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+import numpy as np
+import SimpleITK as sitk
+
+from Tis_SegLib import Pipeline
+from Tis_SegLib import ResultCache
+
+
+def image(array, spacing=(1.0, 1.0, 3.0), origin=(0.0, 0.0, 0.0)):
+  result = sitk.GetImageFromArray(array)
+  result.SetSpacing(spacing)
+  result.SetOrigin(origin)
+  return result
+
+
+class ResultCacheTest(unittest.TestCase):
+  """
+  Keys of the segmentation jobs and storage of their results.
+  """
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    random = np.random.default_rng(0)
+    self.water = random.random((20, 16, 16)).astype(np.float32)
+    self.fat = random.random((20, 16, 16)).astype(np.float32)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory, ignore_errors=True)
+
+  def job(self, **changes):
+    job = {
+      'region': Pipeline.THIGH,
+      'fat': image(self.fat),
+      'water': image(self.water),
+      'RangeSlice': [0, 20],
+      'partitions': 5,
+      'incomplete': False,
+      }
+    job.update(changes)
+    return job
+
+  def result(self, value=1):
+    return {
+      'out_l': image(np.full((20, 16, 16), value, dtype=np.uint8)),
+      'left_full_Q': np.bool_(True),
+      'sum_left': np.int64(value * 5120),
+      }
+
+  def test_keyIsStable(self):
+    key = ResultCache.jobKey(self.job())
+    self.assertEqual(ResultCache.jobKey(self.job()), key)
+    # Copies of the images with the same voxels and geometry give the same key
+    self.assertEqual(ResultCache.jobKey(self.job(fat=image(self.fat.copy()))), key)
+
+  def test_keyChangesWithInputs(self):
+    key = ResultCache.jobKey(self.job())
+    fat = self.fat.copy()
+    fat[10, 8, 8] += 0.5
+    changed = [
+      self.job(fat=image(fat)),
+      self.job(water=image(self.water, spacing=(1.0, 1.0, 2.0))),
+      self.job(water=image(self.water, origin=(0.0, 0.0, 1.0))),
+      self.job(RangeSlice=[0, 15]),
+      self.job(partitions=10),
+      self.job(incomplete=True),
+      self.job(region=Pipeline.ABDOMEN),
+      self.job(roi=image((self.fat > 0.5).astype(np.uint8))),
+      ]
+    keys = [ResultCache.jobKey(job) for job in changed]
+    self.assertNotIn(key, keys)
+    self.assertEqual(len(set(keys)), len(keys))
+
+  def test_keyOfSlab(self):
+    # A slab and the same slices of the whole image are different inputs
+    fat = image(self.fat)
+    slab = Pipeline.SlabImage(fat[:, :, 5:15], 5, fat.GetSize())
+    self.assertNotEqual(ResultCache.jobKey(self.job(fat=slab)), ResultCache.jobKey(self.job(fat=fat[:, :, 5:15])))
+
+  def test_putGet(self):
+    cache = ResultCache.ResultCache(self.directory)
+    self.assertIsNone(cache.get('missing'))
+    cache.put('key', self.result(3))
+    stored = cache.get('key')
+    self.assertEqual(sorted(stored), ['left_full_Q', 'out_l', 'sum_left'])
+    self.assertTrue(np.array_equal(sitk.GetArrayViewFromImage(stored['out_l']), np.full((20, 16, 16), 3)))
+    self.assertEqual(stored['out_l'].GetSpacing(), (1.0, 1.0, 3.0))
+    self.assertIs(stored['left_full_Q'], True)
+    self.assertEqual(stored['sum_left'], 3 * 5120)
+    # Storing again replaces the entry
+    cache.put('key', self.result(4))
+    self.assertEqual(cache.get('key')['sum_left'], 4 * 5120)
+    self.assertEqual([key for _, _, key in cache.entries()], ['key'])
+
+  def test_leastRecentlyUsedEviction(self):
+    cache = ResultCache.ResultCache(self.directory)
+    cache.put('a', self.result(1))
+    cache.put('b', self.result(2))
+    os.utime(os.path.join(self.directory, 'a', ResultCache.RESULT_FILE), (1000, 1000))
+    os.utime(os.path.join(self.directory, 'b', ResultCache.RESULT_FILE), (2000, 2000))
+    self.assertEqual([key for _, _, key in cache.entries()], ['a', 'b'])
+
+    # Reading 'a' makes 'b' the least recently used entry
+    self.assertIsNotNone(cache.get('a'))
+    size = max(size for _, size, _ in cache.entries())
+    cache.maximumSize = 2 * size + size // 2
+    cache.put('c', self.result(3))
+    self.assertEqual(sorted(key for _, _, key in cache.entries()), ['a', 'c'])
+    self.assertLessEqual(sum(size for _, size, _ in cache.entries()), cache.maximumSize)
+
+    cache.maximumSize = 0
+    cache.evict()
+    self.assertEqual(cache.entries(), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,79 @@
+import os
+import sys
+import types
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from Tis_SegLib import Scheduling
+
+
+def cpuInfo(sockets, coresPerSocket, threadsPerCore):
+  """
+  Content of /proc/cpuinfo with one entry per logical processor.
+  """
+  entries = []
+  processor = 0
+  for socket in range(sockets):
+    for thread in range(threadsPerCore):
+      for core in range(coresPerSocket):
+        entries.append('processor\t: {0}\nphysical id\t: {1}\ncore id\t\t: {2}\n'.format(processor, socket, core))
+        processor += 1
+  return '\n'.join(entries)
+
+
+class SchedulingTest(unittest.TestCase):
+  """
+  Physical cores and threads of the workers, without psutil (read from /proc/cpuinfo) and with it.
+  """
+
+  def physicalCores(self, logical, info=None, affinity=None, psutil=None):
+    patches = [
+      mock.patch('os.cpu_count', return_value=logical),
+      mock.patch.dict(sys.modules, {'psutil': psutil}),
+      ]
+    if hasattr(os, 'sched_getaffinity'):
+      patches.append(mock.patch('os.sched_getaffinity', return_value=set(range(affinity or logical or 0))))
+    if info is None:
+      patches.append(mock.patch('builtins.open', side_effect=OSError('No /proc/cpuinfo')))
+    else:
+      patches.append(mock.patch('builtins.open', mock.mock_open(read_data=info)))
+    for patch in patches:
+      patch.start()
+    try:
+      return Scheduling.physicalCores()
+    finally:
+      for patch in reversed(patches):
+        patch.stop()
+
+  def test_physicalCores(self):
+    # Two sockets of four cores with two hyper-threads each
+    self.assertEqual(self.physicalCores(16, cpuInfo(2, 4, 2)), 8)
+    self.assertEqual(self.physicalCores(4, cpuInfo(1, 4, 1)), 4)
+    # Without /proc/cpuinfo all the logical processors are counted
+    self.assertEqual(self.physicalCores(6), 6)
+    self.assertEqual(self.physicalCores(None), 1)
+    # psutil is used when it is installed
+    psutil = types.SimpleNamespace(cpu_count=lambda logical=True: 6)
+    self.assertEqual(self.physicalCores(12, psutil=psutil), 6)
+
+  @unittest.skipUnless(hasattr(os, 'sched_getaffinity'), 'No processor affinity on this platform')
+  def test_physicalCoresAffinity(self):
+    # The process can only run on 3 logical processors
+    self.assertEqual(self.physicalCores(16, cpuInfo(2, 4, 2), affinity=3), 3)
+
+  def test_threadsPerWorker(self):
+    with mock.patch.object(Scheduling, 'physicalCores', return_value=8):
+      self.assertEqual(Scheduling.threadsPerWorker(1), 8)
+      self.assertEqual(Scheduling.threadsPerWorker(3), 2)
+      self.assertEqual(Scheduling.threadsPerWorker(8), 1)
+      self.assertEqual(Scheduling.threadsPerWorker(16), 1)
+      self.assertEqual(Scheduling.threadsPerWorker(0), 8)
+
+  def test_jobMemory(self):
+    self.assertEqual(Scheduling.jobMemory(100, 10, 8), 100 * 10 * (8 + Scheduling.WORKING_COPIES * 8))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,164 @@
+import concurrent.futures
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from Tis_SegLib import SegmentationService
+
+
+class StubExecutor:
+  """
+  Executor that keeps the submitted calls, the test sets the state of their futures.
+  """
+
+  def __init__(self):
+    self.calls = []
+
+  def submit(self, function, *args):
+    future = concurrent.futures.Future()
+    self.calls.append((function, args, future))
+    return future
+
+  def shutdown(self, wait=True, cancel_futures=False):
+    pass
+
+
+def record(status='done'):
+  return {'id': 's1', 'status': status, 'error': 'Segmentation failed' if status == 'failed' else None, 'outputs': {}}
+
+
+class SegmentationServiceTest(unittest.TestCase):
+  """
+  Jobs of the segmentation service, run by a stub executor, and the restrictions of the service.
+  """
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.directory, True)
+    self.outputDirectory = os.path.join(self.directory, 'results')
+    self.executor = StubExecutor()
+    self.service = SegmentationService.SegmentationService(self.outputDirectory, executor=self.executor)
+    self.request = {'id': 's1', 'region': 'thigh', 'water': '/data/s1_W.nrrd', 'fat': '/data/s1_F.nrrd'}
+
+  def test_submit(self):
+    jobId = self.service.submit(dict(self.request, quantify='true', options={'format': 'nii.gz'}))
+    self.assertEqual(len(self.executor.calls), 1)
+    function, (study, outputDirectory, quantify, options), future = self.executor.calls[0]
+    self.assertIs(function, SegmentationService._processJob)
+    self.assertEqual((study['id'], study['region'], study['water']), ('s1', 'thigh', '/data/s1_W.nrrd'))
+    self.assertEqual(outputDirectory, os.path.realpath(self.outputDirectory))
+    self.assertTrue(os.path.isdir(outputDirectory))
+    self.assertIs(quantify, True)
+    self.assertEqual(options['format'], 'nii.gz')
+
+    job = self.service.job(jobId)
+    self.assertEqual((job['id'], job['study'], job['status']), (jobId, 's1', SegmentationService.QUEUED))
+    self.assertNotIn('future', job)
+    self.assertEqual(self.service.counts(), {'queued': 1, 'running': 0, 'done': 0, 'failed': 0})
+
+    future.set_running_or_notify_cancel()
+    self.assertEqual(self.service.job(jobId)['status'], SegmentationService.RUNNING)
+    self.assertEqual(self.service.counts(), {'queued': 0, 'running': 1, 'done': 0, 'failed': 0})
+
+    future.set_result(record())
+    job = self.service.job(jobId, wait=True, timeout=5)
+    self.assertEqual(job['status'], SegmentationService.DONE)
+    self.assertEqual(job['record'], record())
+    self.assertIsNotNone(job['seconds'])
+    self.assertEqual(self.service.counts(), {'queued': 0, 'running': 0, 'done': 1, 'failed': 0})
+
+  def test_failedJobs(self):
+    failed = self.service.submit(self.request)
+    crashed = self.service.submit(self.request)
+    self.executor.calls[0][2].set_result(record('failed'))
+    self.executor.calls[1][2].set_exception(MemoryError('out of memory'))
+    self.assertEqual(self.service.job(failed)['error'], 'Segmentation failed')
+    self.assertEqual(self.service.job(crashed)['error'], 'MemoryError: out of memory')
+    self.assertEqual(self.service.counts(), {'queued': 0, 'running': 0, 'done': 0, 'failed': 2})
+    self.assertIsNone(self.service.job('unknown'))
+    # A job still queued after the timeout is returned as it is
+    queued = self.service.submit(self.request)
+    self.assertEqual(self.service.job(queued, wait=True, timeout=0.01)['status'], SegmentationService.QUEUED)
+
+  def test_invalidRequests(self):
+    with self.assertRaises(ValueError):
+      self.service.submit({'region': 'thigh', 'water': '/data/s1_W.nrrd'})
+    with self.assertRaises(ValueError):
+      self.service.submit(dict(self.request, region='knee'))
+    # The id starts the name of the output files, it cannot lead outside of the output folder
+    for studyId in ('../../../tmp/evil', 'cohort/s1', '..', '.', os.path.join(self.directory, 'evil')):
+      with self.assertRaises(ValueError):
+        self.service.submit(dict(self.request, id=studyId, options={'store': 'cohort.zarr'}))
+    self.assertEqual(self.executor.calls, [])
+
+  def test_outputsInsideOutputDirectory(self):
+    self.service.submit(dict(self.request, outputDirectory='cohort/s1', options={'store': 'cohort.zarr'}))
+    _, (_, outputDirectory, _, options), _ = self.executor.calls[0]
+    root = os.path.realpath(self.outputDirectory)
+    self.assertEqual(outputDirectory, os.path.join(root, 'cohort', 's1'))
+    self.assertEqual(options['store'], os.path.join(root, 'cohort.zarr'))
+    self.service.submit(dict(self.request, outputDirectory=os.path.join(root, 'other')))
+
+    for request in (dict(self.request, outputDirectory='../elsewhere'), dict(self.request, outputDirectory=self.directory),
+        dict(self.request, outputDirectory='/'), dict(self.request, options={'store': '../cohort.zarr'})):
+      with self.assertRaises(ValueError):
+        self.service.submit(request)
+    # A link inside the output folder to another folder does not escape it
+    os.symlink(self.directory, os.path.join(root, 'link'))
+    with self.assertRaises(ValueError):
+      self.service.submit(dict(self.request, outputDirectory='link/elsewhere'))
+    self.assertEqual(len(self.executor.calls), 2)
+    self.assertFalse(os.path.exists(os.path.join(self.directory, 'elsewhere')))
+
+  def test_loopbackOnly(self):
+    self.assertTrue(SegmentationService.isLoopback('127.0.0.1'))
+    self.assertTrue(SegmentationService.isLoopback('::1'))
+    self.assertFalse(SegmentationService.isLoopback('0.0.0.0'))
+    self.assertFalse(SegmentationService.isLoopback('192.168.1.10'))
+    for host in ('0.0.0.0', '::', '10.0.0.1'):
+      with self.assertRaises(ValueError):
+        SegmentationService.createServer(self.service, host, 0)
+
+  def test_httpApi(self):
+    server = SegmentationService.createServer(self.service, '127.0.0.1', 0)
+    self.addCleanup(server.server_close)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    self.addCleanup(server.shutdown)
+    url = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+
+    def post(body):
+      request = urllib.request.Request(url + '/jobs', json.dumps(body).encode(), method='POST')
+      try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+          return response.status, json.loads(response.read())
+      except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+    code, job = post(self.request)
+    self.assertEqual((code, job['status']), (202, SegmentationService.QUEUED))
+    code, answer = post(dict(self.request, outputDirectory='..'))
+    self.assertEqual(code, 400)
+    self.assertIn('output folder', answer['error'])
+    code, answer = post(dict(self.request, id='../../../tmp/evil'))
+    self.assertEqual(code, 400)
+    self.assertIn('folders', answer['error'])
+    self.assertEqual(len(self.executor.calls), 1)
+
+    self.executor.calls[0][2].set_result(record())
+    with urllib.request.urlopen(url + '/jobs/' + job['id'], timeout=10) as response:
+      self.assertEqual(json.loads(response.read())['status'], SegmentationService.DONE)
+    with urllib.request.urlopen(url + '/health', timeout=10) as response:
+      self.assertEqual(json.loads(response.read())['jobs'], {'queued': 0, 'running': 0, 'done': 1, 'failed': 0})
+
+
+if __name__ == '__main__':
+  unittest.main()
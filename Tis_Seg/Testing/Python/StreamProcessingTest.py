@@ -0,0 +1,98 @@
+import importlib.util
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+import numpy as np
+import SimpleITK as sitk
+
+from Tis_SegLib import BatchProcessing
+from Tis_SegLib import Benchmark
+from Tis_SegLib import Pipeline
+from Tis_SegLib import StreamProcessing
+
+
+def hasLibrary():
+  try:
+    return importlib.util.find_spec('tisseglibrary') is not None
+  except Exception:
+    return False
+
+
+class StreamProcessingTest(unittest.TestCase):
+  """
+  Streamed segmentation of a study compared with BatchProcessing.processStudy.
+  """
+
+  SIZE = (96, 96, 40)
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.directory, True)
+
+  def study(self, water, fat, minSlice, maxSlice, partitions):
+    paths = {}
+    for name, image in (('water', water), ('fat', fat)):
+      paths[name] = os.path.join(self.directory, name + '.nrrd')
+      # Uncompressed, so that the streamed run reads the inputs through a memory map
+      sitk.WriteImage(image, paths[name], False)
+    return BatchProcessing.normalizeStudy({'id': 'phantom', 'region': Pipeline.THIGH, 'water': paths['water'], 'fat': paths['fat'],
+      'minSlice': minSlice, 'maxSlice': maxSlice, 'partitions': partitions})
+
+  def outputDirectory(self, name):
+    path = os.path.join(self.directory, name)
+    os.makedirs(path)
+    return path
+
+  @unittest.skipUnless(hasLibrary(), 'tisseglibrary is not installed')
+  def test_streamMatchesBatch(self):
+    water, fat = Benchmark.thighPhantom(self.SIZE)
+    minSlice, maxSlice = Benchmark.caseRange(self.SIZE, 1.0)
+    study = self.study(water, fat, minSlice, maxSlice, 5)
+
+    expected = BatchProcessing.processStudy(study, self.outputDirectory('batch'))
+    # The range fits in one chunk
+    record = StreamProcessing.processStudy(study, self.outputDirectory('stream'), chunkSlices=self.SIZE[2])
+    self.assertEqual(expected['status'], 'done', expected['error'])
+    self.assertEqual(record['status'], 'done', record['error'])
+    self.assertEqual(record['message'], expected['message'])
+    self.assertEqual(record['segmentSuffixes'], expected['segmentSuffixes'])
+    for flag in ('left_full_Q', 'right_full_Q', 'sum_left', 'sum_right'):
+      self.assertEqual(record[flag], expected[flag], flag)
+    self.assertEqual(sorted(record['outputs']), sorted(expected['outputs']))
+    self.assertTrue(expected['outputs'])
+    for name, path in expected['outputs'].items():
+      expected_img = sitk.ReadImage(path)
+      label_img = sitk.ReadImage(record['outputs'][name])
+      self.assertEqual(label_img.GetSize(), expected_img.GetSize(), name)
+      self.assertEqual(label_img.GetOrigin(), expected_img.GetOrigin(), name)
+      self.assertTrue(np.array_equal(sitk.GetArrayViewFromImage(label_img), sitk.GetArrayViewFromImage(expected_img)), name)
+
+  def test_chunksDisagree(self):
+    random = np.random.default_rng(0)
+    water = sitk.GetImageFromArray(random.random((100, 16, 16)).astype(np.float32))
+    fat = sitk.GetImageFromArray(random.random((100, 16, 16)).astype(np.float32))
+    study = self.study(water, fat, 0, 99, 10)
+
+    def segmentThigh(fat_img, water_img, RangeSlice, numberOfPartitions, incomplete, master_img=None):
+      first = RangeSlice[0] - water_img.first
+      labels = sitk.Cast(water_img.slab[:, :, first:first + RangeSlice[1] - RangeSlice[0]] > 0.5, sitk.sitkUInt8)
+      # The left thigh looks incomplete in the last chunk only
+      return {'out_l': labels, 'out_r': labels, 'left_full_Q': RangeSlice[1] < 100, 'right_full_Q': True, 'sum_left': 1, 'sum_right': 1}
+
+    outputDirectory = self.outputDirectory('stream')
+    with mock.patch.object(Pipeline, 'segmentThigh', side_effect=segmentThigh):
+      record = StreamProcessing.processStudy(study, outputDirectory, chunkSlices=30)
+    self.assertEqual(record['status'], 'failed')
+    self.assertEqual(record['error'], StreamProcessing.CHUNKS_DISAGREE_ERROR)
+    self.assertEqual(record['outputs'], {})
+    self.assertEqual(os.listdir(outputDirectory), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,7 +1,22 @@
+import logging
+import os
+
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
 
+from Tis_SegLib import Alignment
+from Tis_SegLib import Dependencies
+from Tis_SegLib import Pipeline
+from Tis_SegLib import Preview
+from Tis_SegLib import Profiling
+from Tis_SegLib import Quantification
+from Tis_SegLib import RangeDetection
+from Tis_SegLib import ResultCache
+from Tis_SegLib import SegmentationImport
+from Tis_SegLib import VolumeBridge
+from Tis_SegLib import VolumeGeometry
+
 #
 # Tis_Seg
 #
@@ -100,9 +115,28 @@ class Tis_SegWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.ui.RangeWidget_Abdo.connect("maximumValueChanged(double)", self.updateParameterNodeFromGUIAbdo)
     self.ui.RangeWidget_Abdo.connect("minimumValueChanged(double)", self.updateParameterNodeFromGUIAbdo)    
 
+    self.ui.RunInBackgroundCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUIAdvanced)
+    self.ui.PartitionWorkersSpinBox.connect("valueChanged(int)", self.updateParameterNodeFromGUIAdvanced)
+    self.ui.UseResultCacheCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUIAdvanced)
+    self.ui.IncrementalCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUIAdvanced)
+    self.ui.BuildSurfacesCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUIAdvanced)
+    self.ui.SurfaceDecimationSpinBox.connect("valueChanged(double)", self.updateParameterNodeFromGUIAdvanced)
+    self.ui.ProfileLogPathLineEdit.connect("currentPathChanged(QString)", self.updateParameterNodeFromGUIAdvanced)
+    self.ui.WarmUpCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUIAdvanced)
+    self.ui.QuantifyCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUIAdvanced)
+    self.ui.QuantificationPathLineEdit.connect("currentPathChanged(QString)", self.updateParameterNodeFromGUIAdvanced)
+    self.ui.PreviewFactorSpinBox.connect("valueChanged(int)", self.updateParameterNodeFromGUIAdvanced)
+    self.ui.AutoRangeCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUIAdvanced)
+
     # Buttons
     self.ui.applyButton.connect('clicked(bool)', self.onApplyButton)
     self.ui.applyButtonAbdo.connect('clicked(bool)', self.onApplyButtonAbdo)
+    self.ui.previewButton.connect('clicked(bool)', self.onPreviewButton)
+    self.ui.previewButtonAbdo.connect('clicked(bool)', self.onPreviewButtonAbdo)
+    self.ui.detectRangeButton.connect('clicked(bool)', self.onDetectRangeButton)
+    self.ui.detectRangeButtonAbdo.connect('clicked(bool)', self.onDetectRangeButtonAbdo)
+    self.ui.LoadDicomButton.connect('clicked(bool)', self.onLoadDicomButton)
+    self.ui.cancelBackgroundButton.connect('clicked(bool)', self.onCancelBackgroundButton)
 
 
     # Make sure parameter node is initialized (needed for module reload)
@@ -117,6 +151,7 @@ class Tis_SegWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.ui.segmentation_Abdo.setToolTip("Select the volume where the color segmentation will be saved")
     self.ui.NumberOfPartitions_Abdo.setToolTip('Select the number of partitions on which the volume will be analysed')
     self.ui.RangeWidget_Abdo.setToolTip('Select the number of slices of the image to be segmented. Both end slices are included')
+    self.ui.detectRangeButtonAbdo.setToolTip('Set the range to the slices that contain the abdomen, in whole partitions')
 
     self.ui.inputSelectorWater.setToolTip ('Pick the water input image')
     self.ui.inputSelectorFat.setToolTip ('Pick the fat input image')
@@ -126,22 +161,55 @@ class Tis_SegWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.ui.segmentation_r.setToolTip("Select the volume where right thigh color segmentation will be saved")
     self.ui.NumberOfPartitions.setToolTip('Select the number of partitions on which the volume will be analysed')
     self.ui.RangeWidget.setToolTip('Select the number of slices of the image to be segmented. Both end slices are included')
+    self.ui.detectRangeButton.setToolTip('Set the range to the slices that contain the thighs, in whole partitions')
     self.ui.ProcessIncompleteCheckBox.setToolTip('If the box is checked, incomplete thighs will be segmented even though the results are not 100% accurate')
-    self.ui.MasterVolumeSelector.setToolTip("In case the images don't have the same spatial information, a master volume should be selected")
+    self.ui.MasterVolumeSelector.setToolTip("In case the images don't have the same spatial information, a master volume should be selected. "
+      "Images on a different voxel grid are resampled on the grid of the master volume")
+
+    self.ui.RunInBackgroundCheckBox.setToolTip('If the box is checked, Apply queues the segmentation in a background process and Slicer stays responsive while it runs')
+    self.ui.cancelBackgroundButton.setToolTip('Stop the running background segmentation and remove the queued ones')
+    self.ui.PartitionWorkersSpinBox.setToolTip('Number of processes among which the chunks computed again by the incremental re-segmentation are split. '
+      'Without incremental re-segmentation the range is always segmented in a single process')
+    self.ui.UseResultCacheCheckBox.setToolTip('If the box is checked, the results are kept on disk and reused when the same images are segmented again with the same settings')
+    self.ui.IncrementalCheckBox.setToolTip('If the box is checked, the range is segmented in chunks of partitions and only the chunks whose slices, '
+      'ROI or settings changed since the last run are computed again. The result is an approximation: the library clusters '
+      'and masks each chunk on its own, so the labelmaps can differ from a segmentation of the whole range, also far from the '
+      'chunk boundaries. Not used when running in background')
+    self.ui.BuildSurfacesCheckBox.setToolTip('If the box is checked, the 3D surfaces of the segmentations are built after Apply. '
+      'Otherwise they are only built when Show 3D is used, which makes Apply faster')
+    self.ui.SurfaceDecimationSpinBox.setToolTip('Fraction of the triangles removed from the 3D surfaces (0 keeps all of them)')
+    self.ui.WarmUpCheckBox.setToolTip('If the box is checked, the segmentation libraries are loaded in the background when the module is opened')
+    self.ui.ProfileLogPathLineEdit.setToolTip('If a file is selected, the time and memory of the stages of each run are appended to it (one JSON object per line)')
+    self.ui.QuantifyCheckBox.setToolTip('If the box is checked, the volume and mean fat fraction of each tissue are computed per slice, '
+      'per block of slices of the size of a partition and per thigh after Apply and shown in a table')
+    self.ui.QuantificationPathLineEdit.setToolTip('If a file is selected, the quantification table is also saved to it')
+    self.ui.PreviewFactorSpinBox.setToolTip('Factor by which the rows and columns of the images are reduced for the preview')
+    self.ui.LoadDicomButton.setToolTip('Find the Dixon water and fat series of a DICOM folder, load them and select them as inputs. '
+      'Only the headers of the files are read to find them, and they are indexed so that the folder is scanned faster the next time')
+    self.ui.AutoRangeCheckBox.setToolTip('If the box is checked, the range is set to the slices that contain tissue before each Apply or Preview')
 
   def cleanup(self):
     """
     Called when the application closes and the module widget is destroyed.
     """
     self.removeObservers()
+    if self.logic:
+      self.logic.stopBackgroundProcessing()
+      self.logic.geometryCache.clear()
 
   def enter(self):
     """
     Called each time the user opens this module.
     """
-    # Make sure parameter node exists and observed
-    self.logic.installRequiredPythonPackages()
-    self.initializeParameterNode()
+    with self.logic.profiler.run('Module entry'):
+      with self.logic.profiler.stage('Dependency check'):
+        self.logic.installRequiredPythonPackages()
+      # Make sure parameter node exists and observed
+      with self.logic.profiler.stage('Parameter node'):
+        self.initializeParameterNode()
+    if self._parameterNode.GetParameter("WarmUp") == "true":
+      # Once the module is shown
+      qt.QTimer.singleShot(0, self.logic.warmUp)
 
   def exit(self):
     """
@@ -230,6 +298,20 @@ class Tis_SegWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.ui.RangeWidget_Abdo.maximumValue= float(self._parameterNode.GetParameter("MaxSliceRange_Abdo"))
     self.ui.RangeWidget_Abdo.minimumValue= float(self._parameterNode.GetParameter("MinSliceRange_Abdo"))
 
+    self.ui.RunInBackgroundCheckBox.checked = (self._parameterNode.GetParameter("RunInBackground") == "true")
+    self.ui.PartitionWorkersSpinBox.value = int(self._parameterNode.GetParameter("PartitionWorkers"))
+    self.ui.UseResultCacheCheckBox.checked = (self._parameterNode.GetParameter("UseResultCache") == "true")
+    self.ui.IncrementalCheckBox.checked = (self._parameterNode.GetParameter("Incremental") == "true")
+    self.ui.PartitionWorkersSpinBox.enabled = self.ui.IncrementalCheckBox.checked
+    self.ui.BuildSurfacesCheckBox.checked = (self._parameterNode.GetParameter("BuildSurfaces") == "true")
+    self.ui.SurfaceDecimationSpinBox.value = float(self._parameterNode.GetParameter("SurfaceDecimation"))
+    self.ui.ProfileLogPathLineEdit.currentPath = self._parameterNode.GetParameter("ProfileLogPath")
+    self.ui.WarmUpCheckBox.checked = (self._parameterNode.GetParameter("WarmUp") == "true")
+    self.ui.QuantifyCheckBox.checked = (self._parameterNode.GetParameter("Quantify") == "true")
+    self.ui.QuantificationPathLineEdit.currentPath = self._parameterNode.GetParameter("QuantificationPath")
+    self.ui.PreviewFactorSpinBox.value = int(self._parameterNode.GetParameter("PreviewFactor"))
+    self.ui.AutoRangeCheckBox.checked = (self._parameterNode.GetParameter("AutoRange") == "true")
+
     # Update buttons states and tooltips
     if  self._parameterNode.GetNodeReference("OutputVolume_r") and self._parameterNode.GetNodeReference("OutputVolume_l") and\
         self._parameterNode.GetNodeReference("Segmentation_r") and self._parameterNode.GetNodeReference("Segmentation_l"):
@@ -239,6 +321,10 @@ class Tis_SegWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       self.ui.applyButton.toolTip = "Select output volume node"
       self.ui.applyButton.enabled = False
 
+    # The preview only writes the labelmaps
+    self.ui.previewButton.enabled = bool(self._parameterNode.GetNodeReference("OutputVolume_r") and self._parameterNode.GetNodeReference("OutputVolume_l"))
+    self.ui.previewButtonAbdo.enabled = bool(self._parameterNode.GetNodeReference("OutputVolume_Abdo"))
+
     if  self._parameterNode.GetNodeReference("OutputVolume_Abdo") and self._parameterNode.GetNodeReference("Segmentation_Abdo"):
       self.ui.applyButtonAbdo.toolTip = "Compute output volume"
       self.ui.applyButtonAbdo.enabled = True
@@ -254,9 +340,7 @@ class Tis_SegWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     This method is called when the user select the input image.
     The changes are saved into the parameter node (so that they are restored when the scene is saved and loaded).
     """
-    import sitkUtils
-    fat_img=sitkUtils.PullVolumeFromSlicer(input)
-    aux = fat_img.GetSize()
+    aux = self.logic.getVolumeGeometry(input).size
     max = float (aux[2]-1)
     range.maximum=max
     
@@ -295,8 +379,6 @@ class Tis_SegWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     This method is called when the user makes any change in the GUI.
     The changes are saved into the parameter node (so that they are restored when the scene is saved and loaded).
     """
-    import sitkUtils
-
     if self._parameterNode is None or self._updatingGUIFromParameterNode:
       return
 
@@ -308,13 +390,10 @@ class Tis_SegWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     if self.ui.inputSelectorFat.currentNodeID=="" or self.ui.inputSelectorWater.currentNodeID=="" :
       return
     else:
-      fat_img = sitkUtils.PullVolumeFromSlicer(self.ui.inputSelectorFat.currentNodeID)
-      water_img = sitkUtils.PullVolumeFromSlicer(self.ui.inputSelectorWater.currentNodeID)
-      if fat_img.GetSize() != water_img.GetSize() or \
-              fat_img.GetSpacing() != water_img.GetSpacing()  or \
-              fat_img.GetDirection() != water_img.GetDirection() or \
-              fat_img.GetOrigin() != water_img.GetOrigin():
-        if fat_img.GetSize() == water_img.GetSize():
+      fat_geometry = self.logic.getVolumeGeometry(self.ui.inputSelectorFat.currentNodeID)
+      water_geometry = self.logic.getVolumeGeometry(self.ui.inputSelectorWater.currentNodeID)
+      if not fat_geometry.sameSpace(water_geometry):
+        if fat_geometry.size == water_geometry.size:
             msgBox = qt.QMessageBox()
             msgBox.setText("The images don't have the same spatial reference.")
             msgBox.setInformativeText("Select a master volume")
@@ -365,22 +444,79 @@ class Tis_SegWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       
       self.changeRangeWidgetMaximum(self.ui.inputSelectorFat_Abdo.currentNodeID, self.ui.RangeWidget_Abdo)
 
+  def updateParameterNodeFromGUIAdvanced(self, caller=None, event=None):
+    """
+    This method is called when the user changes the advanced settings.
+    The changes are saved into the parameter node (so that they are restored when the scene is saved and loaded).
+    """
+    if self._parameterNode is None or self._updatingGUIFromParameterNode:
+      return
+
+    wasModified = self._parameterNode.StartModify()  # Modify all properties in a single batch
+    self._parameterNode.SetParameter("RunInBackground", "true" if self.ui.RunInBackgroundCheckBox.checked else "false")
+    self._parameterNode.SetParameter("PartitionWorkers", str(self.ui.PartitionWorkersSpinBox.value))
+    self._parameterNode.SetParameter("UseResultCache", "true" if self.ui.UseResultCacheCheckBox.checked else "false")
+    self._parameterNode.SetParameter("Incremental", "true" if self.ui.IncrementalCheckBox.checked else "false")
+    self._parameterNode.SetParameter("BuildSurfaces", "true" if self.ui.BuildSurfacesCheckBox.checked else "false")
+    self._parameterNode.SetParameter("SurfaceDecimation", str(self.ui.SurfaceDecimationSpinBox.value))
+    self._parameterNode.SetParameter("ProfileLogPath", self.ui.ProfileLogPathLineEdit.currentPath)
+    self._parameterNode.SetParameter("WarmUp", "true" if self.ui.WarmUpCheckBox.checked else "false")
+    self._parameterNode.SetParameter("Quantify", "true" if self.ui.QuantifyCheckBox.checked else "false")
+    self._parameterNode.SetParameter("QuantificationPath", self.ui.QuantificationPathLineEdit.currentPath)
+    self._parameterNode.SetParameter("PreviewFactor", str(self.ui.PreviewFactorSpinBox.value))
+    self._parameterNode.SetParameter("AutoRange", "true" if self.ui.AutoRangeCheckBox.checked else "false")
+    self._parameterNode.EndModify(wasModified)
       
   
+  def configureLogic(self):
+    """
+    Pass the advanced settings to the logic. All the runs use the same logic, so they are recorded by its
+    profiler, reuse its aligned volumes and share its geometry cache (whose node observers are removed in cleanup).
+    """
+    logic = self.logic
+    logic.partitionWorkers = self.ui.PartitionWorkersSpinBox.value
+    logic.useResultCache = self.ui.UseResultCacheCheckBox.checked
+    logic.incrementalSegmentation = self.ui.IncrementalCheckBox.checked
+    logic.buildClosedSurfaces = self.ui.BuildSurfacesCheckBox.checked
+    logic.surfaceDecimation = self.ui.SurfaceDecimationSpinBox.value or None
+    logic.quantifyTissues = self.ui.QuantifyCheckBox.checked
+    logic.quantificationPath = self.ui.QuantificationPathLineEdit.currentPath or None
+    logic.profiler.logPath = self.ui.ProfileLogPathLineEdit.currentPath or None
+
+  def showLastRunProfile(self):
+    """
+    Show the stages of the last segmentation run in the advanced section.
+    """
+    run = self.logic.profiler.lastRun()
+    self.ui.ProfileSummaryLabel.text = run.summary() if run is not None else ''
+
   def onApplyButton(self):
     """
     Run processing when user clicks "Apply" button.
     """
+    if self.ui.AutoRangeCheckBox.checked:
+      self.detectRange(self.ui.inputSelectorWater.currentNode(), self.ui.inputSelectorFat.currentNode(),
+        self.ui.NumberOfPartitions.value, self.ui.RangeWidget, showMessage=False)
+    if self.ui.RunInBackgroundCheckBox.checked:
+      self.configureLogic()
+      self.logic.processInBackground(self.ui.inputSelectorWater.currentNode(), self.ui.inputSelectorFat.currentNode(),  \
+        self.ui.outputSelector_l.currentNode(), self.ui.segmentation_l.currentNode(),\
+        self.ui.outputSelector_r.currentNode(), self.ui.segmentation_r.currentNode(),\
+        self.ui.NumberOfPartitions.value, self.ui.RangeWidget.maximumValue, self.ui.RangeWidget.minimumValue,\
+        self.ui.ProcessIncompleteCheckBox.checked, self.ui.MasterVolumeSelector.currentNode(), onProgress=self.onBackgroundTaskProgress)
+      return
+
     self.ui.applyButton.text = 'Working...'
     self.ui.applyButton.setEnabled(False)
     slicer.app.processEvents()
 
-    logic = Tis_SegLogic()
-    logic.process(self.ui.inputSelectorWater.currentNode(), self.ui.inputSelectorFat.currentNode(),  \
+    self.configureLogic()
+    self.logic.process(self.ui.inputSelectorWater.currentNode(), self.ui.inputSelectorFat.currentNode(),  \
       self.ui.outputSelector_l.currentNode(), self.ui.segmentation_l.currentNode(),\
       self.ui.outputSelector_r.currentNode(), self.ui.segmentation_r.currentNode(),\
       self.ui.NumberOfPartitions.value, self.ui.RangeWidget.maximumValue, self.ui.RangeWidget.minimumValue,\
       self.ui.ProcessIncompleteCheckBox.checked, self.ui.MasterVolumeSelector.currentNode(),  showResult=True) 
+    self.showLastRunProfile()
 
     self.ui.applyButton.text = 'Apply'
     self.ui.applyButton.setEnabled(True)
@@ -390,23 +526,153 @@ class Tis_SegWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       """
       Run processing when user clicks "Apply" button.
       """
+      if self.ui.AutoRangeCheckBox.checked:
+        self.detectRange(self.ui.inputSelectorWater_Abdo.currentNode(), self.ui.inputSelectorFat_Abdo.currentNode(),
+          self.ui.NumberOfPartitions_Abdo.value, self.ui.RangeWidget_Abdo, showMessage=False)
+      if self.ui.RunInBackgroundCheckBox.checked:
+        self.configureLogic()
+        self.logic.processAbdoInBackground(self.ui.inputSelectorWater_Abdo.currentNode(), self.ui.inputSelectorFat_Abdo.currentNode(),\
+          self.ui.inputSelectorROI.currentNode(),self.ui.outputSelector_Abdo.currentNode(), self.ui.segmentation_Abdo.currentNode(),\
+          self.ui.NumberOfPartitions_Abdo.value, self.ui.RangeWidget_Abdo.maximumValue, self.ui.RangeWidget_Abdo.minimumValue, onProgress=self.onBackgroundTaskProgress)
+        return
+
       self.ui.applyButtonAbdo.text = 'Working...'
       self.ui.applyButtonAbdo.setEnabled(False)
       slicer.app.processEvents()
 
-      logic = Tis_SegLogic()
-      logic.processAbdo(self.ui.inputSelectorWater_Abdo.currentNode(), self.ui.inputSelectorFat_Abdo.currentNode(),\
+      self.configureLogic()
+      self.logic.processAbdo(self.ui.inputSelectorWater_Abdo.currentNode(), self.ui.inputSelectorFat_Abdo.currentNode(),\
         self.ui.inputSelectorROI.currentNode(),self.ui.outputSelector_Abdo.currentNode(), self.ui.segmentation_Abdo.currentNode(),\
         self.ui.NumberOfPartitions_Abdo.value, self.ui.RangeWidget_Abdo.maximumValue, self.ui.RangeWidget_Abdo.minimumValue, showResult=True) 
+      self.showLastRunProfile()
 
       self.ui.applyButtonAbdo.text = 'Apply'
       self.ui.applyButtonAbdo.setEnabled(True)
       slicer.app.processEvents()
 
+  def detectRange(self, inputVolumeW, inputVolumeF, numberOfPartitions, rangeWidget, showMessage=True):
+    """
+    Set a range widget to the slices that contain tissue (see RangeDetection). Returns False if no tissue is found.
+    """
+    if inputVolumeF is None:
+      return False
+    sliceRange = self.logic.detectSliceRange(inputVolumeW, inputVolumeF, numberOfPartitions)
+    if sliceRange is None:
+      if showMessage:
+        slicer.util.infoDisplay('No tissue was found in ' + inputVolumeF.GetName())
+      return False
+    # Widen first so that the new minimum is never above the current maximum
+    rangeWidget.maximumValue = rangeWidget.maximum
+    rangeWidget.minimumValue = sliceRange[0]
+    rangeWidget.maximumValue = sliceRange[1]
+    return True
+
+  def onDetectRangeButton(self):
+    self.detectRange(self.ui.inputSelectorWater.currentNode(), self.ui.inputSelectorFat.currentNode(),
+      self.ui.NumberOfPartitions.value, self.ui.RangeWidget)
+
+  def onDetectRangeButtonAbdo(self):
+    self.detectRange(self.ui.inputSelectorWater_Abdo.currentNode(), self.ui.inputSelectorFat_Abdo.currentNode(),
+      self.ui.NumberOfPartitions_Abdo.value, self.ui.RangeWidget_Abdo)
+
+  def onLoadDicomButton(self):
+    """
+    Load the water and fat series of the Dixon acquisitions of a DICOM folder and select the first ones as inputs.
+    """
+    directory = qt.QFileDialog.getExistingDirectory(slicer.util.mainWindow(), 'Dixon DICOM folder')
+    if not directory:
+      return
+    try:
+      loaded = self.logic.loadDixonSeries(directory)
+    except Exception as e:
+      logging.exception('Failed to load ' + directory)
+      slicer.util.errorDisplay('Failed to load the DICOM folder: {0}'.format(e))
+      return
+    if not loaded:
+      slicer.util.infoDisplay('No pair of Dixon water and fat series was found in ' + directory)
+      return
+    waterNode, fatNode = loaded[0]
+    self.ui.inputSelectorWater.setCurrentNode(waterNode)
+    self.ui.inputSelectorFat.setCurrentNode(fatNode)
+    self.ui.inputSelectorWater_Abdo.setCurrentNode(waterNode)
+    self.ui.inputSelectorFat_Abdo.setCurrentNode(fatNode)
+    if len(loaded) > 1:
+      slicer.util.infoDisplay('{0} Dixon acquisitions were loaded, the first one is selected'.format(len(loaded)))
+
+  def onPreviewButton(self):
+    """
+    Segment the thighs at low resolution when user clicks "Preview". If "Run in background" is checked,
+    the full-resolution segmentation is queued right after the preview is shown.
+    """
+    self.ui.previewButton.setEnabled(False)
+    slicer.app.processEvents()
+    if self.ui.AutoRangeCheckBox.checked:
+      self.detectRange(self.ui.inputSelectorWater.currentNode(), self.ui.inputSelectorFat.currentNode(),
+        self.ui.NumberOfPartitions.value, self.ui.RangeWidget, showMessage=False)
+
+    self.configureLogic()
+    shown = self.logic.preview(self.ui.inputSelectorWater.currentNode(), self.ui.inputSelectorFat.currentNode(),
+      self.ui.outputSelector_l.currentNode(), self.ui.outputSelector_r.currentNode(),
+      self.ui.NumberOfPartitions.value, self.ui.RangeWidget.maximumValue, self.ui.RangeWidget.minimumValue,
+      self.ui.ProcessIncompleteCheckBox.checked, self.ui.MasterVolumeSelector.currentNode(), self.ui.PreviewFactorSpinBox.value)
+    self.showLastRunProfile()
+
+    self.ui.previewButton.setEnabled(True)
+    slicer.app.processEvents()
+    if shown and self.ui.RunInBackgroundCheckBox.checked and self.ui.applyButton.enabled:
+      self.onApplyButton()
+
+  def onPreviewButtonAbdo(self):
+    """
+    Segment the abdomen at low resolution when user clicks "Preview". If "Run in background" is checked,
+    the full-resolution segmentation is queued right after the preview is shown.
+    """
+    self.ui.previewButtonAbdo.setEnabled(False)
+    slicer.app.processEvents()
+    if self.ui.AutoRangeCheckBox.checked:
+      self.detectRange(self.ui.inputSelectorWater_Abdo.currentNode(), self.ui.inputSelectorFat_Abdo.currentNode(),
+        self.ui.NumberOfPartitions_Abdo.value, self.ui.RangeWidget_Abdo, showMessage=False)
+
+    self.configureLogic()
+    shown = self.logic.previewAbdo(self.ui.inputSelectorWater_Abdo.currentNode(), self.ui.inputSelectorFat_Abdo.currentNode(),
+      self.ui.inputSelectorROI.currentNode(), self.ui.outputSelector_Abdo.currentNode(),
+      self.ui.NumberOfPartitions_Abdo.value, self.ui.RangeWidget_Abdo.maximumValue, self.ui.RangeWidget_Abdo.minimumValue,
+      self.ui.PreviewFactorSpinBox.value)
+    self.showLastRunProfile()
+
+    self.ui.previewButtonAbdo.setEnabled(True)
+    slicer.app.processEvents()
+    if shown and self.ui.RunInBackgroundCheckBox.checked and self.ui.applyButtonAbdo.enabled:
+      self.onApplyButtonAbdo()
+
+  def onBackgroundTaskProgress(self, task):
+    """
+    Show the state of the background segmentations.
+    """
+    queue = self.logic.backgroundQueue()
+    current = queue.currentTask
+    if current is not None:
+      status = '{0}: {1} ({2:.0f} s)'.format(current.name, current.status, current.elapsedTime())
+      if len(queue.tasks):
+        status += ', {0} queued'.format(len(queue.tasks))
+    else:
+      status = '{0}: {1}'.format(task.name, task.status)
+    self.ui.BackgroundStatusLabel.text = status
+    self.ui.cancelBackgroundButton.enabled = queue.numberOfPendingTasks() > 0
+
+  def onCancelBackgroundButton(self):
+    """
+    Cancel the running and queued background segmentations.
+    """
+    self.logic.backgroundQueue().cancelAll()
+
   #
 # Tis_SegLogic
 #
 
+# Application setting with the package versions of the last successful dependency check
+DEPENDENCY_STAMP_SETTING = 'Tis_Seg/DependencyStamp'
+
 class Tis_SegLogic(ScriptedLoadableModuleLogic):
   """This class should implement all the actual
   computation done by your module.  The interface
@@ -422,20 +688,56 @@ class Tis_SegLogic(ScriptedLoadableModuleLogic):
     Called when the logic class is instantiated. Can be used for initializing member variables.
     """
     ScriptedLoadableModuleLogic.__init__(self)
+    self._backgroundQueue = None
+    self.geometryCache = VolumeGeometry.GeometryCache()
+    # Inputs resampled on the grid of the master volume (see Alignment)
+    self.alignmentCache = Alignment.AlignmentCache()
+    # Number of processes among which the chunks of an incremental segmentation are split (see PartitionProcessing)
+    self.partitionWorkers = 1
+    # Reuse the results stored on disk for identical inputs and settings (see ResultCache)
+    self.useResultCache = False
+    self._resultCache = None
+    # Only segment again the chunks of partitions whose inputs changed (see PartitionProcessing)
+    self.incrementalSegmentation = False
+    # Build the 3D surfaces of the output segmentations, with this decimation factor (see SegmentationImport)
+    self.buildClosedSurfaces = True
+    self.surfaceDecimation = None
+    # Time and memory of the stages of the segmentation runs (see Profiling)
+    self.profiler = Profiling.Profiler()
+    # Compute the volume and fat fraction of the tissues after each run, optionally saved to a CSV file (see Quantification)
+    self.quantifyTissues = False
+    self.quantificationPath = None
+    self._dependenciesChecked = False
+    self._warmUpThread = None
 
   def installRequiredPythonPackages(self):
-    try: 
-      import skimage as sk
-    except: 
-      slicer.util.pip_install('scikit-image')
-    try:
-      import sklearn as skl
-    except: 
-      slicer.util.pip_install('scikit-learn')
-    try: 
-      from tisseglibrary import tisseglibrary
-    except: 
-      slicer.util.pip_install('TisSegLibrary')
+    """
+    Install the required packages that are missing. The check is skipped while the installed versions
+    are the ones recorded after the last successful check (see Dependencies).
+    """
+    if self._dependenciesChecked:
+      return
+    settings = qt.QSettings()
+    if settings.value(DEPENDENCY_STAMP_SETTING) != Dependencies.stamp():
+      for packageName in Dependencies.missingPackages():
+        slicer.util.pip_install(packageName)
+      if not Dependencies.missingPackages():
+        settings.setValue(DEPENDENCY_STAMP_SETTING, Dependencies.stamp())
+    self._dependenciesChecked = True
+
+  def warmUp(self):
+    """
+    Import the segmentation libraries in a background thread, so that the first Apply does not wait for them.
+    The import times are recorded by the profiler as a 'Warm-up' run.
+    """
+    if self._warmUpThread is None:
+      self._warmUpThread = Dependencies.warmUp(lambda seconds: self.profiler.record('Warm-up', seconds))
+
+  def getVolumeGeometry(self, volumeNode):
+    """
+    Size, spacing, origin and direction (as in SimpleITK) of a volume node or node ID, without reading its voxels.
+    """
+    return self.geometryCache.geometry(volumeNode)
 
   def setDefaultParameters(self, parameterNode):
     """
@@ -457,41 +759,251 @@ class Tis_SegLogic(ScriptedLoadableModuleLogic):
       parameterNode.SetParameter("MinSliceRange_Abdo", "20.00")
     if not parameterNode.GetParameter("MaxSliceRange_Abdo"):
       parameterNode.SetParameter("MaxSliceRange_Abdo", "60.00")
+
+    if not parameterNode.GetParameter("RunInBackground"):
+      parameterNode.SetParameter("RunInBackground", "false")
+    if not parameterNode.GetParameter("PartitionWorkers"):
+      parameterNode.SetParameter("PartitionWorkers", "1")
+    if not parameterNode.GetParameter("UseResultCache"):
+      parameterNode.SetParameter("UseResultCache", "false")
+    if not parameterNode.GetParameter("Incremental"):
+      parameterNode.SetParameter("Incremental", "false")
+    if not parameterNode.GetParameter("BuildSurfaces"):
+      parameterNode.SetParameter("BuildSurfaces", "true")
+    if not parameterNode.GetParameter("SurfaceDecimation"):
+      parameterNode.SetParameter("SurfaceDecimation", "0.0")
+    if not parameterNode.GetParameter("ProfileLogPath"):
+      parameterNode.SetParameter("ProfileLogPath", "")
+    if not parameterNode.GetParameter("WarmUp"):
+      parameterNode.SetParameter("WarmUp", "true")
+    if not parameterNode.GetParameter("Quantify"):
+      parameterNode.SetParameter("Quantify", "false")
+    if not parameterNode.GetParameter("QuantificationPath"):
+      parameterNode.SetParameter("QuantificationPath", "")
+    if not parameterNode.GetParameter("PreviewFactor"):
+      parameterNode.SetParameter("PreviewFactor", str(Preview.DEFAULT_PREVIEW_FACTOR))
+    if not parameterNode.GetParameter("AutoRange"):
+      parameterNode.SetParameter("AutoRange", "false")
     
+  def pullAbdomenInputs(self, inputVolumeW_Abdo, inputVolumeF_Abdo, inputVolumeROI, RangeSlice_Abdo=None):
+    """
+    Get the fat, water and ROI images of the abdomen from the scene.
+    The ROI segments are read as a labelmap with the geometry of the fat volume (see VolumeBridge.imageFromSegments),
+    or exported through a temporary labelmap node if they cannot be read directly.
+    If RangeSlice_Abdo is given, only the slices needed to segment it are read (see Pipeline.SlabImage).
+    """
+    with self.profiler.stage('Read fat'):
+      fat_img = VolumeBridge.imageFromVolume(inputVolumeF_Abdo, RangeSlice_Abdo)
+    with self.profiler.stage('Read water'):
+      water_img = VolumeBridge.imageFromVolume(inputVolumeW_Abdo, RangeSlice_Abdo)
+
+    with self.profiler.stage('Export ROI'):
+      roi_img = VolumeBridge.imageFromSegments(inputVolumeROI, inputVolumeF_Abdo, RangeSlice_Abdo)
+      if roi_img is None:
+        referenceVolumeNode = inputVolumeF_Abdo
+        labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+        inputVolumeROI.SetReferenceImageGeometryParameterFromVolumeNode(referenceVolumeNode)
+        slicer.modules.segmentations.logic().ExportVisibleSegmentsToLabelmapNode(inputVolumeROI, labelmapVolumeNode, referenceVolumeNode)
+        roi_img = VolumeBridge.imageFromVolume(labelmapVolumeNode, RangeSlice_Abdo)
+        slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
+
+    return fat_img, water_img, roi_img
+
+  def pullAlignedInput(self, volumeNode, MasterVolume, RangeSlice=None):
+    """
+    Image of an input volume. If it is not on the voxel grid of MasterVolume, it is resampled on that grid
+    and the resampled volume is cached until either node is modified (see Alignment).
+    Returns the image and whether it was resampled.
+    """
+    if MasterVolume is None or Alignment.sameVoxelGrid(self.getVolumeGeometry(volumeNode), self.getVolumeGeometry(MasterVolume)):
+      return VolumeBridge.imageFromVolume(volumeNode, RangeSlice), False
+    with self.profiler.stage('Align on master'):
+      image = self.alignmentCache.alignedImage(volumeNode, MasterVolume, VolumeBridge.imageFromVolume)
+    return (Pipeline.slabFromImage(image, RangeSlice) if RangeSlice is not None else image), True
+
+  def pullThighInputs(self, inputVolumeW, inputVolumeF, MasterVolume, RangeSlice=None):
+    """
+    Get the fat, water and (optional) master images of the thighs from the scene.
+    Inputs that are not on the voxel grid of the master volume are resampled on it, the master geometry is
+    copied to the others. If RangeSlice is given, only the slices needed to segment it are read (see Pipeline.SlabImage).
+    """
+    with self.profiler.stage('Read fat'):
+      fat_img, fatResampled = self.pullAlignedInput(inputVolumeF, MasterVolume, RangeSlice)
+    with self.profiler.stage('Read water'):
+      water_img, waterResampled = self.pullAlignedInput(inputVolumeW, MasterVolume, RangeSlice)
+    master_img = None
+    if MasterVolume is not None and not (fatResampled and waterResampled):
+      with self.profiler.stage('Read master'):
+        master_img = VolumeBridge.imageFromVolume(MasterVolume, RangeSlice)
+
+    return fat_img, water_img, master_img
+
+  def importSegmentation(self, outputVolume, segmentation, region, suffix=''):
+    """
+    Create the tissue segments of an output labelmap in a segmentation node (if there is one).
+    """
+    if segmentation is None:
+      return
+    with self.profiler.stage('Import segmentation ' + segmentation.GetName()):
+      imported = SegmentationImport.importLabelmap(outputVolume, segmentation, region, suffix,
+        self.buildClosedSurfaces, self.surfaceDecimation)
+    if not imported:
+      slicer.util.errorDisplay(SegmentationImport.SEGMENTATION_ERROR)
+
+  def quantifyOutputs(self, job, result, names):
+    """
+    Compute the volume and mean fat fraction of the tissues of the outputs of a job (see Quantification),
+    show them in a table node and save them to quantificationPath if it is set. The rows computed by
+    a background worker (result['quantification']) are used if present, the job then needs no images.
+    Returns the table node, or None if quantifyTissues is not set.
+    """
+    if not self.quantifyTissues or job is None:
+      return None
+    with self.profiler.stage('Quantification'):
+      if 'quantification' in result:
+        sides = [Quantification.SIDES[name] for name in names]
+        rows = [row for row in result['quantification'] if row['side'] in sides]
+      else:
+        rows = Quantification.quantifyResult(job, result, names)
+    tableName = 'Tissue quantification ' + job['region']
+    tableNode = slicer.mrmlScene.GetFirstNodeByName(tableName)
+    if tableNode is None or not tableNode.IsA('vtkMRMLTableNode'):
+      tableNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode', tableName)
+    Quantification.updateTableNode(tableNode, rows)
+    if self.quantificationPath:
+      try:
+        Quantification.writeCsv(rows, self.quantificationPath)
+      except OSError as e:
+        slicer.util.errorDisplay('Could not write {0}: {1}'.format(self.quantificationPath, e))
+    return tableNode
+
+  def storeAbdomenOutputs(self, result, OutputVolume_Abdo, Segmentation_Abdo, job=None):
+    """
+    Push the abdomen labelmap to the output volume and create its segmentation.
+    The tissues are quantified if the segmented job is given.
+    """
+    with self.profiler.stage('Write ' + OutputVolume_Abdo.GetName()):
+      VolumeBridge.updateVolumeFromImage(OutputVolume_Abdo, result['out_Abdo'])
+
+    with self.profiler.stage('Show in slice views'):
+      slicer.util.setSliceViewerLayers(background=OutputVolume_Abdo)
+
+    self.importSegmentation(OutputVolume_Abdo, Segmentation_Abdo, Pipeline.ABDOMEN)
+    self.quantifyOutputs(job, result, ['Abdo'])
+
+  def storeThighOutputs(self, result, incomplete, outputVolume_l, Segmentation_l, outputVolume_r, Segmentation_r, job=None):
+    """
+    Push the thigh labelmaps that are kept to the output volumes and create their segmentations.
+    The tissues of the segmented thighs are quantified if the segmented job is given.
+    """
+    message, outputs = Pipeline.thighOutputPlan(result, incomplete)
+    if message:
+      slicer.app.processEvents()
+      slicer.util.infoDisplay(message)
+
+    outputNodes = {'l': (outputVolume_l, Segmentation_l), 'r': (outputVolume_r, Segmentation_r)}
+    for side, suffix in outputs:
+      outputVolume, segmentation = outputNodes[side]
+      with self.profiler.stage('Write ' + outputVolume.GetName()):
+        VolumeBridge.updateVolumeFromImage(outputVolume, result['out_' + side])
+      with self.profiler.stage('Show in slice views'):
+        slicer.util.setSliceViewerLayers(background=outputVolume)
+      if suffix is not None:
+        self.importSegmentation(outputVolume, segmentation, Pipeline.THIGH, suffix)
+    self.quantifyOutputs(job, result, [side for side, suffix in outputs if suffix is not None])
+
+  def resultCache(self):
+    """
+    Cache of the segmentation results, in the Slicer cache directory (created on first use).
+    It has its own folder since clearing the cache removes the whole folder.
+    """
+    if self._resultCache is None:
+      self._resultCache = ResultCache.ResultCache(os.path.join(slicer.app.cachePath, 'Tis_Seg', 'Results'))
+    return self._resultCache
+
+  def cachedResult(self, job):
+    """
+    Return (key, result stored for the job) if the result cache is used, (key, None) if the job is not cached
+    and (None, None) if the cache is not used.
+    """
+    if not self.useResultCache:
+      return None, None
+    key = ResultCache.jobKey(job)
+    return key, self.resultCache().get(key)
+
+  def cacheResult(self, key, result):
+    """
+    Store a result under the key returned by cachedResult (nothing is done if the key is None).
+    """
+    if key is None:
+      return
+    try:
+      self.resultCache().put(key, result)
+    except Exception as e:
+      logging.warning('Could not store the segmentation result in the cache: {0}'.format(e))
+
+  def segmentImages(self, job):
+    """
+    Segment the images of a job (see ParallelProcessing.ParallelRunner.segmentImages) in this process.
+    The result cache is used if useResultCache is set. With incrementalSegmentation, only the chunks of
+    partitions whose inputs changed since they were last segmented are computed again, split among
+    self.partitionWorkers processes (see PartitionProcessing).
+    """
+    with self.profiler.stage('Cache lookup'):
+      key, result = self.cachedResult(job)
+    if result is not None:
+      self.profiler.tag(cached=True)
+      return result
+
+    with self.profiler.stage('Segmentation'):
+      if self.incrementalSegmentation:
+        from Tis_SegLib import PartitionProcessing
+        result = PartitionProcessing.segmentInChunks(job, self.partitionWorkers, incremental=True, cache=self.resultCache())
+      else:
+        result = Pipeline.segmentJob(job)
+
+    with self.profiler.stage('Cache store'):
+      self.cacheResult(key, result)
+    return result
+
+  def profileTags(self, region, inputVolume, RangeSlice, numberOfPartitions, incomplete=None):
+    """
+    Tags of a profiled run: region, size and spacing of the input volume, parameters and library version.
+    """
+    geometry = self.getVolumeGeometry(inputVolume)
+    return {
+      'region': region,
+      'size': geometry.size if geometry else None,
+      'spacing': geometry.spacing if geometry else None,
+      'RangeSlice': [int(RangeSlice[0]), int(RangeSlice[1])],
+      'partitions': float(numberOfPartitions),
+      'incomplete': incomplete,
+      'partitionWorkers': self.partitionWorkers,
+      'incremental': self.incrementalSegmentation,
+      'library': ResultCache.libraryVersion(),
+      }
+
   def getsegmentation_Abdo(self, inputVolumeW_Abdo, inputVolumeF_Abdo, inputVolumeROI , OutputVolume_Abdo, Segmentation_Abdo,  numberOfPartitions_Abdo, RangeSlice_Abdo):
       '''
       Compute the segmentation of the abdomen
       '''
-      import sitkUtils
-      from tisseglibrary import tisseglibrary
-
       if inputVolumeF_Abdo is None or inputVolumeW_Abdo is None or inputVolumeROI is None:
         slicer.util.errorDisplay('Select the input images') 
 
       else : 
-        #Leemos las imágenes
-        fat_img=sitkUtils.PullVolumeFromSlicer(inputVolumeF_Abdo)
-        water_img=sitkUtils.PullVolumeFromSlicer(inputVolumeW_Abdo)
+        with self.profiler.run('Abdomen', self.profileTags(Pipeline.ABDOMEN, inputVolumeF_Abdo, RangeSlice_Abdo, numberOfPartitions_Abdo)):
+          #Leemos las imágenes
+          fat_img, water_img, roi_img = self.pullAbdomenInputs(inputVolumeW_Abdo, inputVolumeF_Abdo, inputVolumeROI, RangeSlice_Abdo)
 
-        referenceVolumeNode = inputVolumeF_Abdo
-        labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
-        inputVolumeROI.SetReferenceImageGeometryParameterFromVolumeNode(referenceVolumeNode)
-        slicer.modules.segmentations.logic().ExportVisibleSegmentsToLabelmapNode(inputVolumeROI, labelmapVolumeNode, referenceVolumeNode)
-        roi_img = sitkUtils.PullVolumeFromSlicer(labelmapVolumeNode)
-        slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
-
-        #Comprobamos el número de particiones y el rango
-        if numberOfPartitions_Abdo > (RangeSlice_Abdo[1]-RangeSlice_Abdo[0]):
-          slicer.util.errorDisplay ('The number of partitions is greater than the selected range of slices')
-        else:
-          
-          classImage2_img = tisseglibrary.AbdomenSegmentation(fat_img, water_img, roi_img, RangeSlice_Abdo, numberOfPartitions_Abdo)
-          
-          sitkUtils.PushVolumeToSlicer(classImage2_img, OutputVolume_Abdo)
+          job = {'region': Pipeline.ABDOMEN, 'fat': fat_img, 'water': water_img, 'roi': roi_img,
+            'RangeSlice': RangeSlice_Abdo, 'partitions': numberOfPartitions_Abdo}
+          try:
+            result = self.segmentImages(job)
+          except ValueError as e:
+            slicer.util.errorDisplay(str(e))
+            return
 
-          slicer.util.setSliceViewerLayers(background=OutputVolume_Abdo)
-
-          tisseglibrary.ColorSegmentation_Abdo(OutputVolume_Abdo, Segmentation_Abdo)
+          self.storeAbdomenOutputs(result, OutputVolume_Abdo, Segmentation_Abdo, job)
 
 
   def getsegmentation(self, inputVolumeW, inputVolumeF,  outputVolume_l, Segmentation_l, outputVolume_r, Segmentation_r, RangeSlice, numberOfPartitions, incomplete, MasterVolume ):
@@ -499,117 +1011,34 @@ class Tis_SegLogic(ScriptedLoadableModuleLogic):
     Compute the segmentation of the thights
 
     '''
-    import sitkUtils
-    from tisseglibrary import tisseglibrary
-
     if inputVolumeF is None or inputVolumeW is None:
   
       slicer.util.errorDisplay('Select the input images') 
 
     else:
+      with self.profiler.run('Thigh', self.profileTags(Pipeline.THIGH, inputVolumeF, RangeSlice, numberOfPartitions, incomplete)):
         #Leemos las imágenes
-        fat_img=sitkUtils.PullVolumeFromSlicer(inputVolumeF)
-        water_img=sitkUtils.PullVolumeFromSlicer(inputVolumeW)
-       
-        if MasterVolume is not None:
-          master_img=sitkUtils.PullVolumeFromSlicer(MasterVolume)
-          fat_img.CopyInformation(master_img)
-          water_img.CopyInformation(master_img)
-
-
-        #Comprobamos el número de particiones y el rango
-        if numberOfPartitions > (RangeSlice[1]-RangeSlice[0]):
-          #self.delayDisplay('ERROR: número de particiones mayor que el rango de slices seleccionado', 10000)
-          slicer.util.errorDisplay ('The number of partitions is greater than the selected range of slices')
-        
-        else:
-          
-          out_l, out_r , right_full_Q, left_full_Q, sum_left, sum_right= tisseglibrary.ThighSegmentation(fat_img, water_img, 
-                                                                          RangeSlice, numberOfPartitions, incomplete)
-
-          if left_full_Q == True and right_full_Q == False:
-            print('entra en 1')
-            if incomplete == False:
-              slicer.util.infoDisplay("Incomplete right thigh. \nTo have them processed check the box")
-              sitkUtils.PushVolumeToSlicer(out_r , outputVolume_r)
-              slicer.util.setSliceViewerLayers(background=outputVolume_r)
-              
-            else:
-    
-              sitkUtils.PushVolumeToSlicer(out_r , outputVolume_r)
-              slicer.util.setSliceViewerLayers(background=outputVolume_r)
-              tisseglibrary.ColorSegmentation(outputVolume_r, '_r', Segmentation_r)
-
-            sitkUtils.PushVolumeToSlicer(out_l, outputVolume_l)
-            slicer.util.setSliceViewerLayers(background=outputVolume_l)
-            tisseglibrary.ColorSegmentation(outputVolume_l, '_l', Segmentation_l)
-            
-
-          elif left_full_Q == False and right_full_Q == True:
-            print('entra en 2')
-            if incomplete == False:
-              slicer.util.infoDisplay("Incomplete left thigh. \nTo have them processed check the box")
-              sitkUtils.PushVolumeToSlicer(out_l , outputVolume_l)
-              slicer.util.setSliceViewerLayers(background=outputVolume_l)
-
-            else:
-              sitkUtils.PushVolumeToSlicer(out_l , outputVolume_l)
-              slicer.util.setSliceViewerLayers(background=outputVolume_l)
-              tisseglibrary.ColorSegmentation(outputVolume_l, '_r', Segmentation_l)
-
-            
-            sitkUtils.PushVolumeToSlicer(out_r , outputVolume_r)
-            slicer.util.setSliceViewerLayers(background=outputVolume_r)
-            tisseglibrary.ColorSegmentation(outputVolume_r, '_r', Segmentation_r)
-
-          elif left_full_Q == True and right_full_Q == True:
-            
-            sitkUtils.PushVolumeToSlicer(out_l , outputVolume_l)
-            slicer.util.setSliceViewerLayers(background=outputVolume_l)
-            tisseglibrary.ColorSegmentation(outputVolume_l, '_l', Segmentation_l)
-
-            sitkUtils.PushVolumeToSlicer(out_r , outputVolume_r)
-            slicer.util.setSliceViewerLayers(background=outputVolume_r)
-            tisseglibrary.ColorSegmentation(outputVolume_r, '_r', Segmentation_r)
-
-            
-          elif left_full_Q == False and right_full_Q == False:
-            if incomplete == True:
-          
-              if sum_left ==0 and sum_right!=0:
-                slicer.util.infoDisplay("Thighs could not be divided")
-                
-                sitkUtils.PushVolumeToSlicer(out_r, outputVolume_r)
-                slicer.util.setSliceViewerLayers(background=outputVolume_r)
-                tisseglibrary.ColorSegmentation(outputVolume_r, '', Segmentation_r)
-                
-                sitkUtils.PushVolumeToSlicer(out_l , outputVolume_l)
-                slicer.util.setSliceViewerLayers(background=outputVolume_l)
-
-              elif sum_right==0 and sum_left!=0:
-                slicer.util.infoDisplay("Thighs could not be divided")
-                sitkUtils.PushVolumeToSlicer(out_l, outputVolume_l)
-                slicer.util.setSliceViewerLayers(background=outputVolume_l)
-                tisseglibrary.ColorSegmentation(outputVolume_l, '', Segmentation_l)
-
-                sitkUtils.PushVolumeToSlicer(out_r , outputVolume_r)
-                slicer.util.setSliceViewerLayers(background=outputVolume_r)
-              
-              elif sum_right!=0 and sum_left!=0:
-                sitkUtils.PushVolumeToSlicer(out_l, outputVolume_l)
-                slicer.util.setSliceViewerLayers(background=outputVolume_l)
-                tisseglibrary.ColorSegmentation(outputVolume_l, '', Segmentation_l)
-
-                sitkUtils.PushVolumeToSlicer(out_r, outputVolume_r)
-                slicer.util.setSliceViewerLayers(background=outputVolume_r)
-                tisseglibrary.ColorSegmentation(outputVolume_r, '', Segmentation_r)
-
-            else:
-              slicer.app.processEvents()
-              slicer.util.infoDisplay("Incomplete thighs \nTo have them processed check the box")
-            
+        fat_img, water_img, master_img = self.pullThighInputs(inputVolumeW, inputVolumeF, MasterVolume, RangeSlice)
+
+        job = {'region': Pipeline.THIGH, 'fat': fat_img, 'water': water_img, 'master': master_img,
+          'RangeSlice': RangeSlice, 'partitions': numberOfPartitions, 'incomplete': incomplete}
+        try:
+          result = self.segmentImages(job)
+        except ValueError as e:
+          slicer.util.errorDisplay(str(e))
+          return outputVolume_l, Segmentation_l, outputVolume_r, Segmentation_r
+
+        self.storeThighOutputs(result, incomplete, outputVolume_l, Segmentation_l, outputVolume_r, Segmentation_r, job)
       
         return outputVolume_l, Segmentation_l, outputVolume_r, Segmentation_r
+
+  def setLabelmapDisplay(self, outputVolume):
+    """
+    Show the output labelmap with the generic colors table.
+    """
+    outputVolume.CreateDefaultDisplayNodes()
+    displayOutput = outputVolume.GetDisplayNode()
+    displayOutput.SetAndObserveColorNodeID("vtkMRMLColorTableNodeFileGenericColors.txt")
         
   def process(self, inputVolumeW, inputVolumeF , outputVolume_l, Segmentation_l, outputVolume_r, Segmentation_r, numberOfPartitions, MaxSliceRange, MinSliceRange , incomplete , MasterVolume, showResult=True):
     """
@@ -618,13 +1047,8 @@ class Tis_SegLogic(ScriptedLoadableModuleLogic):
 
     RangeSlice = [MinSliceRange, MaxSliceRange+1]
 
-    outputVolume_r.CreateDefaultDisplayNodes()
-    displayOutput_r = outputVolume_r.GetDisplayNode()
-    displayOutput_r.SetAndObserveColorNodeID("vtkMRMLColorTableNodeFileGenericColors.txt")
-
-    outputVolume_l.CreateDefaultDisplayNodes()
-    displayOutput_l = outputVolume_l.GetDisplayNode()
-    displayOutput_l.SetAndObserveColorNodeID("vtkMRMLColorTableNodeFileGenericColors.txt")
+    self.setLabelmapDisplay(outputVolume_r)
+    self.setLabelmapDisplay(outputVolume_l)
 
     self.getsegmentation(inputVolumeW, inputVolumeF, outputVolume_l, Segmentation_l, outputVolume_r, Segmentation_r, RangeSlice, numberOfPartitions, incomplete, MasterVolume)
 
@@ -639,15 +1063,217 @@ class Tis_SegLogic(ScriptedLoadableModuleLogic):
 
     RangeSlice_Abdo = np.array([MinSliceRange_Abdo, MaxSliceRange_Abdo+1]).astype(np.int32)
 
-    OutputVolume_Abdo.CreateDefaultDisplayNodes()
-    displayOutput_Abdo = OutputVolume_Abdo.GetDisplayNode()
-    displayOutput_Abdo.SetAndObserveColorNodeID("vtkMRMLColorTableNodeFileGenericColors.txt")
+    self.setLabelmapDisplay(OutputVolume_Abdo)
 
     self.getsegmentation_Abdo(inputVolumeW_Abdo, inputVolumeF_Abdo,  inputVolumeROI, OutputVolume_Abdo, Segmentation_Abdo, numberOfPartitions_Abdo,  RangeSlice_Abdo)
 
 
     return True
 
+  def loadDixonSeries(self, directory):
+    """
+    Load the water and fat series of the Dixon acquisitions of a DICOM folder tree (see Tis_SegLib.DicomIngest).
+    The headers are indexed in the Slicer cache folder. Returns a list of (water volume node, fat volume node).
+    """
+    from Tis_SegLib import DicomIngest
+
+    indexDirectory = os.path.join(slicer.app.cachePath, 'Tis_Seg', 'DicomIndex')
+    os.makedirs(indexDirectory, exist_ok=True)
+    with self.profiler.run('DICOM ingest'):
+      with self.profiler.stage('Index headers'):
+        acquisitions = DicomIngest.ingest(directory, os.path.join(indexDirectory, DicomIngest.DEFAULT_INDEX_NAME))
+      loaded = []
+      for acquisition in acquisitions:
+        nodes = []
+        for contrast in ('water', 'fat'):
+          with self.profiler.stage('Load ' + contrast):
+            volumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', '{0} {1}'.format(acquisition['id'], contrast))
+            VolumeBridge.updateVolumeFromImage(volumeNode, DicomIngest.loadSeries(acquisition[contrast]))
+            volumeNode.CreateDefaultDisplayNodes()
+            nodes.append(volumeNode)
+        loaded.append(tuple(nodes))
+    return loaded
+
+  def detectSliceRange(self, inputVolumeW, inputVolumeF, numberOfPartitions):
+    """
+    Tightest (minSlice, maxSlice) range, in whole partitions, of the slices that contain tissue, or None if
+    no slice does (see RangeDetection). The voxels are read in place, without copying the volumes.
+    """
+    with self.profiler.run('Range detection'):
+      with self.profiler.stage('Detect range'):
+        water = VolumeBridge.arrayView(inputVolumeW) if inputVolumeW is not None else None
+        return RangeDetection.detectSliceRange(VolumeBridge.arrayView(inputVolumeF), water, numberOfPartitions)
+
+  def preview(self, inputVolumeW, inputVolumeF, outputVolume_l, outputVolume_r, numberOfPartitions, MaxSliceRange, MinSliceRange, incomplete, MasterVolume, factor=Preview.DEFAULT_PREVIEW_FACTOR):
+    """
+    Segment the thighs on images downsampled in-plane by factor (see Preview) and show the labels in the
+    output volumes. The segmentations, cache and quantification are not updated. Returns True if the preview is shown.
+    """
+    RangeSlice = Pipeline.sliceRange(MinSliceRange, MaxSliceRange)
+    if inputVolumeF is None or inputVolumeW is None:
+      slicer.util.errorDisplay('Select the input images')
+      return False
+
+    self.setLabelmapDisplay(outputVolume_r)
+    self.setLabelmapDisplay(outputVolume_l)
+
+    tags = self.profileTags(Pipeline.THIGH, inputVolumeF, RangeSlice, numberOfPartitions, incomplete)
+    tags['previewFactor'] = factor
+    with self.profiler.run('Thigh preview', tags):
+      fat_img, water_img, master_img = self.pullThighInputs(inputVolumeW, inputVolumeF, MasterVolume, RangeSlice)
+      job = {'region': Pipeline.THIGH, 'fat': fat_img, 'water': water_img, 'master': master_img,
+        'RangeSlice': RangeSlice, 'partitions': numberOfPartitions, 'incomplete': incomplete}
+      try:
+        with self.profiler.stage('Segmentation'):
+          result = Preview.segmentPreview(job, factor)
+      except ValueError as e:
+        slicer.util.errorDisplay(str(e))
+        return False
+      self.storeThighOutputs(result, incomplete, outputVolume_l, None, outputVolume_r, None)
+    return True
+
+  def previewAbdo(self, inputVolumeW_Abdo, inputVolumeF_Abdo, inputVolumeROI, OutputVolume_Abdo, numberOfPartitions_Abdo, MaxSliceRange_Abdo, MinSliceRange_Abdo, factor=Preview.DEFAULT_PREVIEW_FACTOR):
+    """
+    Segment the abdomen on images downsampled in-plane by factor (see Preview) and show the labels in the
+    output volume. The segmentation, cache and quantification are not updated. Returns True if the preview is shown.
+    """
+    RangeSlice_Abdo = Pipeline.sliceRange(MinSliceRange_Abdo, MaxSliceRange_Abdo)
+    if inputVolumeF_Abdo is None or inputVolumeW_Abdo is None or inputVolumeROI is None:
+      slicer.util.errorDisplay('Select the input images')
+      return False
+
+    self.setLabelmapDisplay(OutputVolume_Abdo)
+
+    tags = self.profileTags(Pipeline.ABDOMEN, inputVolumeF_Abdo, RangeSlice_Abdo, numberOfPartitions_Abdo)
+    tags['previewFactor'] = factor
+    with self.profiler.run('Abdomen preview', tags):
+      fat_img, water_img, roi_img = self.pullAbdomenInputs(inputVolumeW_Abdo, inputVolumeF_Abdo, inputVolumeROI, RangeSlice_Abdo)
+      job = {'region': Pipeline.ABDOMEN, 'fat': fat_img, 'water': water_img, 'roi': roi_img,
+        'RangeSlice': RangeSlice_Abdo, 'partitions': numberOfPartitions_Abdo}
+      try:
+        with self.profiler.stage('Segmentation'):
+          result = Preview.segmentPreview(job, factor)
+      except ValueError as e:
+        slicer.util.errorDisplay(str(e))
+        return False
+      self.storeAbdomenOutputs(result, OutputVolume_Abdo, None)
+    return True
+
+  def backgroundQueue(self):
+    """
+    Queue of the segmentations that run in a background process (created on first use).
+    """
+    if self._backgroundQueue is None:
+      from Tis_SegLib import BackgroundProcessing
+      self._backgroundQueue = BackgroundProcessing.BackgroundQueue()
+    return self._backgroundQueue
+
+  def stopBackgroundProcessing(self):
+    """
+    Cancel the background segmentations and stop the background process.
+    """
+    if self._backgroundQueue is not None:
+      self._backgroundQueue.shutdown()
+      self._backgroundQueue = None
+
+  def processInBackground(self, inputVolumeW, inputVolumeF , outputVolume_l, Segmentation_l, outputVolume_r, Segmentation_r, numberOfPartitions, MaxSliceRange, MinSliceRange , incomplete , MasterVolume, onProgress=None):
+    """
+    Same as process, but the segmentation runs in a background process and the outputs are
+    stored when it finishes. The inputs are read immediately, so they can be changed afterwards.
+    Returns the queued BackgroundTask, or None if the inputs are not valid or the result was in the cache.
+    """
+    from Tis_SegLib import BackgroundProcessing
+
+    RangeSlice = Pipeline.sliceRange(MinSliceRange, MaxSliceRange)
+    if inputVolumeF is None or inputVolumeW is None:
+      slicer.util.errorDisplay('Select the input images')
+      return None
+    try:
+      Pipeline.checkPartitions(RangeSlice, numberOfPartitions)
+    except ValueError as e:
+      slicer.util.errorDisplay(str(e))
+      return None
+
+    self.setLabelmapDisplay(outputVolume_r)
+    self.setLabelmapDisplay(outputVolume_l)
+
+    fat_img, water_img, master_img = self.pullThighInputs(inputVolumeW, inputVolumeF, MasterVolume, RangeSlice)
+    job = {'region': Pipeline.THIGH, 'fat': fat_img, 'water': water_img, 'master': master_img,
+      'RangeSlice': RangeSlice, 'partitions': numberOfPartitions, 'incomplete': incomplete}
+
+    key, result = self.cachedResult(job)
+    if result is not None:
+      self.storeThighOutputs(result, incomplete, outputVolume_l, Segmentation_l, outputVolume_r, Segmentation_r, job)
+      return None
+
+    # The closure must not keep the input images alive while the task waits and runs
+    jobDescription = {name: value for name, value in job.items() if name not in ('fat', 'water', 'master')}
+
+    def onFinished(result):
+      self.cacheResult(key, result)
+      self.storeThighOutputs(result, incomplete, outputVolume_l, Segmentation_l, outputVolume_r, Segmentation_r, jobDescription)
+
+    task = BackgroundProcessing.BackgroundTask(job, onFinished, onError=slicer.util.errorDisplay, onProgress=onProgress,
+      name='Thigh ' + inputVolumeF.GetName(), quantify=self.quantifyTissues)
+    return self.backgroundQueue().add(task)
+
+  def processAbdoInBackground(self, inputVolumeW_Abdo, inputVolumeF_Abdo, inputVolumeROI, OutputVolume_Abdo, Segmentation_Abdo, numberOfPartitions_Abdo, MaxSliceRange_Abdo, MinSliceRange_Abdo, onProgress=None):
+    """
+    Same as processAbdo, but the segmentation runs in a background process and the output is
+    stored when it finishes. Returns the queued BackgroundTask, or None if the inputs are not valid or the result was in the cache.
+    """
+    from Tis_SegLib import BackgroundProcessing
+
+    RangeSlice_Abdo = Pipeline.sliceRange(MinSliceRange_Abdo, MaxSliceRange_Abdo)
+    if inputVolumeF_Abdo is None or inputVolumeW_Abdo is None or inputVolumeROI is None:
+      slicer.util.errorDisplay('Select the input images')
+      return None
+    try:
+      Pipeline.checkPartitions(RangeSlice_Abdo, numberOfPartitions_Abdo)
+    except ValueError as e:
+      slicer.util.errorDisplay(str(e))
+      return None
+
+    self.setLabelmapDisplay(OutputVolume_Abdo)
+
+    fat_img, water_img, roi_img = self.pullAbdomenInputs(inputVolumeW_Abdo, inputVolumeF_Abdo, inputVolumeROI, RangeSlice_Abdo)
+    job = {'region': Pipeline.ABDOMEN, 'fat': fat_img, 'water': water_img, 'roi': roi_img,
+      'RangeSlice': RangeSlice_Abdo, 'partitions': numberOfPartitions_Abdo}
+
+    key, result = self.cachedResult(job)
+    if result is not None:
+      self.storeAbdomenOutputs(result, OutputVolume_Abdo, Segmentation_Abdo, job)
+      return None
+
+    # The closure must not keep the input images alive while the task waits and runs
+    jobDescription = {name: value for name, value in job.items() if name not in ('fat', 'water', 'roi')}
+
+    def onFinished(result):
+      self.cacheResult(key, result)
+      self.storeAbdomenOutputs(result, OutputVolume_Abdo, Segmentation_Abdo, jobDescription)
+
+    task = BackgroundProcessing.BackgroundTask(job, onFinished, onError=slicer.util.errorDisplay, onProgress=onProgress,
+      name='Abdomen ' + inputVolumeF_Abdo.GetName(), quantify=self.quantifyTissues)
+    return self.backgroundQueue().add(task)
+
+  def processManifest(self, manifestPath, outputDirectory, writeSegmentations=True, retryFailed=False):
+    """
+    Segment all the studies listed in a manifest without using the scene for the computation
+    and write the labelmaps (and segmentations) to outputDirectory.
+    The studies done by a previous call with the same output folder are not segmented again (see Tis_SegLib.JobQueue).
+    Returns the list of records of the studies (see Tis_SegLib.BatchProcessing).
+    """
+    from Tis_SegLib import BatchProcessing
+    from Tis_SegLib import JobQueue
+
+    studies = BatchProcessing.readManifest(manifestPath)
+    if not os.path.isdir(outputDirectory):
+      os.makedirs(outputDirectory)
+    with JobQueue.JobQueue(os.path.join(outputDirectory, JobQueue.DEFAULT_QUEUE_NAME)) as queue:
+      return list(BatchProcessing.processQueue(queue, studies,
+        lambda pending: BatchProcessing.processManifest(pending, outputDirectory, writeSegmentations),
+        {'segmentations': writeSegmentations}, retryFailed))
+
 #
 # Tis_SegTest
 #
@@ -669,6 +1295,8 @@ class Tis_SegTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_Tis_Seg1()
+    self.setUp()
+    self.test_Tis_SegPhantoms()
 
   def test_Tis_Seg1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -684,3 +1312,48 @@ class Tis_SegTest(ScriptedLoadableModuleTest):
 
     self.delayDisplay("Starting the test", 10000)
     self.delayDisplay('Test passed', 10000)
+
+  def assertVolume(self, labels, tissues, expected, tolerance, name):
+    voxels = sum(labels.get(label, 0) for label in tissues)
+    self.assertLess(abs(voxels - expected), tolerance * expected,
+      '{0}: {1} voxels, {2:.0f} expected'.format(name, voxels, expected))
+
+  def test_Tis_SegPhantoms(self):
+    """ Segment small synthetic thigh and abdomen phantoms (see Tis_SegLib.Benchmark), check that every
+    stage of the logic ran and that the tissues have roughly the volumes painted in the phantoms.
+    """
+    import numpy as np
+    from Tis_SegLib import Benchmark
+
+    self.delayDisplay("Segmenting the phantoms")
+    size = Benchmark.SIZES['small']
+    minSlice, maxSlice = Benchmark.caseRange(size, 0.5)
+    slices = np.arange(minSlice, maxSlice + 1)
+    logic = Tis_SegLogic()
+
+    case = Benchmark.runCase(logic, Pipeline.THIGH, size, rangeFraction=0.5)
+    self.assertIn('Segmentation', case['stages'])
+    self.assertGreater(case['seconds'], 0)
+    self.assertEqual(sorted(case['labels']), ['l', 'r'])
+    # Area (voxels) of the disk of each thigh in each slice of the range (see Benchmark.thighPhantom)
+    disk = np.pi * (0.18 * size[0] * (1.0 - 0.2 * slices / (size[2] - 1))) ** 2
+    for side, labels in case['labels'].items():
+      self.assertTrue(set(labels) <= set(SegmentationImport.THIGH_SEGMENTS), labels)
+      self.assertVolume(labels, [6], (1 - 0.95 ** 2) * disk.sum(), 0.2, side + ' skin')
+      self.assertVolume(labels, [15], (0.95 ** 2 - 0.75 ** 2) * disk.sum(), 0.2, side + ' SAT')
+      self.assertVolume(labels, [5, 8, 11, 31], (0.75 ** 2 - 0.2 ** 2) * disk.sum(), 0.2, side + ' muscle')
+      self.assertVolume(labels, [2, 7], 0.2 ** 2 * disk.sum(), 0.35, side + ' bone and marrow')
+    self.assertEqual(slicer.mrmlScene.GetNodesByName('BenchmarkFat').GetNumberOfItems(), 0)
+
+    case = Benchmark.runCase(logic, Pipeline.ABDOMEN, size, rangeFraction=0.5)
+    self.assertIn('Segmentation', case['stages'])
+    labels = case['labels']['Abdo']
+    self.assertTrue(set(labels) <= set(SegmentationImport.ABDOMEN_SEGMENTS), labels)
+    self.assertGreater(labels.get(11, 0), 0)
+    # Area (voxels) of the ellipse of the abdomen in each slice of the range (see Benchmark.abdomenPhantom)
+    scale = 1.0 - 0.1 * slices / (size[2] - 1)
+    ellipse = np.pi * (0.42 * size[0] * scale) * (0.32 * size[1] * scale)
+    self.assertVolume(labels, [15], (0.97 ** 2 - 0.8 ** 2) * ellipse.sum(), 0.2, 'SAT')
+    self.assertVolume(labels, [2, 5, 7, 8, 11, 31], 0.8 ** 2 * ellipse.sum(), 0.2, 'inside the muscle wall')
+    self.assertEqual(slicer.mrmlScene.GetNodesByName('BenchmarkFat').GetNumberOfItems(), 0)
+    self.delayDisplay('Test passed')
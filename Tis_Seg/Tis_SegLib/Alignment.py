@@ -0,0 +1,106 @@
+"""
+Alignment of the fat and water images on the voxel grid of a master volume.
+
+When an input only differs from the master in its header (same size, and spacing, origin and
+directions within a fraction of a voxel), the master geometry is copied to it, as tisseglibrary
+expects. Otherwise the input is resampled on the master grid with the multithreaded SimpleITK resampler.
+The resampled volumes are kept in an AlignmentCache, keyed by node and modification time, so that
+runs on other slice ranges or with other parameters reuse them.
+"""
+import collections
+import os
+
+from Tis_SegLib import VolumeGeometry
+
+# Largest difference (fraction of a voxel) between two grids that are considered the same
+GRID_TOLERANCE = 0.1
+
+
+def imageGeometry(image):
+  """
+  Geometry of a SimpleITK image or Pipeline.SlabImage (the whole volume).
+  """
+  return VolumeGeometry.Geometry(tuple(image.GetSize()), tuple(image.GetSpacing()), tuple(image.GetOrigin()), tuple(image.GetDirection()))
+
+
+def sameVoxelGrid(geometry, masterGeometry, tolerance=GRID_TOLERANCE):
+  """
+  True if two geometries (see VolumeGeometry.Geometry) describe the same voxels, up to tolerance voxels.
+  """
+  import numpy as np
+
+  if tuple(geometry.size) != tuple(masterGeometry.size):
+    return False
+  spacing = np.array(masterGeometry.spacing, float)
+  if not np.allclose(geometry.spacing, spacing, rtol=tolerance / max(geometry.size), atol=0):
+    return False
+  if not np.allclose(geometry.direction, masterGeometry.direction, atol=tolerance / max(geometry.size)):
+    return False
+  # Origin difference along the master axes, in voxels
+  direction = np.array(masterGeometry.direction, float).reshape(3, 3)
+  shift = direction.T @ (np.array(geometry.origin, float) - np.array(masterGeometry.origin, float)) / spacing
+  return bool(np.all(np.abs(shift) <= tolerance))
+
+
+def resampleToGeometry(image, geometry, numberOfThreads=None):
+  """
+  Resample an image (linear interpolation, 0 outside) on the grid of a geometry, with numberOfThreads threads
+  (all the cores by default).
+  """
+  import SimpleITK as sitk
+
+  resampler = sitk.ResampleImageFilter()
+  resampler.SetSize([int(value) for value in geometry.size])
+  resampler.SetOutputSpacing(geometry.spacing)
+  resampler.SetOutputOrigin(geometry.origin)
+  resampler.SetOutputDirection(geometry.direction)
+  resampler.SetInterpolator(sitk.sitkLinear)
+  resampler.SetDefaultPixelValue(0)
+  resampler.SetOutputPixelType(image.GetPixelID())
+  resampler.SetNumberOfThreads(numberOfThreads or os.cpu_count() or 1)
+  return resampler.Execute(image)
+
+
+def modifiedTime(volumeNode):
+  """
+  Modification time of a volume node and its voxels.
+  """
+  imageData = volumeNode.GetImageData()
+  return max(volumeNode.GetMTime(), imageData.GetMTime() if imageData is not None else 0)
+
+
+class AlignmentCache:
+  """
+  Volumes resampled on the grid of a master volume, for the most recently used (volume, master) pairs.
+  An entry is used as long as neither node nor their voxels were modified since it was computed.
+  """
+
+  def __init__(self, maximumNumberOfVolumes=4):
+    self.maximumNumberOfVolumes = maximumNumberOfVolumes
+    self._entries = collections.OrderedDict()
+
+  def _key(self, volumeNode, masterVolumeNode):
+    return (volumeNode.GetID(), modifiedTime(volumeNode), masterVolumeNode.GetID(), modifiedTime(masterVolumeNode))
+
+  def alignedImage(self, volumeNode, masterVolumeNode, readImage):
+    """
+    SimpleITK image of volumeNode resampled on the grid of masterVolumeNode.
+    readImage(volumeNode) returns the whole image of a node, it is only called when the cached image is not valid.
+    """
+    key = self._key(volumeNode, masterVolumeNode)
+    image = self._entries.get(key)
+    if image is not None:
+      self._entries.move_to_end(key)
+      return image
+
+    image = resampleToGeometry(readImage(volumeNode), VolumeGeometry.volumeGeometry(masterVolumeNode))
+    # Older versions of the same pair are not valid anymore
+    for oldKey in [oldKey for oldKey in self._entries if oldKey[0] == key[0] and oldKey[2] == key[2]]:
+      del self._entries[oldKey]
+    self._entries[key] = image
+    while len(self._entries) > self.maximumNumberOfVolumes:
+      self._entries.popitem(last=False)
+    return image
+
+  def clear(self):
+    self._entries.clear()
@@ -0,0 +1,246 @@
+"""
+Segmentation in a background process, so that the Slicer GUI stays responsive while it computes.
+
+The input volumes are pulled from the scene on the main thread and handed to a worker process in
+shared memory. The worker is kept alive between tasks, so the segmentation library is only imported once.
+The results are delivered back on the main thread, where they can be pushed to the scene.
+BackgroundQueue uses a qt.QTimer to poll the worker, so it must be used from the Slicer application.
+"""
+import collections
+import time
+import traceback
+
+from Tis_SegLib import ParallelProcessing
+from Tis_SegLib import Scheduling
+
+
+def _workerLoop(connection, threadsPerWorker):
+  ParallelProcessing._initializeWorker(threadsPerWorker)
+  while True:
+    job = connection.recv()
+    if job is None:
+      break
+    try:
+      result = ParallelProcessing._segmentImages(job, lambda stage: connection.send(('progress', stage)))
+      connection.send(('done', result))
+    except Exception as e:
+      connection.send(('error', '{0}: {1}\n{2}'.format(type(e).__name__, e, traceback.format_exc())))
+
+
+class BackgroundWorker:
+  """
+  Worker process that runs segmentation jobs (see ParallelProcessing.ParallelRunner.segmentImages) one at a time.
+  """
+
+  def __init__(self, threadsPerWorker=None):
+    self.threadsPerWorker = threadsPerWorker or Scheduling.physicalCores()
+    self._process = None
+    self._connection = None
+
+  def isAlive(self):
+    return self._process is not None and self._process.is_alive()
+
+  def start(self):
+    if self.isAlive():
+      return
+    context = ParallelProcessing.multiprocessingContext()
+    self._connection, workerConnection = context.Pipe()
+    self._process = context.Process(target=_workerLoop, args=(workerConnection, self.threadsPerWorker), daemon=True)
+    self._process.start()
+    workerConnection.close()
+
+  def submit(self, workerJob):
+    self.start()
+    self._connection.send(workerJob)
+
+  def poll(self):
+    """
+    Return the messages sent by the worker since the last call, without blocking.
+    """
+    messages = []
+    try:
+      while self._connection is not None and self._connection.poll():
+        messages.append(self._connection.recv())
+    except EOFError:
+      messages.append(('error', 'The background process stopped unexpectedly'))
+      self.terminate()
+    return messages
+
+  def terminate(self):
+    if self._process is not None:
+      self._process.terminate()
+      self._process.join()
+    if self._connection is not None:
+      self._connection.close()
+    self._process = None
+    self._connection = None
+
+  def stop(self):
+    """
+    Ask the worker to finish and wait for it.
+    """
+    if self.isAlive():
+      self._connection.send(None)
+      self._process.join()
+    self.terminate()
+
+
+class BackgroundTask:
+  """
+  Segmentation job queued in a BackgroundQueue.
+  job has the keys described in ParallelRunner.segmentImages. onFinished(result) is called on the main thread
+  with the result of Pipeline.segmentThigh/segmentAbdomen, onError(message) if the segmentation failed and
+  onProgress(task) whenever the status (the stage that runs) or the elapsed time changes.
+  If quantify is True, the worker also quantifies the outputs (see ParallelProcessing._segmentImages).
+  The images of the job are released as soon as the worker has finished with them.
+  """
+
+  STORING = 'Storing the outputs'
+
+  QUEUED = 'Queued'
+  RUNNING = 'Running'
+  DONE = 'Done'
+  FAILED = 'Failed'
+  CANCELLED = 'Cancelled'
+
+  def __init__(self, job, onFinished, onError=None, onProgress=None, name='', quantify=False):
+    self.job = job
+    self.quantify = quantify
+    self.onFinished = onFinished
+    self.onError = onError
+    self.onProgress = onProgress
+    self.name = name
+    self.state = BackgroundTask.QUEUED
+    self.status = BackgroundTask.QUEUED
+    self.startTime = None
+    self._inputHandles = {}
+
+  def elapsedTime(self):
+    return time.time() - self.startTime if self.startTime is not None else 0.0
+
+  def _workerJob(self):
+    workerJob, self._inputHandles = ParallelProcessing.shareJob(self.job)
+    workerJob['quantify'] = self.quantify
+    return workerJob
+
+  def _releaseInputs(self):
+    for handle in self._inputHandles.values():
+      handle.release()
+    self._inputHandles = {}
+    # The images are not needed anymore, do not keep them alive
+    self.job = {key: value for key, value in self.job.items() if not hasattr(value, 'GetPixelID')}
+
+
+class BackgroundQueue:
+  """
+  Run BackgroundTasks one after the other in a BackgroundWorker. Must be used from the main thread.
+  """
+
+  def __init__(self, pollInterval=200):
+    import qt
+    self.worker = BackgroundWorker()
+    self.tasks = collections.deque()
+    self.currentTask = None
+    self.timer = qt.QTimer()
+    self.timer.setInterval(pollInterval)
+    self.timer.connect('timeout()', self._poll)
+
+  def add(self, task):
+    self.tasks.append(task)
+    self._notify(task)
+    self._startNext()
+    return task
+
+  def numberOfPendingTasks(self):
+    return len(self.tasks) + (1 if self.currentTask is not None else 0)
+
+  def cancel(self, task=None):
+    """
+    Cancel a task (the running one by default). Cancelling the running task stops the worker process.
+    """
+    task = task or self.currentTask
+    if task is None:
+      return
+    if task is self.currentTask:
+      self.worker.terminate()
+      self.currentTask = None
+    elif task in self.tasks:
+      self.tasks.remove(task)
+    task._releaseInputs()
+    task.state = task.status = BackgroundTask.CANCELLED
+    self._notify(task)
+    self._startNext()
+
+  def cancelAll(self):
+    while self.tasks:
+      task = self.tasks.pop()
+      task._releaseInputs()
+      task.state = task.status = BackgroundTask.CANCELLED
+      self._notify(task)
+    self.cancel()
+
+  def shutdown(self):
+    self.cancelAll()
+    self.timer.stop()
+    self.worker.stop()
+
+  def _notify(self, task):
+    if task.onProgress:
+      task.onProgress(task)
+
+  def _startNext(self):
+    if self.currentTask is not None:
+      return
+    if not self.tasks:
+      self.timer.stop()
+      return
+    task = self.tasks.popleft()
+    self.currentTask = task
+    task.state = task.status = BackgroundTask.RUNNING
+    task.startTime = time.time()
+    try:
+      self.worker.submit(task._workerJob())
+    except Exception as e:
+      self._finish(task, error=str(e))
+      return
+    self._notify(task)
+    self.timer.start()
+
+  def _finish(self, task, result=None, error=None):
+    task._releaseInputs()
+    self.currentTask = None
+    try:
+      if error is None:
+        task.status = BackgroundTask.STORING
+        self._notify(task)
+        task.onFinished(result)
+        task.state = task.status = BackgroundTask.DONE
+      else:
+        task.state = task.status = BackgroundTask.FAILED
+        if task.onError:
+          task.onError(error)
+    except Exception:
+      task.state = task.status = BackgroundTask.FAILED
+      raise
+    finally:
+      self._notify(task)
+      self._startNext()
+
+  def _poll(self):
+    task = self.currentTask
+    if task is None:
+      self.timer.stop()
+      return
+    for kind, content in self.worker.poll():
+      if kind == 'progress':
+        task.status = content
+      elif kind == 'done':
+        self._finish(task, result=ParallelProcessing.unshareResult(content))
+        return
+      elif kind == 'error':
+        self._finish(task, error=content)
+        return
+    if not self.worker.isAlive():
+      self._finish(task, error='The background process stopped unexpectedly')
+      return
+    self._notify(task)
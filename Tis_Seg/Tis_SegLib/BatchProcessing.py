@@ -0,0 +1,498 @@
+"""
+Headless batch processing of cohorts of thigh and abdomen studies.
+
+The studies are listed in a manifest (CSV with a header row, or a JSON list of objects) with the fields
+in MANIFEST_FIELDS. Every study is segmented without using the GUI and its labelmaps (and optionally
+its segmentations) are written to the output directory as soon as it finishes.
+
+Run it from the command line with:
+
+  Slicer --no-main-window --python-script Tis_SegLib/BatchProcessing.py --manifest studies.csv --output-dir results
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import time
+
+if __name__ == "__main__":
+  # Make Tis_SegLib importable when this file is run with --python-script
+  sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Tis_SegLib import JobQueue
+from Tis_SegLib import Pipeline
+from Tis_SegLib import Scheduling
+
+MANIFEST_FIELDS = ['id', 'region', 'water', 'fat', 'roi', 'master', 'minSlice', 'maxSlice', 'partitions', 'incomplete', 'autoRange']
+
+DEFAULT_PARAMETERS = {
+  'partitions': 10,
+  'minSlice': 20,
+  'maxSlice': 60,
+  'incomplete': False,
+  'autoRange': False,
+  }
+
+SUMMARY_FIELDS = ['id', 'region', 'minSlice', 'maxSlice', 'status', 'seconds', 'message', 'error', 'outputs']
+
+# How the labelmaps are written: file format ('nrrd' or 'nii.gz'), compression level (0 to 9, 0 writes
+# them uncompressed and -1 uses the default level) and whether both thighs go to one labelmap (see Pipeline.combineThighs)
+OUTPUT_FORMATS = ['nrrd', 'nii.gz']
+DEFAULT_LABELMAP_OPTIONS = {
+  'format': 'nrrd',
+  'compressionLevel': -1,
+  'combineThighs': False,
+  # Cohort store (see CohortStore) where the labelmaps and tissue volumes are also written, if set
+  'store': None,
+  }
+
+
+def _parseBool(value):
+  if isinstance(value, bool):
+    return value
+  return str(value).strip().lower() in ('1', 'true', 'yes', 'y', 'on')
+
+
+def normalizeStudy(study, baseDirectory='', defaults=None):
+  """
+  Fill in the defaults of a manifest entry, resolve its paths relative to baseDirectory
+  and convert the parameters to their types. Raise ValueError if the entry is not valid.
+  """
+  parameters = dict(DEFAULT_PARAMETERS)
+  if defaults:
+    parameters.update(defaults)
+
+  def path(field):
+    value = str(study.get(field) or '').strip()
+    if not value:
+      return None
+    return os.path.join(baseDirectory, os.path.expanduser(value))
+
+  normalized = {
+    'region': str(study.get('region') or Pipeline.THIGH).strip().lower(),
+    'water': path('water'),
+    'fat': path('fat'),
+    'roi': path('roi'),
+    'master': path('master'),
+    }
+  for field in ('minSlice', 'maxSlice', 'partitions'):
+    value = study.get(field)
+    normalized[field] = int(float(value)) if value not in (None, '') else int(parameters[field])
+  for field in ('incomplete', 'autoRange'):
+    value = study.get(field)
+    normalized[field] = _parseBool(value) if value not in (None, '') else _parseBool(parameters[field])
+
+  if normalized['region'] not in (Pipeline.THIGH, Pipeline.ABDOMEN):
+    raise ValueError("Unknown region '{0}', expected '{1}' or '{2}'".format(normalized['region'], Pipeline.THIGH, Pipeline.ABDOMEN))
+  if normalized['water'] is None or normalized['fat'] is None:
+    raise ValueError('Water and fat images are required')
+  if normalized['region'] == Pipeline.ABDOMEN and normalized['roi'] is None:
+    raise ValueError('The abdomen segmentation requires a ROI image')
+
+  studyId = str(study['id']).strip() if study.get('id') is not None else ''
+  if not studyId:
+    studyId = os.path.basename(normalized['water']).split('.')[0]
+  # The id is the start of the name of every output file
+  if studyId == '.' or '..' in studyId or os.path.basename(studyId) != studyId:
+    raise ValueError("The study id '{0}' must not contain folders".format(studyId))
+  normalized['id'] = studyId
+  return normalized
+
+
+def readManifest(manifestPath, defaults=None):
+  """
+  Read a CSV or JSON manifest and return the list of normalized studies.
+  Relative paths are resolved from the folder of the manifest.
+  """
+  baseDirectory = os.path.dirname(os.path.abspath(manifestPath))
+  with open(manifestPath, newline='') as manifestFile:
+    if manifestPath.lower().endswith('.json'):
+      entries = json.load(manifestFile)
+    else:
+      entries = list(csv.DictReader(manifestFile))
+
+  studies = []
+  for index, entry in enumerate(entries):
+    try:
+      studies.append(normalizeStudy(entry, baseDirectory, defaults))
+    except ValueError as e:
+      raise ValueError('Manifest entry {0}: {1}'.format(index + 1, e))
+  return studies
+
+
+def readImageSlab(path, RangeSlice):
+  """
+  Read only the slices of an image file that are needed to segment RangeSlice.
+  Returns a Pipeline.SlabImage.
+  """
+  import SimpleITK as sitk
+
+  reader = sitk.ImageFileReader()
+  reader.SetFileName(path)
+  reader.ReadImageInformation()
+  size = reader.GetSize()
+  first, last = Pipeline.slabRange(RangeSlice, size[2])
+  reader.SetExtractIndex([0, 0, first])
+  reader.SetExtractSize([size[0], size[1], last - first])
+  return Pipeline.SlabImage(reader.Execute(), first, size)
+
+
+def readGeometry(path):
+  """
+  Geometry of an image file (see VolumeGeometry.Geometry), without reading its voxels.
+  """
+  import SimpleITK as sitk
+  from Tis_SegLib import VolumeGeometry
+
+  reader = sitk.ImageFileReader()
+  reader.SetFileName(path)
+  reader.ReadImageInformation()
+  return VolumeGeometry.Geometry(tuple(reader.GetSize()), tuple(reader.GetSpacing()), tuple(reader.GetOrigin()), tuple(reader.GetDirection()))
+
+
+def readAlignedSlab(path, RangeSlice, masterGeometry=None):
+  """
+  Same as readImageSlab, but if the image is not on the voxel grid of masterGeometry it is read whole
+  and resampled on that grid (see Alignment).
+  """
+  import SimpleITK as sitk
+  from Tis_SegLib import Alignment
+
+  if masterGeometry is None or Alignment.sameVoxelGrid(readGeometry(path), masterGeometry):
+    return readImageSlab(path, RangeSlice)
+  return Pipeline.slabFromImage(Alignment.resampleToGeometry(sitk.ReadImage(path), masterGeometry), RangeSlice)
+
+
+def readStudyArray(path, masterGeometry=None):
+  """
+  NumPy array (K, J, I) of an image file on the voxel grid of masterGeometry. Uncompressed NRRD files
+  on that grid are mapped in memory instead of being read (see StreamProcessing.mapNrrd).
+  """
+  import SimpleITK as sitk
+  from Tis_SegLib import Alignment
+  from Tis_SegLib import StreamProcessing
+
+  if masterGeometry is not None and not Alignment.sameVoxelGrid(readGeometry(path), masterGeometry):
+    return sitk.GetArrayFromImage(Alignment.resampleToGeometry(sitk.ReadImage(path), masterGeometry))
+  mapped = StreamProcessing.mapNrrd(path)
+  if mapped is not None:
+    return mapped[0]
+  return sitk.GetArrayFromImage(sitk.ReadImage(path))
+
+
+def detectStudyRange(study):
+  """
+  Copy of a study whose minSlice and maxSlice are the slices that contain tissue, in whole partitions
+  (see RangeDetection). Raise ValueError if no slice contains tissue.
+  """
+  from Tis_SegLib import RangeDetection
+
+  masterGeometry = readGeometry(study['master']) if study['region'] == Pipeline.THIGH and study.get('master') else None
+  fat = readStudyArray(study['fat'], masterGeometry)
+  water = readStudyArray(study['water'], masterGeometry)
+  sliceRange = RangeDetection.detectSliceRange(fat, water, study['partitions'])
+  if sliceRange is None:
+    raise ValueError('No tissue was found in ' + study['fat'])
+  detected = dict(study)
+  detected['minSlice'], detected['maxSlice'] = sliceRange
+  return detected
+
+
+def readRoi(roiPath, reference_img):
+  """
+  Read the ROI labelmap on the voxel grid of the fat image (a SlabImage).
+  """
+  import SimpleITK as sitk
+
+  reader = sitk.ImageFileReader()
+  reader.SetFileName(roiPath)
+  reader.ReadImageInformation()
+  if reader.GetSize() == reference_img.GetSize() and \
+          reader.GetSpacing() == reference_img.GetSpacing() and \
+          reader.GetDirection() == reference_img.GetDirection() and \
+          reader.GetOrigin() == reference_img.GetOrigin():
+    return readImageSlab(roiPath, [reference_img.first, reference_img.last])
+
+  roi_img = sitk.ReadImage(roiPath)
+  roi_slab = sitk.Resample(roi_img, reference_img.slab, sitk.Transform(), sitk.sitkNearestNeighbor, 0, roi_img.GetPixelID())
+  return Pipeline.SlabImage(roi_slab, reference_img.first, reference_img.GetSize())
+
+
+def labelmapOptions(options=None):
+  """
+  Labelmap options with the missing ones set to their default value.
+  """
+  labelmapOptions = dict(DEFAULT_LABELMAP_OPTIONS)
+  labelmapOptions.update(options or {})
+  if labelmapOptions['format'] not in OUTPUT_FORMATS:
+    raise ValueError('Unknown labelmap format {0}, expected one of {1}'.format(labelmapOptions['format'], ', '.join(OUTPUT_FORMATS)))
+  return labelmapOptions
+
+
+def labelmapPath(outputDirectory, studyId, name, options=None):
+  return os.path.join(outputDirectory, '{0}_{1}.{2}'.format(studyId, name, labelmapOptions(options)['format']))
+
+
+def writeLabelmap(label_img, path, compressionLevel=DEFAULT_LABELMAP_OPTIONS['compressionLevel']):
+  """
+  Write a labelmap, compressed unless compressionLevel is 0. The file is renamed to path when complete.
+  """
+  import SimpleITK as sitk
+
+  with JobQueue.atomicPath(path) as partialPath:
+    sitk.WriteImage(label_img, partialPath, compressionLevel != 0, compressionLevel)
+
+
+def readStudyLabelmap(record, name):
+  """
+  Read an output labelmap of a processed study. The thighs are split from the combined labelmap if they were written in one.
+  """
+  import SimpleITK as sitk
+
+  if name not in record['outputs'] and 'thighs' in record['outputs']:
+    return Pipeline.splitThighs(sitk.ReadImage(record['outputs']['thighs']), name)
+  return sitk.ReadImage(record['outputs'][name])
+
+
+def writeSegmentation(label_img, region, suffix, segmentationPath):
+  """
+  Convert a labelmap to a segmentation with the colors and names used by the module and save it.
+  Requires the Slicer application (it can run without main window).
+  """
+  import slicer
+  from Tis_SegLib import SegmentationImport
+  from Tis_SegLib import VolumeBridge
+
+  labelmapNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+  VolumeBridge.updateVolumeFromImage(labelmapNode, label_img)
+  segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode')
+  try:
+    # The file only stores the labelmaps, the 3D surfaces are not needed
+    if not SegmentationImport.importLabelmap(labelmapNode, segmentationNode, region, suffix, closedSurfaces=False):
+      raise ValueError(SegmentationImport.SEGMENTATION_ERROR)
+    with JobQueue.atomicPath(segmentationPath) as partialPath:
+      if not slicer.util.saveNode(segmentationNode, partialPath):
+        raise IOError('Failed to write ' + segmentationPath)
+  finally:
+    slicer.mrmlScene.RemoveNode(segmentationNode)
+    slicer.mrmlScene.RemoveNode(labelmapNode)
+
+
+def writeStudySegmentations(record, outputDirectory, label_imgs=None):
+  """
+  Write the segmentations of a processed study. The labelmaps are taken from label_imgs
+  (dictionary indexed by output name) or read from the files listed in the record.
+  """
+  for name, suffix in record['segmentSuffixes'].items():
+    if label_imgs is not None and name in label_imgs:
+      label_img = label_imgs[name]
+    else:
+      label_img = readStudyLabelmap(record, name)
+    segmentationPath = os.path.join(outputDirectory, '{0}_{1}.seg.nrrd'.format(record['id'], name))
+    writeSegmentation(label_img, record['region'], suffix, segmentationPath)
+    record['outputs'][name + '_seg'] = segmentationPath
+
+
+def writeQuantification(record, rows, outputDirectory):
+  """
+  Write the quantification rows of a study (see Quantification) next to its labelmaps.
+  """
+  from Tis_SegLib import Quantification
+
+  quantificationPath = os.path.join(outputDirectory, '{0}_quantification.csv'.format(record['id']))
+  with JobQueue.atomicPath(quantificationPath) as partialPath:
+    Quantification.writeCsv(rows, partialPath)
+  record['outputs']['quantification'] = quantificationPath
+
+
+def processStudy(study, outputDirectory, writeSegmentations=False, quantify=False, options=None):
+  """
+  Segment one normalized study and write its outputs to outputDirectory, as set by the labelmap options.
+  If quantify is True, the volume and fat fraction of the tissues are also written (see Quantification).
+  With the store option, the labelmaps and tissue volumes are also written to a cohort store (see CohortStore).
+  If the study has autoRange set, its slice range is detected first (see detectStudyRange).
+  Errors are not raised, they are reported in the returned record.
+  """
+  options = labelmapOptions(options)
+  startTime = time.time()
+  record = {'id': study['id'], 'region': study['region'], 'minSlice': study['minSlice'], 'maxSlice': study['maxSlice'],
+    'status': 'done', 'message': None, 'error': None, 'outputs': {}, 'segmentSuffixes': {}}
+  label_imgs = {}
+
+  def writeOutput(label_img, name, suffix):
+    label_imgs[name] = label_img
+    if suffix is not None:
+      record['segmentSuffixes'][name] = suffix
+    if options['combineThighs'] and name in ('l', 'r'):
+      return
+    outputPath = labelmapPath(outputDirectory, study['id'], name, options)
+    writeLabelmap(label_img, outputPath, options['compressionLevel'])
+    record['outputs'][name] = outputPath
+
+  try:
+    if study.get('autoRange'):
+      study = detectStudyRange(study)
+      record['minSlice'], record['maxSlice'] = study['minSlice'], study['maxSlice']
+    RangeSlice = Pipeline.sliceRange(study['minSlice'], study['maxSlice'])
+    masterGeometry = readGeometry(study['master']) if study['region'] == Pipeline.THIGH and study['master'] else None
+    fat_img = readAlignedSlab(study['fat'], RangeSlice, masterGeometry)
+    water_img = readAlignedSlab(study['water'], RangeSlice, masterGeometry)
+
+    if study['region'] == Pipeline.THIGH:
+      master_img = readImageSlab(study['master'], RangeSlice) if study['master'] else None
+      result = Pipeline.segmentThigh(fat_img, water_img, RangeSlice, study['partitions'], study['incomplete'], master_img)
+      message, outputs = Pipeline.thighOutputPlan(result, study['incomplete'])
+      record['message'] = message
+      for side, suffix in outputs:
+        writeOutput(result['out_' + side], side, suffix)
+      if options['combineThighs'] and outputs:
+        sides = {side: result['out_' + side] for side, _ in outputs}
+        outputPath = labelmapPath(outputDirectory, study['id'], 'thighs', options)
+        writeLabelmap(Pipeline.combineThighs(sides.get('l'), sides.get('r')), outputPath, options['compressionLevel'])
+        record['outputs']['thighs'] = outputPath
+      for flag in ('left_full_Q', 'right_full_Q', 'sum_left', 'sum_right'):
+        record[flag] = result[flag]
+    else:
+      roi_img = readRoi(study['roi'], fat_img)
+      result = Pipeline.segmentAbdomen(fat_img, water_img, roi_img, RangeSlice, study['partitions'])
+      writeOutput(result['out_Abdo'], 'Abdo', '')
+    if quantify:
+      from Tis_SegLib import Quantification
+      job = {'region': study['region'], 'fat': fat_img, 'water': water_img, 'RangeSlice': RangeSlice, 'partitions': study['partitions']}
+      writeQuantification(record, Quantification.quantifyResult(job, result, list(record['segmentSuffixes'])), outputDirectory)
+    if options['store']:
+      from Tis_SegLib import CohortStore
+      compact_imgs = {name: Pipeline.compactLabelmap(label_imgs[name]) for name in record['segmentSuffixes']}
+      record['outputs']['store'] = CohortStore.writeStudy(options['store'], record,
+        {name: CohortStore.mapImage(label_img) for name, label_img in compact_imgs.items()})
+      del compact_imgs
+    if writeSegmentations:
+      writeStudySegmentations(record, outputDirectory, label_imgs)
+  except Exception as e:
+    logging.exception('Study {0} failed'.format(study['id']))
+    record['status'] = 'failed'
+    record['error'] = str(e)
+
+  record['seconds'] = time.time() - startTime
+  return record
+
+
+def processManifest(studies, outputDirectory, writeSegmentations=False, quantify=False, options=None):
+  """
+  Segment the studies one after the other. Yields the record of each study as soon as it is written.
+  """
+  if not os.path.isdir(outputDirectory):
+    os.makedirs(outputDirectory)
+  for study in studies:
+    yield processStudy(study, outputDirectory, writeSegmentations, quantify, options)
+
+
+def processQueue(queue, studies, processStudies, settings=None, retryFailed=False):
+  """
+  Add the studies to a JobQueue and segment the ones that are not done yet with processStudies, a function
+  that takes an iterable of studies and yields their records (for example processManifest). settings are the
+  options of processStudies that change the outputs: the studies done with other settings are segmented again.
+  Each record is stored in the queue as soon as it is yielded, that is after the outputs of the study are written.
+  Yields the records of the studies processed by previous runs, then the others as they finish.
+  """
+  queue.add(studies, settings, retryFailed)
+  ids = {study['id'] for study in studies}
+  for record in queue.records():
+    if record['id'] in ids:
+      yield record
+  for record in processStudies(queue.claim(queue.studies())):
+    queue.finish(record)
+    yield record
+
+
+def summaryRow(record):
+  row = {field: record.get(field) for field in SUMMARY_FIELDS}
+  row['outputs'] = ';'.join(record['outputs'].values())
+  if row['seconds'] is not None:
+    row['seconds'] = '{0:.2f}'.format(row['seconds'])
+  return row
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Segment the thigh and abdomen studies listed in a manifest.')
+  parser.add_argument('--manifest', required=True, help='CSV or JSON file with the fields: ' + ', '.join(MANIFEST_FIELDS))
+  parser.add_argument('--output-dir', required=True, help='Folder where the labelmaps, segmentations and summary are written')
+  parser.add_argument('--partitions', type=int, default=DEFAULT_PARAMETERS['partitions'], help='Default number of partitions')
+  parser.add_argument('--min-slice', type=int, default=DEFAULT_PARAMETERS['minSlice'], help='Default first slice (included)')
+  parser.add_argument('--max-slice', type=int, default=DEFAULT_PARAMETERS['maxSlice'], help='Default last slice (included)')
+  parser.add_argument('--incomplete', action='store_true', help='Segment incomplete thighs by default')
+  parser.add_argument('--queue', default=None, help='Job queue used to resume an interrupted run '
+    '(default: {0} in the output folder)'.format(JobQueue.DEFAULT_QUEUE_NAME))
+  parser.add_argument('--retry-failed', action='store_true', help='Segment again the studies that failed in a previous run')
+  parser.add_argument('--auto-range', action='store_true', help='Detect the slices that contain tissue by default '
+    'instead of using the minimum and maximum slices')
+  parser.add_argument('--segmentations', action='store_true', help='Also write the color segmentations (.seg.nrrd)')
+  parser.add_argument('--workers', type=int, default=1, help='Number of worker processes (studies are segmented in parallel if > 1)')
+  parser.add_argument('--memory-budget', type=float, default=None, help='Memory (GB) that the parallel workers can use together '
+    '(default: {0:.0f}% of the available memory)'.format(100 * Scheduling.DEFAULT_MEMORY_FRACTION))
+  parser.add_argument('--unordered', action='store_true', help='Report the studies in completion order instead of manifest order')
+  parser.add_argument('--stream', action='store_true', help='Read, segment and write each study in chunks of slices to bound memory')
+  parser.add_argument('--chunk-slices', type=int, default=None, help='Number of slices segmented at once with --stream')
+  parser.add_argument('--quantify', action='store_true', help='Also write the volume and fat fraction of the tissues of each study '
+    '(per slice, per block of partitions slices and per thigh) and their totals for all the studies in quantification.csv')
+  parser.add_argument('--format', choices=OUTPUT_FORMATS, default=DEFAULT_LABELMAP_OPTIONS['format'], help='File format of the labelmaps')
+  parser.add_argument('--compression-level', type=int, choices=range(-1, 10), default=DEFAULT_LABELMAP_OPTIONS['compressionLevel'],
+    metavar='{-1..9}', help='Compression level of the labelmaps (0 writes them uncompressed, -1 uses the default level)')
+  parser.add_argument('--combine-thighs', action='store_true', help='Write both thighs in one labelmap <id>_thighs, '
+    'the labels of the right thigh shifted by {0}'.format(Pipeline.RIGHT_LABEL_OFFSET))
+  parser.add_argument('--store', default=None, help='Also write the labelmaps and tissue volumes of all the studies '
+    'to this chunked cohort store (Zarr folder, see CohortStore)')
+  args = parser.parse_args(argv)
+
+  defaults = {'partitions': args.partitions, 'minSlice': args.min_slice, 'maxSlice': args.max_slice, 'incomplete': args.incomplete,
+    'autoRange': args.auto_range}
+  options = {'format': args.format, 'compressionLevel': args.compression_level, 'combineThighs': args.combine_thighs,
+    'store': os.path.abspath(args.store) if args.store else None}
+  studies = readManifest(args.manifest, defaults)
+
+  failed = 0
+  totals = []
+  if not os.path.isdir(args.output_dir):
+    os.makedirs(args.output_dir)
+  if args.stream:
+    from Tis_SegLib import StreamProcessing
+    processStudies = lambda pending: StreamProcessing.processManifest(pending, args.output_dir, args.segmentations,
+      args.chunk_slices or StreamProcessing.DEFAULT_CHUNK_SLICES, args.quantify, options)
+  elif args.workers > 1:
+    from Tis_SegLib import ParallelProcessing
+    runner = ParallelProcessing.ParallelRunner(args.workers, ordered=not args.unordered,
+      memoryBudget=int(args.memory_budget * 1024 ** 3) if args.memory_budget else None)
+    processStudies = lambda pending: runner.processStudies(pending, args.output_dir, args.segmentations, args.quantify, options)
+  else:
+    processStudies = lambda pending: processManifest(pending, args.output_dir, args.segmentations, args.quantify, options)
+
+  settings = {'segmentations': args.segmentations, 'quantify': args.quantify, 'stream': args.stream,
+    'chunkSlices': args.chunk_slices if args.stream else None, 'options': labelmapOptions(options)}
+  queue = JobQueue.JobQueue(args.queue or os.path.join(args.output_dir, JobQueue.DEFAULT_QUEUE_NAME))
+  with queue, open(os.path.join(args.output_dir, 'summary.csv'), 'w', newline='') as summaryFile:
+    writer = csv.DictWriter(summaryFile, SUMMARY_FIELDS)
+    writer.writeheader()
+    for record in processQueue(queue, studies, processStudies, settings, args.retry_failed):
+      writer.writerow(summaryRow(record))
+      summaryFile.flush()
+      if record['status'] != 'done':
+        failed += 1
+      elif 'quantification' in record['outputs']:
+        from Tis_SegLib import Quantification
+        for row in Quantification.totalRows(Quantification.readCsv(record['outputs']['quantification'])):
+          row['id'] = record['id']
+          totals.append(row)
+      print('{0}: {1} ({2:.1f} s)'.format(record['id'], record['status'], record['seconds']))
+
+  if args.quantify:
+    from Tis_SegLib import Quantification
+    Quantification.writeCsv(totals, os.path.join(args.output_dir, 'quantification.csv'), ['id'])
+
+  print('Processed {0} studies, {1} failed'.format(len(studies), failed))
+  return 1 if failed else 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
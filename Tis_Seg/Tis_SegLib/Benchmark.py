@@ -0,0 +1,348 @@
+"""
+Benchmark of the thigh and abdomen segmentation on synthetic water/fat (Dixon) phantoms.
+
+The phantoms are generated from a seed, so every run segments exactly the same images. Each case
+(region, size, number of partitions, fraction of the slices segmented) is run through Tis_SegLogic
+and timed end to end and per stage (see Profiling). The results are written as JSON and can be
+compared with a baseline file to detect regressions.
+
+Run it without GUI (CPU only) with:
+
+  Slicer --no-main-window --python-script Tis_SegLib/Benchmark.py --sizes small medium --output results.json --baseline baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+if __name__ == "__main__":
+  # Make Tis_SegLib and Tis_Seg importable when this file is run with --python-script
+  sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Tis_SegLib import Pipeline
+from Tis_SegLib import ResultCache
+from Tis_SegLib import VolumeBridge
+
+# Phantom sizes (I, J, K)
+SIZES = {
+  'small': (256, 256, 40),
+  'medium': (384, 384, 120),
+  'large': (512, 512, 400),
+  }
+
+PHANTOM_SPACING = (1.0, 1.0, 3.0)
+
+# Intensity of the water and fat images for each tissue
+TISSUES = {
+  'background': (0.02, 0.02),
+  'skin': (0.5, 0.3),
+  'fat': (0.1, 0.9),
+  'muscle': (0.8, 0.1),
+  'bone': (0.05, 0.05),
+  'marrow': (0.1, 0.85),
+  'organ': (0.75, 0.15),
+  }
+
+# Stages shorter than this (seconds) are not reported as regressions
+MINIMUM_REGRESSION_SECONDS = 0.05
+
+
+def parseSize(text):
+  """
+  Size from a name of SIZES or from 'IxJxK'.
+  """
+  if text in SIZES:
+    return SIZES[text]
+  size = tuple(int(value) for value in text.lower().split('x'))
+  if len(size) != 3:
+    raise ValueError("Invalid size '{0}', expected one of {1} or IxJxK".format(text, ', '.join(SIZES)))
+  return size
+
+
+def _images(water, fat, spacing):
+  import SimpleITK as sitk
+
+  images = []
+  for array in (water, fat):
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing(spacing)
+    images.append(image)
+  return images
+
+
+def _paint(water, fat, mask, tissue):
+  water[mask], fat[mask] = TISSUES[tissue]
+
+
+def _addNoise(random, water, fat, scale=1000.0):
+  import numpy as np
+
+  for array in (water, fat):
+    array += random.normal(0, 0.03, array.shape).astype(np.float32)
+    np.abs(array, out=array)
+    array *= scale
+
+
+def thighPhantom(size, seed=0, spacing=PHANTOM_SPACING):
+  """
+  Two thighs (skin, subcutaneous fat, muscle with intramuscular fat, bone and marrow) whose radius
+  decreases along the volume. Returns the water and fat SimpleITK images (float32).
+  """
+  import numpy as np
+
+  random = np.random.RandomState(seed)
+  columns, rows, slices = size
+  water = np.empty((slices, rows, columns), np.float32)
+  fat = np.empty((slices, rows, columns), np.float32)
+  y, x = np.mgrid[0:rows, 0:columns].astype(np.float32)
+  speckles = random.rand(rows, columns) < 0.04
+
+  for k in range(slices):
+    radius = 0.18 * columns * (1.0 - 0.2 * k / max(1, slices - 1))
+    waterSlice, fatSlice = water[k], fat[k]
+    _paint(waterSlice, fatSlice, np.ones((rows, columns), bool), 'background')
+    for center in (0.3 * columns, 0.7 * columns):
+      r = np.hypot(x - center, y - 0.5 * rows) / radius
+      _paint(waterSlice, fatSlice, r < 1.0, 'skin')
+      _paint(waterSlice, fatSlice, r < 0.95, 'fat')
+      _paint(waterSlice, fatSlice, r < 0.75, 'muscle')
+      _paint(waterSlice, fatSlice, (r < 0.75) & (r > 0.25) & speckles, 'fat')
+      _paint(waterSlice, fatSlice, r < 0.2, 'bone')
+      _paint(waterSlice, fatSlice, r < 0.12, 'marrow')
+
+  _addNoise(random, water, fat)
+  return _images(water, fat, spacing)
+
+
+def abdomenPhantom(size, seed=0, spacing=PHANTOM_SPACING):
+  """
+  Abdomen (skin, subcutaneous fat, muscle wall, visceral fat with organs and spine).
+  Returns the water, fat and ROI (inside of the subcutaneous fat, label 1) SimpleITK images.
+  """
+  import numpy as np
+  import SimpleITK as sitk
+
+  random = np.random.RandomState(seed)
+  columns, rows, slices = size
+  water = np.empty((slices, rows, columns), np.float32)
+  fat = np.empty((slices, rows, columns), np.float32)
+  roi = np.zeros((slices, rows, columns), np.uint8)
+  y, x = np.mgrid[0:rows, 0:columns].astype(np.float32)
+  organs = [(0.5 + random.uniform(-0.15, 0.15), 0.45 + random.uniform(-0.1, 0.1), random.uniform(0.08, 0.14)) for _ in range(4)]
+
+  for k in range(slices):
+    scale = 1.0 - 0.1 * k / max(1, slices - 1)
+    rho = np.hypot((x - 0.5 * columns) / (0.42 * columns * scale), (y - 0.5 * rows) / (0.32 * rows * scale))
+    waterSlice, fatSlice = water[k], fat[k]
+    _paint(waterSlice, fatSlice, np.ones((rows, columns), bool), 'background')
+    _paint(waterSlice, fatSlice, rho < 1.0, 'skin')
+    _paint(waterSlice, fatSlice, rho < 0.97, 'fat')
+    _paint(waterSlice, fatSlice, rho < 0.8, 'muscle')
+    _paint(waterSlice, fatSlice, rho < 0.72, 'fat')
+    for cx, cy, radius in organs:
+      _paint(waterSlice, fatSlice, np.hypot(x / columns - cx, y / rows - cy) < radius * scale, 'organ')
+    _paint(waterSlice, fatSlice, np.hypot(x / columns - 0.5, y / rows - 0.7) < 0.05 * scale, 'bone')
+    roi[k][rho < 0.8] = 1
+
+  _addNoise(random, water, fat)
+  water_img, fat_img = _images(water, fat, spacing)
+  roi_img = sitk.GetImageFromArray(roi)
+  roi_img.CopyInformation(water_img)
+  return water_img, fat_img, roi_img
+
+
+def caseRange(size, rangeFraction):
+  """
+  Slices (minSlice, maxSlice, both included) of a window of rangeFraction of the slices in the middle of the volume.
+  """
+  slices = size[2]
+  length = max(1, min(slices, int(round(rangeFraction * slices))))
+  minSlice = (slices - length) // 2
+  return minSlice, minSlice + length - 1
+
+
+def caseName(region, size, partitions, rangeFraction):
+  return '{0}_{1}x{2}x{3}_p{4}_r{5:g}'.format(region, size[0], size[1], size[2], partitions, rangeFraction)
+
+
+def _volumeNode(image, name, className='vtkMRMLScalarVolumeNode'):
+  import slicer
+  node = slicer.mrmlScene.AddNewNodeByClass(className, name)
+  VolumeBridge.updateVolumeFromImage(node, image)
+  return node
+
+
+def runCase(logic, region, size, partitions=10, rangeFraction=0.5, repeats=1, seed=0):
+  """
+  Segment a phantom repeats times with logic (a Tis_SegLogic) and return the timing record of the case,
+  with the number of voxels of each label of the output labelmaps of the last run.
+  The nodes created for the case are removed from the scene afterwards.
+  """
+  import numpy as np
+  import slicer
+
+  startTime = time.perf_counter()
+  if region == Pipeline.THIGH:
+    water_img, fat_img = thighPhantom(size, seed)
+  else:
+    water_img, fat_img, roi_img = abdomenPhantom(size, seed)
+  phantomSeconds = time.perf_counter() - startTime
+
+  minSlice, maxSlice = caseRange(size, rangeFraction)
+  nodes = []
+  try:
+    water = _volumeNode(water_img, 'BenchmarkWater')
+    fat = _volumeNode(fat_img, 'BenchmarkFat')
+    nodes += [water, fat]
+    runs = []
+    for repeat in range(repeats):
+      if region == Pipeline.THIGH:
+        outputs = [slicer.mrmlScene.AddNewNodeByClass(className, name) for className, name in (
+          ('vtkMRMLLabelMapVolumeNode', 'Benchmark_l'), ('vtkMRMLSegmentationNode', 'BenchmarkSegmentation_l'),
+          ('vtkMRMLLabelMapVolumeNode', 'Benchmark_r'), ('vtkMRMLSegmentationNode', 'BenchmarkSegmentation_r'))]
+        nodes += outputs
+        logic.process(water, fat, outputs[0], outputs[1], outputs[2], outputs[3], partitions, maxSlice, minSlice, False, None)
+      else:
+        if repeat == 0:
+          roiLabelmap = _volumeNode(roi_img, 'BenchmarkROILabelmap', 'vtkMRMLLabelMapVolumeNode')
+          roi = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode', 'BenchmarkROI')
+          slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(roiLabelmap, roi)
+          nodes += [roiLabelmap, roi]
+        outputs = [slicer.mrmlScene.AddNewNodeByClass(className, name) for className, name in (
+          ('vtkMRMLLabelMapVolumeNode', 'Benchmark_Abdo'), ('vtkMRMLSegmentationNode', 'BenchmarkSegmentation_Abdo'))]
+        nodes += outputs
+        logic.processAbdo(water, fat, roi, outputs[0], outputs[1], partitions, maxSlice, minSlice)
+      runs.append(logic.profiler.lastRun())
+
+    labels = {}
+    for node in outputs:
+      if node.IsA('vtkMRMLLabelMapVolumeNode') and node.GetImageData() is not None:
+        values, counts = np.unique(slicer.util.arrayFromVolume(node), return_counts=True)
+        labels[node.GetName()[len('Benchmark_'):]] = {int(value): int(count) for value, count in zip(values, counts) if value != 0}
+  finally:
+    # Remove the observers the logic added to the nodes of the case
+    logic.geometryCache.clear()
+    for node in nodes:
+      slicer.mrmlScene.RemoveNode(node)
+
+  stageNames = []
+  for run in runs:
+    for stage in run.stages:
+      if stage['stage'] not in stageNames:
+        stageNames.append(stage['stage'])
+  stages = {}
+  for name in stageNames:
+    stages[name] = statistics.median(sum(stage['seconds'] for stage in run.stages if stage['stage'] == name) for run in runs)
+  peakMemory = [stage.get('peakMemory') for run in runs for stage in run.stages if stage.get('peakMemory') is not None]
+
+  return {
+    'name': caseName(region, size, partitions, rangeFraction),
+    'region': region,
+    'size': list(size),
+    'partitions': partitions,
+    'range': [minSlice, maxSlice],
+    'phantomSeconds': phantomSeconds,
+    'runs': [run.seconds for run in runs],
+    'seconds': statistics.median(run.seconds for run in runs),
+    'stages': stages,
+    'peakMemory': max(peakMemory) if peakMemory else None,
+    'labels': labels,
+    }
+
+
+def environment():
+  """
+  Versions and hardware the benchmark ran on.
+  """
+  import numpy as np
+  import SimpleITK as sitk
+
+  info = {
+    'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'platform': platform.platform(),
+    'processor': platform.processor(),
+    'cpus': os.cpu_count(),
+    'python': platform.python_version(),
+    'numpy': np.__version__,
+    'SimpleITK': sitk.Version_VersionString(),
+    'tisseglibrary': ResultCache.libraryVersion(),
+    }
+  try:
+    import slicer
+    info['slicer'] = slicer.app.applicationVersion
+  except (ImportError, AttributeError):
+    pass
+  return info
+
+
+def runBenchmark(logic, sizes, regions=(Pipeline.THIGH, Pipeline.ABDOMEN), partitions=(10,), rangeFractions=(0.5,), repeats=1, seed=0):
+  """
+  Run all the combinations of sizes, regions, partitions and range fractions. Returns the results dictionary.
+  """
+  cases = []
+  for size in sizes:
+    for region in regions:
+      for numberOfPartitions in partitions:
+        for rangeFraction in rangeFractions:
+          case = runCase(logic, region, size, numberOfPartitions, rangeFraction, repeats, seed)
+          print('{0}: {1:.2f} s'.format(case['name'], case['seconds']))
+          cases.append(case)
+  return {'environment': environment(), 'cases': cases}
+
+
+def compare(results, baseline, tolerance=0.2):
+  """
+  Return the list of regressions (text) of results with respect to baseline: cases or stages
+  more than tolerance (fraction) slower than in the baseline.
+  """
+  baselineCases = {case['name']: case for case in baseline.get('cases', [])}
+  regressions = []
+  for case in results['cases']:
+    reference = baselineCases.get(case['name'])
+    if reference is None:
+      continue
+    timings = [('total', case['seconds'], reference['seconds'])]
+    timings += [(name, seconds, reference['stages'][name]) for name, seconds in case['stages'].items() if name in reference['stages']]
+    for name, seconds, referenceSeconds in timings:
+      if seconds > referenceSeconds * (1 + tolerance) and seconds - referenceSeconds > MINIMUM_REGRESSION_SECONDS:
+        regressions.append('{0} {1}: {2:.2f} s, baseline {3:.2f} s (+{4:.0f}%)'.format(case['name'], name, seconds,
+          referenceSeconds, 100 * (seconds / referenceSeconds - 1) if referenceSeconds else float('inf')))
+  return regressions
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmark the thigh and abdomen segmentation on synthetic phantoms.')
+  parser.add_argument('--sizes', nargs='+', default=['small'], help='Phantom sizes: ' + ', '.join(SIZES) + ' or IxJxK')
+  parser.add_argument('--regions', nargs='+', default=[Pipeline.THIGH, Pipeline.ABDOMEN], choices=[Pipeline.THIGH, Pipeline.ABDOMEN])
+  parser.add_argument('--partitions', nargs='+', type=int, default=[10], help='Numbers of partitions to benchmark')
+  parser.add_argument('--range-fractions', nargs='+', type=float, default=[0.5], help='Fractions of the slices segmented')
+  parser.add_argument('--repeats', type=int, default=1, help='Runs of each case (the median is reported)')
+  parser.add_argument('--seed', type=int, default=0, help='Seed of the phantoms')
+  parser.add_argument('--output', help='JSON file where the results are written')
+  parser.add_argument('--baseline', help='JSON results to compare with')
+  parser.add_argument('--tolerance', type=float, default=0.2, help='Slowdown (fraction) reported as a regression')
+  args = parser.parse_args(argv)
+
+  from Tis_Seg import Tis_SegLogic
+
+  results = runBenchmark(Tis_SegLogic(), [parseSize(size) for size in args.sizes], args.regions, args.partitions,
+    args.range_fractions, args.repeats, args.seed)
+  if args.output:
+    with open(args.output, 'w') as outputFile:
+      json.dump(results, outputFile, indent=2)
+
+  if args.baseline:
+    with open(args.baseline) as baselineFile:
+      regressions = compare(results, json.load(baselineFile), args.tolerance)
+    for regression in regressions:
+      print('Regression: ' + regression)
+    print('{0} regressions'.format(len(regressions)))
+    return 1 if regressions else 0
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,331 @@
+"""
+Chunked store of the labelmaps and tissue volumes of a whole cohort.
+
+The store is a folder in the Zarr (version 2) layout, so it can also be opened with zarr.open(path):
+
+  <store>/<id>/.zattrs             region, slice range and geometry (size, spacing, origin, direction) of each labelmap
+  <store>/<id>/<name>/             labelmap 'l', 'r' or 'Abdo': array (K, J, I) of labels in zlib-compressed chunks
+  <store>/<id>/volumes/<column>/   one 1-D array per column of the tissue table (TABLE_FIELDS)
+
+Each study is written to a temporary folder that is renamed when complete, and no file is shared between
+studies, so several processes can write to the same store. The arrays are read lazily: indexing a
+labelmap (store.labelmap(id, name)[first:last]) only reads and decompresses the chunks it touches, chunks
+that only contain background are not written, and the table only reads the columns that are asked for.
+"""
+import itertools
+import json
+import os
+import shutil
+import zlib
+
+from Tis_SegLib import JobQueue
+from Tis_SegLib import Pipeline
+
+ZARR_FORMAT = 2
+
+# Chunks of 8 slices of 256 x 256 voxels (K, J, I), clipped to the size of the labelmap
+DEFAULT_CHUNK_SHAPE = (8, 256, 256)
+DEFAULT_COMPRESSION_LEVEL = 6
+
+TABLE_NAME = 'volumes'
+TABLE_FIELDS = ['region', 'side', 'label', 'tissue', 'voxels', 'volumeMl', 'meanFatFraction']
+
+
+def _readJson(path):
+  with open(path) as jsonFile:
+    return json.load(jsonFile)
+
+
+def _writeJson(path, value):
+  with open(path, 'w') as jsonFile:
+    json.dump(value, jsonFile, indent=2, sort_keys=True)
+
+
+def _createGroup(path, attributes=None):
+  os.makedirs(path, exist_ok=True)
+  groupPath = os.path.join(path, '.zgroup')
+  if not os.path.exists(groupPath):
+    with JobQueue.atomicPath(groupPath) as partialPath:
+      _writeJson(partialPath, {'zarr_format': ZARR_FORMAT})
+  if attributes is not None:
+    _writeJson(os.path.join(path, '.zattrs'), attributes)
+
+
+def writeArray(path, array, chunkShape=None, compressionLevel=DEFAULT_COMPRESSION_LEVEL):
+  """
+  Write a NumPy array (or an array-like that can be sliced, such as a memory map) to a Zarr array folder,
+  one chunk at a time. Chunks full of zeros are not written.
+  """
+  import numpy as np
+
+  shape = tuple(int(length) for length in np.shape(array))
+  chunks = tuple(max(1, min(length, chunk)) for length, chunk in zip(shape, chunkShape or shape))
+  dtype = np.dtype(array.dtype)
+  os.makedirs(path, exist_ok=True)
+  _writeJson(os.path.join(path, '.zarray'), {
+    'zarr_format': ZARR_FORMAT,
+    'shape': list(shape),
+    'chunks': list(chunks),
+    'dtype': dtype.str,
+    'compressor': {'id': 'zlib', 'level': compressionLevel},
+    'fill_value': '' if dtype.kind == 'U' else 0,
+    'order': 'C',
+    'filters': None,
+    })
+
+  for chunkIndex in itertools.product(*(range(-(-length // chunk)) for length, chunk in zip(shape, chunks))):
+    region = tuple(slice(index * chunk, min(length, (index + 1) * chunk)) for index, chunk, length in zip(chunkIndex, chunks, shape))
+    block = np.asarray(array[region], dtype)
+    if dtype.kind != 'U' and not block.any():
+      continue
+    if block.shape != chunks:
+      # Chunks on the edges are stored with the full chunk shape
+      padded = np.zeros(chunks, dtype)
+      padded[tuple(slice(0, length) for length in block.shape)] = block
+      block = padded
+    with open(os.path.join(path, '.'.join(str(index) for index in chunkIndex)), 'wb') as chunkFile:
+      chunkFile.write(zlib.compress(np.ascontiguousarray(block).tobytes(), compressionLevel))
+
+
+class LazyArray:
+  """
+  Zarr array of the store, read chunk by chunk when it is indexed with integers and slices.
+  """
+
+  def __init__(self, path):
+    import numpy as np
+
+    self.path = path
+    metadata = _readJson(os.path.join(path, '.zarray'))
+    self.shape = tuple(metadata['shape'])
+    self.chunks = tuple(metadata['chunks'])
+    self.dtype = np.dtype(metadata['dtype'])
+    self.fillValue = metadata['fill_value']
+
+  def __len__(self):
+    return self.shape[0]
+
+  def __array__(self, dtype=None):
+    array = self[...]
+    return array.astype(dtype) if dtype is not None else array
+
+  def _readChunk(self, chunkIndex):
+    import numpy as np
+
+    chunkPath = os.path.join(self.path, '.'.join(str(index) for index in chunkIndex))
+    if not os.path.exists(chunkPath):
+      return None
+    with open(chunkPath, 'rb') as chunkFile:
+      return np.frombuffer(zlib.decompress(chunkFile.read()), self.dtype).reshape(self.chunks)
+
+  def __getitem__(self, key):
+    import numpy as np
+
+    if key is Ellipsis:
+      key = ()
+    if not isinstance(key, tuple):
+      key = (key,)
+    key = key + (slice(None),) * (len(self.shape) - len(key))
+    ranges = []
+    for item, length in zip(key, self.shape):
+      if isinstance(item, slice):
+        start, stop, step = item.indices(length)
+        if step != 1:
+          raise ValueError('Only contiguous slices can be read')
+        ranges.append((start, max(start, stop), False))
+      else:
+        index = int(item) + (length if int(item) < 0 else 0)
+        if not 0 <= index < length:
+          raise IndexError('Index {0} is out of range'.format(item))
+        ranges.append((index, index + 1, True))
+
+    result = np.full(tuple(stop - start for start, stop, _ in ranges), self.fillValue, self.dtype)
+    chunkRanges = [range(start // chunk, -(-stop // chunk)) for (start, stop, _), chunk in zip(ranges, self.chunks)]
+    for chunkIndex in itertools.product(*chunkRanges):
+      block = self._readChunk(chunkIndex)
+      if block is None:
+        continue
+      source = []
+      target = []
+      for index, chunk, (start, stop, _) in zip(chunkIndex, self.chunks, ranges):
+        first = max(start, index * chunk)
+        last = min(stop, (index + 1) * chunk)
+        source.append(slice(first - index * chunk, last - index * chunk))
+        target.append(slice(first - start, last - start))
+      result[tuple(target)] = block[tuple(source)]
+    return result[tuple(0 if isInteger else slice(None) for _, _, isInteger in ranges)]
+
+
+def tissueRows(labels, spacing, region, side='', slabSlices=DEFAULT_CHUNK_SHAPE[0]):
+  """
+  Number of voxels and volume (mL) of each tissue of a labelmap array (K, J, I), counted slabSlices slices at a time.
+  """
+  import numpy as np
+  from Tis_SegLib import Quantification
+
+  tissues = Quantification.tissueLabels(region)
+  counts = np.zeros(max(label for label, _ in tissues) + 1, np.int64)
+  for first in range(0, labels.shape[0], slabSlices):
+    slab = np.asarray(labels[first:first + slabSlices]).ravel()
+    counts += np.bincount(slab[(slab >= 0) & (slab < len(counts))].astype(np.intp), minlength=len(counts))
+  voxelMl = spacing[0] * spacing[1] * spacing[2] / 1000.0
+  return [{'region': region, 'side': side, 'label': label, 'tissue': tissue, 'voxels': int(counts[label]),
+    'volumeMl': counts[label] * voxelMl, 'meanFatFraction': float('nan')} for label, tissue in tissues]
+
+
+def writeTable(path, rows):
+  """
+  Write rows (dictionaries with the TABLE_FIELDS) as one array per column.
+  """
+  import numpy as np
+
+  for field in TABLE_FIELDS:
+    values = [row[field] for row in rows]
+    if field in ('voxels', 'label'):
+      column = np.array(values, np.int64)
+    elif field in ('volumeMl', 'meanFatFraction'):
+      column = np.array(values, np.float64)
+    else:
+      column = np.array(values, np.str_) if values else np.array([], '<U1')
+    writeArray(os.path.join(path, field), column)
+  _createGroup(path)
+
+
+def mapImage(label_img):
+  """
+  (array (K, J, I), spacing, origin, direction) of a SimpleITK labelmap, as returned by StreamProcessing.mapNrrd.
+  The array is a view of the image, which must be kept alive while it is used.
+  """
+  import SimpleITK as sitk
+
+  return sitk.GetArrayViewFromImage(label_img), label_img.GetSpacing(), label_img.GetOrigin(), label_img.GetDirection()
+
+
+def writeStudy(storePath, record, labelmaps=None, chunkShape=DEFAULT_CHUNK_SHAPE, compressionLevel=DEFAULT_COMPRESSION_LEVEL):
+  """
+  Write the labelmaps of a processed study (see BatchProcessing.processStudy) and its tissue table to a store.
+  The labelmaps are taken from labelmaps (dictionary of (array, spacing, origin, direction) indexed by output
+  name, see mapImage) or read from the files of the record. The mean fat fractions come from the
+  quantification of the study, if it was written. Returns the folder of the study in the store.
+  Raise ValueError if the id of the study is not the name of a folder directly inside the store.
+  """
+  from Tis_SegLib import BatchProcessing
+  from Tis_SegLib import Quantification
+
+  # The previous version of the study is removed, its folder must be in the store
+  studyPath = os.path.join(storePath, record['id'])
+  inStore = os.path.dirname(os.path.realpath(studyPath)) == os.path.realpath(storePath)
+  if record['id'] in ('', '.', '..') or os.path.basename(record['id']) != record['id'] or not inStore:
+    raise ValueError("The study id '{0}' is not a folder of the cohort store".format(record['id']))
+  _createGroup(storePath)
+  partialPath = os.path.join(storePath, '{0}{1}-{2}'.format(JobQueue.PARTIAL_PREFIX, record['id'], os.getpid()))
+  if os.path.exists(partialPath):
+    shutil.rmtree(partialPath)
+
+  fatFractions = {}
+  if 'quantification' in record['outputs']:
+    for row in Quantification.totalRows(Quantification.readCsv(record['outputs']['quantification'])):
+      fatFractions[(row['side'], int(row['label']))] = float(row['meanFatFraction']) if row['meanFatFraction'] != '' else float('nan')
+
+  try:
+    geometries = {}
+    rows = []
+    for name in record['segmentSuffixes']:
+      label_img = None
+      if labelmaps is not None and name in labelmaps:
+        labels, spacing, origin, direction = labelmaps[name]
+      else:
+        label_img = Pipeline.compactLabelmap(BatchProcessing.readStudyLabelmap(record, name))
+        labels, spacing, origin, direction = mapImage(label_img)
+      writeArray(os.path.join(partialPath, name), labels, chunkShape, compressionLevel)
+      geometries[name] = {
+        'size': [labels.shape[2], labels.shape[1], labels.shape[0]],
+        'spacing': list(spacing),
+        'origin': list(origin),
+        'direction': list(direction),
+        }
+      side = Quantification.SIDES.get(name, '')
+      for row in tissueRows(labels, spacing, record['region'], side, chunkShape[0]):
+        row['meanFatFraction'] = fatFractions.get((side, row['label']), row['meanFatFraction'])
+        rows.append(row)
+      del labels, label_img
+    writeTable(os.path.join(partialPath, TABLE_NAME), rows)
+    _createGroup(partialPath, {'id': record['id'], 'region': record['region'], 'minSlice': record['minSlice'],
+      'maxSlice': record['maxSlice'], 'message': record.get('message'), 'labelmaps': geometries})
+
+    # Replace the previous version of the study, if any
+    oldPath = os.path.join(storePath, '.old-{0}-{1}'.format(record['id'], os.getpid()))
+    if os.path.exists(studyPath):
+      os.rename(studyPath, oldPath)
+    os.rename(partialPath, studyPath)
+    shutil.rmtree(oldPath, ignore_errors=True)
+  except BaseException:
+    shutil.rmtree(partialPath, ignore_errors=True)
+    raise
+  return studyPath
+
+
+class CohortStore:
+  """
+  Read access to a cohort store.
+  """
+
+  def __init__(self, path):
+    self.path = path
+
+  def studies(self):
+    """
+    Ids of the studies in the store.
+    """
+    if not os.path.isdir(self.path):
+      return []
+    return sorted(name for name in os.listdir(self.path)
+      if not name.startswith('.') and os.path.exists(os.path.join(self.path, name, '.zattrs')))
+
+  def attributes(self, studyId):
+    """
+    Region and geometry of the labelmaps of a study.
+    """
+    return _readJson(os.path.join(self.path, studyId, '.zattrs'))
+
+  def labelmap(self, studyId, name):
+    """
+    Labelmap 'l', 'r' or 'Abdo' of a study as a LazyArray (K, J, I).
+    """
+    return LazyArray(os.path.join(self.path, studyId, name))
+
+  def image(self, studyId, name, first=0, last=None):
+    """
+    SimpleITK image of the slices [first, last) of a labelmap, with its geometry. Only these slices are read.
+    """
+    import SimpleITK as sitk
+
+    geometry = self.attributes(studyId)['labelmaps'][name]
+    first, last, _ = slice(first, last).indices(geometry['size'][2])
+    image = sitk.GetImageFromArray(self.labelmap(studyId, name)[first:last])
+    image.SetSpacing(geometry['spacing'])
+    image.SetOrigin(geometry['origin'])
+    image.SetDirection(geometry['direction'])
+    image.SetOrigin(image.TransformIndexToPhysicalPoint((0, 0, first)))
+    return image
+
+  def table(self, columns=None, studies=None):
+    """
+    Tissue table of the studies (all by default) as a dictionary of NumPy columns, with an 'id' column.
+    Only the requested columns are read.
+    """
+    import numpy as np
+
+    columns = list(columns or TABLE_FIELDS)
+    values = {column: [] for column in ['id'] + columns}
+    for studyId in (studies if studies is not None else self.studies()):
+      tablePath = os.path.join(self.path, studyId, TABLE_NAME)
+      numberOfRows = None
+      for column in columns:
+        array = LazyArray(os.path.join(tablePath, column))[...]
+        numberOfRows = len(array)
+        values[column].append(array)
+      if numberOfRows is None:
+        numberOfRows = LazyArray(os.path.join(tablePath, TABLE_FIELDS[0])).shape[0]
+      values['id'].append(np.full(numberOfRows, studyId))
+    return {column: np.concatenate(arrays) if arrays else np.array([]) for column, arrays in values.items()}
@@ -0,0 +1,71 @@
+"""
+Check of the Python packages needed by the segmentation without importing them.
+
+The installed versions are read from the package metadata, which takes milliseconds, while importing
+scikit-image, scikit-learn and tisseglibrary takes seconds on a cold start. The versions form a stamp
+that can be stored: as long as the stamp does not change, the packages do not need to be checked again.
+The heavy imports can be done in advance in a background thread (warmUp).
+"""
+import importlib.util
+import sys
+import threading
+import time
+
+# (module imported by the segmentation, package installed with pip)
+REQUIRED_PACKAGES = [
+  ('skimage', 'scikit-image'),
+  ('sklearn', 'scikit-learn'),
+  ('tisseglibrary', 'TisSegLibrary'),
+  ]
+
+# Modules imported by the segmentation, in the order they are warmed up
+HEAVY_MODULES = ['numpy', 'SimpleITK', 'skimage', 'sklearn', 'tisseglibrary.tisseglibrary']
+
+
+def packageVersion(packageName):
+  """
+  Installed version of a package, or None if it is not installed.
+  """
+  from importlib import metadata
+  try:
+    return metadata.version(packageName)
+  except metadata.PackageNotFoundError:
+    return None
+
+
+def stamp():
+  """
+  Text identifying the Python version and the installed versions of the required packages.
+  """
+  versions = ['{0}={1}'.format(packageName, packageVersion(packageName)) for _, packageName in REQUIRED_PACKAGES]
+  return 'python={0};'.format(sys.version.split()[0]) + ';'.join(versions)
+
+
+def missingPackages():
+  """
+  Packages (pip names) whose module cannot be found.
+  """
+  return [packageName for moduleName, packageName in REQUIRED_PACKAGES if importlib.util.find_spec(moduleName) is None]
+
+
+def warmUp(onFinished=None):
+  """
+  Import the heavy modules in a daemon thread. onFinished(seconds) is called from that thread
+  with the import time of each module. Returns the thread.
+  """
+  def importModules():
+    seconds = {}
+    for moduleName in HEAVY_MODULES:
+      startTime = time.perf_counter()
+      try:
+        importlib.import_module(moduleName)
+      except Exception:
+        # The error is reported when the module is really needed
+        pass
+      seconds[moduleName] = time.perf_counter() - startTime
+    if onFinished:
+      onFinished(seconds)
+
+  thread = threading.Thread(target=importModules, name='Tis_SegWarmUp', daemon=True)
+  thread.start()
+  return thread
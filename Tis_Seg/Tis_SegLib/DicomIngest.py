@@ -0,0 +1,344 @@
+"""
+Ingest of Dixon DICOM studies: index the headers of a folder tree, pair the water and fat series of each
+acquisition and load only their voxels.
+
+Only the headers of the files are read (in parallel threads), and they are kept in a SQLite index with the
+size and modification time of each file. When the folder tree is scanned again, every file is listed and its
+size and modification time are compared with the index (a file rewritten in place does not change the
+modification time of its folder), and only new or modified files are read. The series of an acquisition share the study, the frame of reference and the
+voxel grid; their Dixon contrast (water, fat, in phase, out of phase) is recognized from the image type and
+the series description. The water and fat volumes can then be loaded in the scene or written, with a manifest,
+for BatchProcessing.
+
+Run it from the command line with:
+
+  Slicer --no-main-window --python-script Tis_SegLib/DicomIngest.py --dicom-dir incoming --output-dir studies --region thigh
+"""
+import argparse
+import concurrent.futures
+import csv
+import os
+import re
+import sqlite3
+import sys
+import time
+
+if __name__ == "__main__":
+  # Make Tis_SegLib importable when this file is run with --python-script
+  sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Tis_SegLib import BatchProcessing
+from Tis_SegLib import Pipeline
+
+DEFAULT_INDEX_NAME = 'dicom_index.sqlite'
+
+# Header fields kept in the index: DICOM tag (group|element as read by GDCM)
+HEADER_TAGS = {
+  'patient': '0010|0020',
+  'study': '0020|000d',
+  'studyDate': '0008|0020',
+  'series': '0020|000e',
+  'seriesNumber': '0020|0011',
+  'description': '0008|103e',
+  'imageType': '0008|0008',
+  'frame': '0020|0052',
+  'instance': '0020|0013',
+  'position': '0020|0032',
+  'orientation': '0020|0037',
+  'rows': '0028|0010',
+  'columns': '0028|0011',
+  }
+
+FIELDS = list(HEADER_TAGS)
+
+# Dixon contrasts, with the values of ImageType and the words of the series description that identify them
+DIXON_CONTRASTS = {
+  'water': ({'W', 'WATER'}, {'W', 'WATER'}),
+  'fat': ({'F', 'FAT'}, {'F', 'FAT'}),
+  'inPhase': ({'IP', 'IN_PHASE'}, {'IN', 'INP', 'IN_PHASE', 'INPHASE'}),
+  'outPhase': ({'OP', 'OUT_PHASE', 'OPP_PHASE'}, {'OUT', 'OPP', 'OUT_PHASE', 'OPP_PHASE', 'OUTPHASE', 'OPPPHASE'}),
+  }
+
+# Words of the series descriptions of fat-suppressed series, which are not Dixon fat images
+FAT_SUPPRESSION_WORDS = {'SAT', 'FS', 'FATSAT', 'FAT_SAT', 'SPAIR', 'STIR'}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (
+  path TEXT PRIMARY KEY,
+  mtime INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+  path TEXT PRIMARY KEY,
+  directory TEXT NOT NULL,
+  size INTEGER NOT NULL,
+  mtime INTEGER NOT NULL,
+  {0}
+);
+CREATE INDEX IF NOT EXISTS filesDirectory ON files (directory);
+""".format(',\n  '.join(field + ' TEXT' for field in FIELDS))
+
+
+def readHeader(path):
+  """
+  Header fields (see HEADER_TAGS) of a DICOM file, read without its voxels, or None if it is not an image.
+  """
+  import SimpleITK as sitk
+
+  reader = sitk.ImageFileReader()
+  reader.SetImageIO('GDCMImageIO')
+  reader.SetFileName(path)
+  try:
+    reader.ReadImageInformation()
+  except RuntimeError:
+    return None
+  header = {field: reader.GetMetaData(tag).strip() if reader.HasMetaDataKey(tag) else '' for field, tag in HEADER_TAGS.items()}
+  return header if header['series'] else None
+
+
+def dixonContrast(imageType, description):
+  """
+  Dixon contrast of a series ('water', 'fat', 'inPhase' or 'outPhase') from its ImageType and
+  SeriesDescription, or None if it cannot be recognized.
+  """
+  values = {value.strip().upper() for value in imageType.split('\\')}
+  for contrast, (imageTypes, _) in DIXON_CONTRASTS.items():
+    if values & imageTypes:
+      return contrast
+  words = set(re.split(r'[^A-Z_]+', description.upper().replace('-', '_'))) | set(re.split(r'[^A-Z]+', description.upper()))
+  if words & FAT_SUPPRESSION_WORDS:
+    return None
+  for contrast, (_, descriptionWords) in DIXON_CONTRASTS.items():
+    if words & descriptionWords:
+      return contrast
+  return None
+
+
+def _vector(text):
+  try:
+    return [float(value) for value in text.split('\\')]
+  except ValueError:
+    return []
+
+
+def _slicePosition(header):
+  """
+  Position of a slice along the normal of its plane (used to sort the files of a series).
+  """
+  position = _vector(header['position'])
+  orientation = _vector(header['orientation'])
+  if len(position) != 3 or len(orientation) != 6:
+    return float(header['instance'] or 0)
+  row, column = orientation[:3], orientation[3:]
+  normal = [row[1] * column[2] - row[2] * column[1], row[2] * column[0] - row[0] * column[2], row[0] * column[1] - row[1] * column[0]]
+  return sum(p * n for p, n in zip(position, normal))
+
+
+class DicomIndex:
+  """
+  Index of the DICOM headers of folder trees, stored in a SQLite database.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.connection = sqlite3.connect(path, timeout=30)
+    self.connection.executescript(SCHEMA)
+
+  def close(self):
+    self.connection.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def scan(self, root, numberOfWorkers=None):
+    """
+    Update the index with the files of a folder tree, reading the headers of the new and modified files
+    (other size or modification time) in numberOfWorkers threads.
+    Returns the number of files read and of files taken from the index.
+    """
+    root = os.path.abspath(root)
+    prefix = os.path.join(root, '')
+    knownDirectories = dict(self.connection.execute('SELECT path, mtime FROM directories WHERE path = ? OR substr(path, 1, ?) = ?',
+      (root, len(prefix), prefix)))
+    toRead = []
+    seenDirectories = []
+    cached = 0
+    for directory, subdirectories, fileNames in os.walk(root):
+      seenDirectories.append((directory, os.stat(directory).st_mtime_ns))
+      known = {path: (size, fileMtime) for path, size, fileMtime in
+        self.connection.execute('SELECT path, size, mtime FROM files WHERE directory = ?', (directory,))}
+      current = set()
+      for fileName in fileNames:
+        path = os.path.join(directory, fileName)
+        try:
+          stat = os.stat(path)
+        except OSError:
+          continue
+        current.add(path)
+        if known.get(path) == (stat.st_size, stat.st_mtime_ns):
+          cached += 1
+        else:
+          toRead.append((path, directory, stat.st_size, stat.st_mtime_ns))
+      removed = [(path,) for path in known if path not in current]
+      self.connection.executemany('DELETE FROM files WHERE path = ?', removed)
+
+    seenPaths = {path for path, _ in seenDirectories}
+    removedDirectories = [(path,) for path in knownDirectories if path not in seenPaths]
+    self.connection.executemany('DELETE FROM files WHERE directory = ?', removedDirectories)
+    self.connection.executemany('DELETE FROM directories WHERE path = ?', removedDirectories)
+
+    with concurrent.futures.ThreadPoolExecutor(numberOfWorkers or min(32, (os.cpu_count() or 1) * 4)) as executor:
+      headers = executor.map(readHeader, [path for path, _, _, _ in toRead], chunksize=64)
+      rows = []
+      for (path, directory, size, mtime), header in zip(toRead, headers):
+        # Files that are not DICOM images are indexed too, so they are not read again
+        header = header or dict.fromkeys(FIELDS)
+        rows.append((path, directory, size, mtime) + tuple(header[field] for field in FIELDS))
+    self.connection.executemany('INSERT OR REPLACE INTO files (path, directory, size, mtime, {0}) VALUES ({1})'.format(
+      ', '.join(FIELDS), ', '.join('?' * (len(FIELDS) + 4))), rows)
+    self.connection.executemany('INSERT OR REPLACE INTO directories (path, mtime) VALUES (?, ?)', seenDirectories)
+    self.connection.commit()
+    return len(toRead), cached
+
+  def series(self, root):
+    """
+    Series of the DICOM images of a folder tree (scanned before). Each series is a dictionary with the header
+    fields of its first slice, its Dixon 'contrast' and its 'files' sorted along the slice normal.
+    """
+    root = os.path.abspath(root)
+    prefix = os.path.join(root, '')
+    rows = self.connection.execute('SELECT path, {0} FROM files WHERE series IS NOT NULL AND (directory = ? OR substr(directory, 1, ?) = ?)'.format(
+      ', '.join(FIELDS)), (root, len(prefix), prefix))
+    slices = {}
+    for row in rows:
+      header = dict(zip(FIELDS, row[1:]))
+      slices.setdefault(header['series'], []).append((_slicePosition(header), row[0], header))
+    seriesList = []
+    for uid, seriesSlices in slices.items():
+      seriesSlices.sort(key=lambda item: item[0])
+      series = dict(seriesSlices[0][2])
+      series['files'] = [path for _, path, _ in seriesSlices]
+      series['firstPosition'] = seriesSlices[0][0]
+      series['lastPosition'] = seriesSlices[-1][0]
+      series['contrast'] = dixonContrast(series['imageType'], series['description'])
+      seriesList.append(series)
+    seriesList.sort(key=lambda series: (series['patient'], series['studyDate'], series['study'], int(float(series['seriesNumber'] or 0))))
+    return seriesList
+
+
+def acquisitionKey(series):
+  """
+  Series with the same key were acquired together: same study, frame of reference and voxel grid.
+  """
+  orientation = tuple(round(value, 3) for value in _vector(series['orientation']))
+  return (series['patient'], series['study'], series['frame'], series['rows'], series['columns'], orientation,
+    len(series['files']), round(series['firstPosition'], 1), round(series['lastPosition'], 1))
+
+
+def pairSeries(seriesList):
+  """
+  Group the Dixon series by acquisition. Returns the acquisitions that have a water and a fat series, as
+  dictionaries with the 'water', 'fat', 'inPhase' and 'outPhase' series (None if missing) and an 'id'.
+  If an acquisition has several series of one contrast, the one with the lowest series number is used.
+  """
+  acquisitions = {}
+  for series in seriesList:
+    if series['contrast'] is None:
+      continue
+    acquisition = acquisitions.setdefault(acquisitionKey(series), dict.fromkeys(DIXON_CONTRASTS))
+    if acquisition[series['contrast']] is None:
+      acquisition[series['contrast']] = series
+
+  paired = []
+  for acquisition in acquisitions.values():
+    if acquisition['water'] is None or acquisition['fat'] is None:
+      continue
+    water = acquisition['water']
+    name = '_'.join(part for part in (water['patient'], water['studyDate'], water['seriesNumber']) if part)
+    acquisition['id'] = re.sub(r'[^A-Za-z0-9._-]+', '_', name) or water['series']
+    paired.append(acquisition)
+  return paired
+
+
+def loadSeries(series):
+  """
+  Read the voxels of a series (SimpleITK image).
+  """
+  import SimpleITK as sitk
+
+  reader = sitk.ImageSeriesReader()
+  reader.SetImageIO('GDCMImageIO')
+  reader.SetFileNames(series['files'])
+  return reader.Execute()
+
+
+def ingest(root, indexPath, numberOfWorkers=None):
+  """
+  Index the DICOM headers of a folder tree and return its paired Dixon acquisitions (see pairSeries).
+  """
+  with DicomIndex(indexPath) as index:
+    index.scan(root, numberOfWorkers)
+    return pairSeries(index.series(root))
+
+
+def writeStudies(acquisitions, outputDirectory, region=Pipeline.THIGH):
+  """
+  Load the water and fat series of each acquisition and write them as NRRD files (uncompressed, so that
+  StreamProcessing can map them). Returns the manifest entries of the studies (see BatchProcessing).
+  """
+  import SimpleITK as sitk
+
+  if not os.path.isdir(outputDirectory):
+    os.makedirs(outputDirectory)
+  studies = []
+  for acquisition in acquisitions:
+    study = {'id': acquisition['id'], 'region': region}
+    for contrast in ('water', 'fat'):
+      path = os.path.join(outputDirectory, '{0}_{1}.nrrd'.format(acquisition['id'], contrast))
+      sitk.WriteImage(loadSeries(acquisition[contrast]), path)
+      study[contrast] = path
+    studies.append(study)
+  return studies
+
+
+def writeManifest(studies, manifestPath):
+  with open(manifestPath, 'w', newline='') as manifestFile:
+    writer = csv.DictWriter(manifestFile, BatchProcessing.MANIFEST_FIELDS)
+    writer.writeheader()
+    writer.writerows(studies)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Pair the Dixon water and fat series of a DICOM folder tree and prepare them for batch processing.')
+  parser.add_argument('--dicom-dir', required=True, help='Folder tree with the DICOM files')
+  parser.add_argument('--output-dir', required=True, help='Folder where the water and fat volumes and studies.csv are written')
+  parser.add_argument('--region', choices=[Pipeline.THIGH, Pipeline.ABDOMEN], default=Pipeline.THIGH, help='Region of the studies')
+  parser.add_argument('--index', default=None, help='Header index (default: {0} in the output folder)'.format(DEFAULT_INDEX_NAME))
+  parser.add_argument('--workers', type=int, default=None, help='Number of threads that read the headers')
+  parser.add_argument('--list', action='store_true', help='Only list the paired acquisitions, without loading them')
+  args = parser.parse_args(argv)
+
+  if not os.path.isdir(args.output_dir):
+    os.makedirs(args.output_dir)
+  startTime = time.perf_counter()
+  with DicomIndex(args.index or os.path.join(args.output_dir, DEFAULT_INDEX_NAME)) as index:
+    read, cached = index.scan(args.dicom_dir, args.workers)
+    seriesList = index.series(args.dicom_dir)
+  acquisitions = pairSeries(seriesList)
+  print('Indexed {0} files ({1} read, {2} from the index) in {3:.1f} s: {4} series, {5} water/fat pairs'.format(
+    read + cached, read, cached, time.perf_counter() - startTime, len(seriesList), len(acquisitions)))
+  for acquisition in acquisitions:
+    print('{0}: water {1}, fat {2}'.format(acquisition['id'], acquisition['water']['description'], acquisition['fat']['description']))
+  if args.list or not acquisitions:
+    return 0
+
+  manifestPath = os.path.join(args.output_dir, 'studies.csv')
+  writeManifest(writeStudies(acquisitions, args.output_dir, args.region), manifestPath)
+  print('Wrote ' + manifestPath)
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
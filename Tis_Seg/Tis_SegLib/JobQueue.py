@@ -0,0 +1,178 @@
+"""
+Persistent queue of the studies of a cohort run, so that an interrupted run resumes where it stopped.
+
+The queue is a SQLite database (by default jobs.sqlite in the output folder) with one row per study:
+its inputs and parameters, the settings of the run (output format, quantification...), its state (pending, running, done or failed), the number of attempts,
+its output paths and its start and finish times. A study is only marked done after all its outputs
+are written, and every output is written to a temporary file that is renamed when complete (atomicPath),
+so a crash leaves either the previous file or the new one, never a partial one. Studies left running by
+an interrupted run are set back to pending when the queue is opened again. A study is computed again
+only if it is not done or if its inputs, parameters or the settings of the run changed.
+"""
+import contextlib
+import json
+import os
+import sqlite3
+import time
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+DEFAULT_QUEUE_NAME = 'jobs.sqlite'
+
+# Prefix of the files being written, they are renamed to their final name when complete
+PARTIAL_PREFIX = '.partial-'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+  id TEXT PRIMARY KEY,
+  position INTEGER NOT NULL,
+  region TEXT,
+  study TEXT NOT NULL,
+  settings TEXT,
+  status TEXT NOT NULL,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  outputs TEXT,
+  record TEXT,
+  error TEXT,
+  startTime REAL,
+  finishTime REAL,
+  seconds REAL
+)
+"""
+
+
+@contextlib.contextmanager
+def atomicPath(path):
+  """
+  Yield a temporary path (same folder and extension as path) to write a file to. When the block ends
+  without error the file is flushed to disk and renamed to path, otherwise it is removed.
+  """
+  directory, name = os.path.split(path)
+  partialPath = os.path.join(directory, PARTIAL_PREFIX + name)
+  try:
+    yield partialPath
+    fileDescriptor = os.open(partialPath, os.O_RDWR)
+    try:
+      os.fsync(fileDescriptor)
+    finally:
+      os.close(fileDescriptor)
+    os.replace(partialPath, path)
+  except BaseException:
+    if os.path.exists(partialPath):
+      os.remove(partialPath)
+    raise
+
+
+def _toJson(value):
+  def default(item):
+    # NumPy scalars (flags of the thigh results)
+    if hasattr(item, 'item'):
+      return item.item()
+    return str(item)
+  return json.dumps(value, sort_keys=True, default=default)
+
+
+class JobQueue:
+  """
+  Jobs of a cohort run stored in a SQLite database. Only one run should use a queue at a time.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    # Autocommit, the changes of several rows are grouped in explicit transactions
+    self.connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+    self.connection.execute('PRAGMA journal_mode=WAL')
+    self.connection.execute('PRAGMA synchronous=FULL')
+    self.connection.execute(SCHEMA)
+
+  def close(self):
+    self.connection.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  @contextlib.contextmanager
+  def _transaction(self):
+    self.connection.execute('BEGIN IMMEDIATE')
+    try:
+      yield
+    except BaseException:
+      self.connection.execute('ROLLBACK')
+      raise
+    self.connection.execute('COMMIT')
+
+  def add(self, studies, settings=None, retryFailed=False):
+    """
+    Add normalized studies (see BatchProcessing.readManifest) to be processed with settings (dictionary of the
+    options that change the outputs). Studies already in the queue keep their state, unless their inputs,
+    parameters or settings changed (or they failed and retryFailed is True): they are pending again.
+    Studies left running by an interrupted run are pending again.
+    """
+    ids = [study['id'] for study in studies]
+    duplicates = sorted({studyId for studyId in ids if ids.count(studyId) > 1})
+    if duplicates:
+      raise ValueError('The study ids must be unique to queue them: ' + ', '.join(duplicates))
+
+    settingsJson = _toJson(settings or {})
+    with self._transaction():
+      self.connection.execute('UPDATE jobs SET status = ? WHERE status = ?', (PENDING, RUNNING))
+      for position, study in enumerate(studies):
+        studyJson = _toJson(study)
+        row = self.connection.execute('SELECT study, settings, status FROM jobs WHERE id = ?', (study['id'],)).fetchone()
+        if row is None:
+          self.connection.execute('INSERT INTO jobs (id, position, region, study, settings, status) VALUES (?, ?, ?, ?, ?, ?)',
+            (study['id'], position, study['region'], studyJson, settingsJson, PENDING))
+        elif (row[0], row[1]) != (studyJson, settingsJson) or (retryFailed and row[2] == FAILED):
+          self.connection.execute('UPDATE jobs SET position = ?, region = ?, study = ?, settings = ?, status = ?, outputs = NULL, '
+            'record = NULL, error = NULL WHERE id = ?', (position, study['region'], studyJson, settingsJson, PENDING, study['id']))
+        else:
+          self.connection.execute('UPDATE jobs SET position = ? WHERE id = ?', (position, study['id']))
+
+  def studies(self, status=PENDING):
+    """
+    Studies with a given state, in manifest order.
+    """
+    rows = self.connection.execute('SELECT study FROM jobs WHERE status = ? ORDER BY position', (status,))
+    return [json.loads(row[0]) for row in rows]
+
+  def start(self, studyId):
+    self.connection.execute('UPDATE jobs SET status = ?, attempts = attempts + 1, startTime = ?, finishTime = NULL WHERE id = ?',
+      (RUNNING, time.time(), studyId))
+
+  def finish(self, record):
+    """
+    Store the record of a processed study (see BatchProcessing.processStudy). Its outputs must be written.
+    """
+    status = DONE if record['status'] == 'done' else FAILED
+    self.connection.execute('UPDATE jobs SET status = ?, outputs = ?, record = ?, error = ?, finishTime = ?, seconds = ? WHERE id = ?',
+      (status, _toJson(record['outputs']), _toJson(record), record.get('error'), time.time(), record.get('seconds'), record['id']))
+
+  def records(self, statuses=(DONE, FAILED)):
+    """
+    Records of the processed studies with the given states, in manifest order.
+    """
+    rows = self.connection.execute('SELECT record FROM jobs WHERE status IN ({0}) AND record IS NOT NULL ORDER BY position'.format(
+      ', '.join('?' * len(statuses))), tuple(statuses))
+    return [json.loads(row[0]) for row in rows]
+
+  def counts(self):
+    """
+    Number of studies in each state.
+    """
+    counts = {PENDING: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+    counts.update(dict(self.connection.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status')))
+    return counts
+
+  def claim(self, studies):
+    """
+    Yield the studies one by one, marking each as running when it is taken.
+    """
+    for study in studies:
+      self.start(study['id'])
+      yield study
@@ -0,0 +1,298 @@
+"""
+Parallel segmentation of independent studies in a pool of worker processes.
+
+Each worker reads the input images of its study and writes its own outputs, so image loading and
+result writing is spread over the workers instead of going through the main process.
+When the images are already in memory (segmentImages), they are handed over in shared memory:
+only the name of the memory block and the image geometry are pickled.
+"""
+import concurrent.futures
+import multiprocessing
+import os
+import sys
+
+from Tis_SegLib import BatchProcessing
+from Tis_SegLib import Pipeline
+from Tis_SegLib import Scheduling
+
+
+class SharedImage:
+  """
+  Picklable handle to the voxels and geometry of a SimpleITK image (or Pipeline.SlabImage) stored in a
+  shared memory block. The process that creates the block must call release() once the image is not needed anymore.
+  """
+
+  def __init__(self, name, shape, dtype, isVector, spacing, origin, direction):
+    self.name = name
+    self.shape = tuple(shape)
+    self.dtype = dtype
+    self.isVector = isVector
+    self.spacing = spacing
+    self.origin = origin
+    self.direction = direction
+    # Position of the slab in the whole volume, if the image is a SlabImage
+    self.slabFirst = None
+    self.volumeSize = None
+    self._sharedMemory = None
+
+  @classmethod
+  def fromImage(cls, image):
+    """
+    Copy the voxels of a SimpleITK image or SlabImage to a new shared memory block.
+    """
+    import numpy as np
+    import SimpleITK as sitk
+    from multiprocessing import shared_memory
+
+    if isinstance(image, Pipeline.SlabImage):
+      handle = cls.fromImage(image.slab)
+      handle.slabFirst = image.first
+      handle.volumeSize = image.GetSize()
+      return handle
+
+    array = sitk.GetArrayViewFromImage(image)
+    sharedMemory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, array.dtype, buffer=sharedMemory.buf)[...] = array
+    handle = cls(sharedMemory.name, array.shape, array.dtype.str, image.GetNumberOfComponentsPerPixel() > 1,
+      image.GetSpacing(), image.GetOrigin(), image.GetDirection())
+    handle._sharedMemory = sharedMemory
+    return handle
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['_sharedMemory'] = None
+    return state
+
+  def toImage(self):
+    """
+    Create a SimpleITK image (or SlabImage) from the shared voxels.
+    """
+    import numpy as np
+    import SimpleITK as sitk
+    from multiprocessing import shared_memory
+
+    sharedMemory = self._sharedMemory or shared_memory.SharedMemory(name=self.name)
+    try:
+      image = sitk.GetImageFromArray(np.ndarray(self.shape, np.dtype(self.dtype), buffer=sharedMemory.buf), isVector=self.isVector)
+    finally:
+      if sharedMemory is not self._sharedMemory:
+        sharedMemory.close()
+    image.SetSpacing(self.spacing)
+    image.SetOrigin(self.origin)
+    image.SetDirection(self.direction)
+    if self.slabFirst is not None:
+      return Pipeline.SlabImage(image, self.slabFirst, self.volumeSize)
+    return image
+
+  def release(self):
+    """
+    Free the shared memory block.
+    """
+    from multiprocessing import shared_memory
+
+    sharedMemory = self._sharedMemory or shared_memory.SharedMemory(name=self.name)
+    self._sharedMemory = None
+    sharedMemory.close()
+    sharedMemory.unlink()
+
+
+def shareJob(job):
+  """
+  Copy the images of a segmentation job to shared memory.
+  Returns the job to send to a worker and the handles of the input images, to be released when the job is done.
+  """
+  handles = {key: SharedImage.fromImage(job[key]) for key in ('fat', 'water', 'roi', 'master') if job.get(key) is not None}
+  workerJob = {
+    'region': job['region'],
+    'images': handles,
+    'RangeSlice': [int(job['RangeSlice'][0]), int(job['RangeSlice'][1])],
+    'partitions': job['partitions'],
+    'incomplete': job.get('incomplete', False),
+    }
+  return workerJob, handles
+
+
+def unshareResult(sharedResult):
+  """
+  Convert the shared images of a result returned by a worker to SimpleITK images and release them.
+  """
+  result = {}
+  for key, value in sharedResult.items():
+    if isinstance(value, SharedImage):
+      image = value.toImage()
+      value.release()
+      value = image
+    result[key] = value
+  return result
+
+
+def _initializeWorker(threadsPerWorker):
+  Scheduling.limitThreads(threadsPerWorker)
+
+
+def _processStudy(study, outputDirectory, quantify=False, options=None):
+  # Segmentations need the Slicer application, they are written by the main process
+  return BatchProcessing.processStudy(study, outputDirectory, writeSegmentations=False, quantify=quantify, options=options)
+
+
+def _segmentImages(job, report=None):
+  """
+  Segment a job made by shareJob. report(stage) is called when a stage starts.
+  If the job has 'quantify' set, the quantification rows of all the outputs are returned in result['quantification'].
+  """
+  report = report or (lambda stage: None)
+  report('Reading the inputs')
+  images = {key: handle.toImage() for key, handle in job['images'].items()}
+  report('Segmenting')
+  if job['region'] == Pipeline.THIGH:
+    result = Pipeline.segmentThigh(images['fat'], images['water'], job['RangeSlice'], job['partitions'],
+      job['incomplete'], images.get('master'))
+  else:
+    result = Pipeline.segmentAbdomen(images['fat'], images['water'], images['roi'], job['RangeSlice'], job['partitions'])
+  if job.get('quantify'):
+    from Tis_SegLib import Quantification
+    report('Quantifying')
+    quantifiedJob = {'region': job['region'], 'fat': images['fat'], 'water': images['water'], 'RangeSlice': job['RangeSlice'],
+      'partitions': job['partitions']}
+    result['quantification'] = Quantification.quantifyResult(quantifiedJob, result,
+      [key[len('out_'):] for key in result if key.startswith('out_')])
+  del images
+
+  # The worker creates the output blocks, the main process releases them
+  report('Sending the result')
+  sharedResult = {}
+  for key, value in result.items():
+    if hasattr(value, 'GetPixelID'):
+      handle = SharedImage.fromImage(value)
+      handle._sharedMemory.close()
+      handle._sharedMemory = None
+      value = handle
+    sharedResult[key] = value
+  return sharedResult
+
+
+def multiprocessingContext():
+  """
+  Return the 'spawn' multiprocessing context. Inside the Slicer application the workers are
+  started with the PythonSlicer interpreter instead of the application executable.
+  """
+  context = multiprocessing.get_context('spawn')
+  executableDirectory, executableName = os.path.split(sys.executable)
+  if not executableName.lower().startswith('python'):
+    pythonSlicer = os.path.join(executableDirectory, 'PythonSlicer' + ('.exe' if sys.platform == 'win32' else ''))
+    if os.path.exists(pythonSlicer):
+      context.set_executable(pythonSlicer)
+  return context
+
+
+class ParallelRunner:
+  """
+  Segment independent studies in a pool of worker processes.
+  numberOfWorkers defaults to the number of physical cores. If ordered is True the results are delivered in the
+  order the studies were given, otherwise as soon as each study finishes.
+  A job is only started while the estimated peak memory of the running jobs fits memoryBudget (bytes, by default
+  a fraction of the available memory, see Scheduling); a job larger than the budget runs alone.
+  """
+
+  def __init__(self, numberOfWorkers=None, ordered=True, threadsPerWorker=None, memoryBudget=None):
+    self.numberOfWorkers = max(1, numberOfWorkers or Scheduling.physicalCores())
+    self.ordered = ordered
+    # Share the cores between the workers so that the ITK, OpenMP and BLAS threads do not oversubscribe the machine
+    self.threadsPerWorker = threadsPerWorker or Scheduling.threadsPerWorker(self.numberOfWorkers)
+    self.memoryBudget = memoryBudget or Scheduling.defaultMemoryBudget()
+
+  def _executor(self):
+    return concurrent.futures.ProcessPoolExecutor(max_workers=self.numberOfWorkers, mp_context=multiprocessingContext(),
+      initializer=_initializeWorker, initargs=(self.threadsPerWorker,))
+
+  def _schedule(self, items, submit, estimateMemory):
+    """
+    Submit the items (submit(index, item) returns a future) in order, one per free worker and while the
+    estimated memory of the running items fits the budget. Yield (index, future) pairs of the finished
+    items in submission or completion order.
+    """
+    budget = None
+    if self.memoryBudget is not None:
+      budget = self.memoryBudget - self.numberOfWorkers * Scheduling.WORKER_MEMORY
+    pending = iter(enumerate(items))
+    nextItem = next(pending, None)
+    running = {}
+    finished = {}
+    usedMemory = 0
+    deliverIndex = 0
+    while nextItem is not None or running:
+      while nextItem is not None and len(running) < self.numberOfWorkers:
+        index, item = nextItem
+        memory = estimateMemory(item)
+        if running and budget is not None and usedMemory + memory > budget:
+          break
+        running[submit(index, item)] = (index, memory)
+        usedMemory += memory
+        nextItem = next(pending, None)
+
+      done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+      for future in done:
+        index, memory = running.pop(future)
+        usedMemory -= memory
+        if self.ordered:
+          finished[index] = future
+        else:
+          yield index, future
+      while deliverIndex in finished:
+        yield deliverIndex, finished.pop(deliverIndex)
+        deliverIndex += 1
+
+  def processStudies(self, studies, outputDirectory, writeSegmentations=False, quantify=False, options=None):
+    """
+    Segment normalized studies (see BatchProcessing.readManifest) and write their outputs to outputDirectory.
+    Yields the record of each study. Segmentations are written in this process since they need the scene.
+    """
+    if not os.path.isdir(outputDirectory):
+      os.makedirs(outputDirectory)
+    with self._executor() as executor:
+      submit = lambda index, study: executor.submit(_processStudy, study, outputDirectory, quantify, options)
+      for index, future in self._schedule(studies, submit, Scheduling.studyMemory):
+        record = future.result()
+        if writeSegmentations and record['status'] == 'done':
+          try:
+            BatchProcessing.writeStudySegmentations(record, outputDirectory)
+          except Exception as e:
+            record['status'] = 'failed'
+            record['error'] = str(e)
+        yield record
+
+  def segmentImages(self, jobs):
+    """
+    Segment images that are already in memory. Each job is a dictionary with the keys
+    'region', 'fat', 'water', 'RangeSlice', 'partitions' and, depending on the region,
+    'incomplete' and 'master' (thigh) or 'roi' (abdomen).
+    Yields (job index, result) where result is the dictionary returned by Pipeline.segmentThigh
+    or Pipeline.segmentAbdomen, or the exception raised by the worker.
+    """
+    with self._executor() as executor:
+      # The images of a job are copied to shared memory when it is submitted
+      inputHandles = {}
+
+      def submit(index, job):
+        workerJob, inputHandles[index] = shareJob(job)
+        return executor.submit(_segmentImages, workerJob)
+
+      try:
+        for index, future in self._schedule(jobs, submit, Scheduling.imagesMemory):
+          try:
+            sharedResult = future.result()
+          except Exception as e:
+            sharedResult = e
+          for handle in inputHandles.pop(index).values():
+            handle.release()
+          if isinstance(sharedResult, Exception):
+            yield index, sharedResult
+            continue
+          yield index, unshareResult(sharedResult)
+      finally:
+        for handles in inputHandles.values():
+          for handle in handles.values():
+            try:
+              handle.release()
+            except FileNotFoundError:
+              pass
@@ -0,0 +1,147 @@
+"""
+Incremental segmentation of a single study in chunks of partitions, which can run in parallel worker processes.
+
+A chunked run does not give the same labelmaps as a serial run of tisseglibrary, not only close to the
+chunk boundaries:
+- the K-Means of each partition is initialized with the centroids of the previous one, so every chunk
+  starts from other centroids than in the serial run;
+- the K-Means groups are made of the masked voxels of the whole range split in equal parts, and the first
+  and last 10% of the slices of the volume are split further, so the groups depend on the whole range;
+- the thigh masks (opening by reconstruction, connected components, watershed) and the Otsu threshold of
+  the abdomen are computed on the whole slab.
+A margin of MORPHOLOGY_MARGIN slices around each chunk only reduces these differences. segmentInChunks
+therefore only splits a study in incremental mode, which is an approximation that has to be requested,
+and segments it serially otherwise. When the range fits in a single chunk, the chunk is the whole range
+and the result is the serial one.
+
+In incremental mode the chunks have a fixed size counted from the first slice of the range, and the result
+of each chunk is stored in a ResultCache under the hash of its own inputs (slices with margins, ROI and
+settings). When the range is widened or a few slices of the ROI are edited, only the chunks whose inputs
+changed are segmented again and the stored ones are stitched with them.
+"""
+from Tis_SegLib import ParallelProcessing
+from Tis_SegLib import Pipeline
+from Tis_SegLib import ResultCache
+
+# Slices of context needed by the morphological operations of the library (largest kernel radius is 7)
+MORPHOLOGY_MARGIN = 8
+
+# Minimum number of slices of a chunk in incremental mode
+INCREMENTAL_CHUNK_SLICES = 30
+
+
+def incrementalChunkRanges(RangeSlice, numberOfPartitions, chunkSlices=INCREMENTAL_CHUNK_SLICES):
+  """
+  Split RangeSlice in chunks of the same number of whole partitions (at least chunkSlices slices),
+  so that the chunks do not move when the end of the range changes.
+  """
+  first, stop = int(RangeSlice[0]), int(RangeSlice[1])
+  partitionSize = max(1, int(numberOfPartitions))
+  chunkSize = -(-int(chunkSlices) // partitionSize) * partitionSize
+  bounds = list(range(first, stop - partitionSize + 1, chunkSize)) or [first]
+  # The last chunk also takes the slices that do not fill a whole chunk
+  if len(bounds) > 1 and stop - bounds[-1] < chunkSize:
+    bounds.pop()
+  bounds.append(stop)
+  return [(bounds[chunk], bounds[chunk + 1]) for chunk in range(len(bounds) - 1)]
+
+
+def chunkMargin(numberOfPartitions):
+  """
+  Number of slices added on each side of a chunk: the smallest number of whole partitions covering MORPHOLOGY_MARGIN.
+  """
+  partitionSize = max(1, int(numberOfPartitions))
+  return -(-MORPHOLOGY_MARGIN // partitionSize) * partitionSize
+
+
+def _subSlab(image, first, last):
+  if image is None:
+    return None
+  if not isinstance(image, Pipeline.SlabImage):
+    image = Pipeline.slabFromImage(image, [first, last])
+  return Pipeline.SlabImage(image[:, :, first:last], first, image.GetSize())
+
+
+def _stitch(images, crops):
+  """
+  Concatenate along K the [start, stop) slices (relative to each image) of the chunk outputs.
+  """
+  import numpy as np
+  import SimpleITK as sitk
+
+  pieces = [image[:, :, start:stop] for image, (start, stop) in zip(images, crops)]
+  arrays = [sitk.GetArrayViewFromImage(piece) for piece in pieces]
+  dtype = np.result_type(*[array.dtype for array in arrays])
+  stitched = sitk.GetImageFromArray(np.concatenate([array.astype(dtype, copy=False) for array in arrays]))
+  stitched.SetSpacing(pieces[0].GetSpacing())
+  stitched.SetOrigin(pieces[0].GetOrigin())
+  stitched.SetDirection(pieces[0].GetDirection())
+  return stitched
+
+
+def segmentInChunks(job, numberOfWorkers, runner=None, incremental=False, cache=None):
+  """
+  Segment a job (see ParallelRunner.segmentImages). If incremental is True the range is split in chunks of a
+  fixed size that are segmented over numberOfWorkers processes and, if a ResultCache is given, the chunks whose
+  inputs have not changed are taken from it. Otherwise the job is segmented serially, since a split run does not
+  give the serial result.
+  Returns the same dictionary as Pipeline.segmentThigh or Pipeline.segmentAbdomen.
+  """
+  RangeSlice = [int(job['RangeSlice'][0]), int(job['RangeSlice'][1])]
+  Pipeline.checkPartitions(RangeSlice, job['partitions'])
+  chunks = incrementalChunkRanges(RangeSlice, job['partitions']) if incremental else [tuple(RangeSlice)]
+  if len(chunks) == 1 and cache is None:
+    return Pipeline.segmentJob(job)
+
+  margin = chunkMargin(job['partitions'])
+  chunkJobs = []
+  crops = []
+  for first, last in chunks:
+    marginFirst = max(RangeSlice[0], first - margin)
+    marginLast = min(RangeSlice[1], last + margin)
+    chunkJob = dict(job)
+    chunkJob['RangeSlice'] = [marginFirst, marginLast]
+    for key in ('fat', 'water', 'roi', 'master'):
+      chunkJob[key] = _subSlab(job.get(key), marginFirst, marginLast)
+    chunkJobs.append(chunkJob)
+    crops.append((first - marginFirst, last - marginFirst))
+
+  results = [None] * len(chunkJobs)
+  keys = [None] * len(chunkJobs)
+  if cache is not None:
+    for index, chunkJob in enumerate(chunkJobs):
+      keys[index] = ResultCache.jobKey(chunkJob)
+      results[index] = cache.get(keys[index])
+
+  pending = [index for index, result in enumerate(results) if result is None]
+  if numberOfWorkers > 1 and len(pending) > 1:
+    runner = runner or ParallelProcessing.ParallelRunner(min(numberOfWorkers, len(pending)))
+    for index, result in runner.segmentImages([chunkJobs[index] for index in pending]):
+      if isinstance(result, Exception):
+        raise result
+      results[pending[index]] = result
+  else:
+    for index in pending:
+      results[index] = Pipeline.segmentJob(chunkJobs[index])
+
+  if cache is not None:
+    for index in pending:
+      cache.put(keys[index], results[index])
+
+  if job['region'] == Pipeline.ABDOMEN:
+    return {'out_Abdo': _stitch([result['out_Abdo'] for result in results], crops)}
+
+  flags = set((result['left_full_Q'], result['right_full_Q']) for result in results)
+  sums = set((result['sum_left'] == 0, result['sum_right'] == 0) for result in results)
+  if len(flags) > 1 or len(sums) > 1:
+    # The chunks took different paths in the library, their outputs cannot be stitched
+    return Pipeline.segmentJob(job)
+
+  return {
+    'out_l': _stitch([result['out_l'] for result in results], crops),
+    'out_r': _stitch([result['out_r'] for result in results], crops),
+    'left_full_Q': results[0]['left_full_Q'],
+    'right_full_Q': results[0]['right_full_Q'],
+    'sum_left': sum(result['sum_left'] for result in results),
+    'sum_right': sum(result['sum_right'] for result in results),
+    }
@@ -0,0 +1,278 @@
+"""
+Scene independent part of the thigh and abdomen segmentation.
+
+The functions in this file only work on SimpleITK images, so they are shared by
+Tis_SegLogic (which pulls the images from the MRML scene and pushes the results
+back) and by the batch processing (which reads and writes files).
+"""
+
+THIGH = "thigh"
+ABDOMEN = "abdomen"
+
+PARTITIONS_ERROR = 'The number of partitions is greater than the selected range of slices'
+
+# Added to the labels of the right thigh when both thighs are stored in one labelmap (see combineThighs)
+RIGHT_LABEL_OFFSET = 100
+
+
+class SlabImage:
+  """
+  Stand-in for a volume of which only the slices [first, last) are in memory.
+  tisseglibrary only reads the size of its input volumes and the slices of the selected range
+  (image[:,:,RangeSlice[0]:RangeSlice[1]]), so a SlabImage gives the same result as the whole volume
+  while memory and copies only depend on the range.
+  """
+
+  def __init__(self, slab, first, size):
+    self.slab = slab
+    self.first = int(first)
+    self.last = self.first + slab.GetSize()[2]
+    self.size = tuple(size)
+
+  def GetSize(self):
+    return self.size
+
+  def GetSpacing(self):
+    return self.slab.GetSpacing()
+
+  def GetDirection(self):
+    return self.slab.GetDirection()
+
+  def GetOrigin(self):
+    return self.slab.TransformIndexToPhysicalPoint((0, 0, -self.first))
+
+  def GetPixelID(self):
+    return self.slab.GetPixelID()
+
+  def TransformIndexToPhysicalPoint(self, index):
+    return self.slab.TransformIndexToPhysicalPoint((index[0], index[1], index[2] - self.first))
+
+  def CopyInformation(self, other):
+    """
+    Same as SimpleITK Image.CopyInformation, other is the whole volume (image or SlabImage).
+    """
+    if tuple(other.GetSize()) != self.size:
+      raise ValueError('Inconsistent image sizes: {0} and {1}'.format(self.size, tuple(other.GetSize())))
+    self.slab.SetSpacing(other.GetSpacing())
+    self.slab.SetDirection(other.GetDirection())
+    self.slab.SetOrigin(other.TransformIndexToPhysicalPoint((0, 0, self.first)))
+
+  def __getitem__(self, key):
+    if not isinstance(key, tuple) or len(key) != 3 or any(not isinstance(k, slice) for k in key) \
+        or any(k != slice(None) for k in key[:2]) or key[2].step not in (None, 1):
+      raise IndexError('Only image[:,:,first:last] is supported by SlabImage')
+    start, stop, _ = key[2].indices(self.size[2])
+    if start < self.first or stop > self.last:
+      raise IndexError('Slices [{0}, {1}) are not in memory, only [{2}, {3})'.format(start, stop, self.first, self.last))
+    return self.slab[:, :, start - self.first:stop - self.first]
+
+
+def slabRange(RangeSlice, numberOfSlices, margin=0):
+  """
+  Slices [first, last) that have to be in memory to segment RangeSlice, clamped to the volume.
+  """
+  first = max(0, int(RangeSlice[0]) - margin)
+  last = min(numberOfSlices, int(RangeSlice[1]) + margin)
+  return first, max(first, last)
+
+
+def slabFromImage(image, RangeSlice, margin=0):
+  """
+  Keep only the slices needed to segment RangeSlice of a SimpleITK image.
+  """
+  first, last = slabRange(RangeSlice, image.GetSize()[2], margin)
+  return SlabImage(image[:, :, first:last], first, image.GetSize())
+
+
+def sliceRange(minSlice, maxSlice):
+  """
+  Convert the range of slices selected by the user (both end slices included)
+  to the [first, last + 1] range expected by tisseglibrary.
+  """
+  return [int(minSlice), int(maxSlice) + 1]
+
+
+def checkPartitions(RangeSlice, numberOfPartitions):
+  """
+  Raise ValueError if the slice range cannot be divided in the requested number of partitions.
+  """
+  if numberOfPartitions > (RangeSlice[1]-RangeSlice[0]):
+    raise ValueError(PARTITIONS_ERROR)
+
+
+def compactLabelmap(label_img):
+  """
+  Cast a labelmap to the narrowest integer pixel type that holds its labels.
+  tisseglibrary returns the labelmaps as 64-bit floats although the labels fit in 8 bits.
+  """
+  import SimpleITK as sitk
+
+  statistics = sitk.MinimumMaximumImageFilter()
+  statistics.Execute(label_img)
+  minimum, maximum = statistics.GetMinimum(), statistics.GetMaximum()
+  if minimum >= 0:
+    pixelTypes = [(255, sitk.sitkUInt8), (65535, sitk.sitkUInt16), (2 ** 32 - 1, sitk.sitkUInt32)]
+  else:
+    pixelTypes = [(127, sitk.sitkInt8), (32767, sitk.sitkInt16), (2 ** 31 - 1, sitk.sitkInt32)]
+  for largest, pixelType in pixelTypes:
+    if maximum <= largest and -minimum <= largest + 1:
+      break
+  else:
+    pixelType = sitk.sitkInt64
+  if label_img.GetPixelID() == pixelType:
+    return label_img
+  return sitk.Cast(label_img, pixelType)
+
+
+def combineLabels(left, right):
+  """
+  Arrays of the left and right thigh labels in one array, the right labels shifted by RIGHT_LABEL_OFFSET.
+  """
+  import numpy as np
+
+  right = np.asarray(right)
+  combined = np.where(right > 0, right.astype(np.uint16) + RIGHT_LABEL_OFFSET, 0)
+  return np.where(np.asarray(left) > 0, left, combined).astype(np.uint8 if combined.max(initial=0) <= 255 else np.uint16)
+
+
+def splitLabels(combined, side):
+  """
+  Labels of one side ('l' or 'r') of an array made by combineLabels.
+  """
+  import numpy as np
+
+  combined = np.asarray(combined)
+  if side == 'l':
+    return np.where(combined < RIGHT_LABEL_OFFSET, combined, 0).astype(np.uint8)
+  return np.where(combined > RIGHT_LABEL_OFFSET, combined - RIGHT_LABEL_OFFSET, 0).astype(np.uint8)
+
+
+def combineThighs(out_l=None, out_r=None):
+  """
+  Store the left and right thigh labelmaps (either can be None) in one labelmap with disjoint labels:
+  the left labels are kept and RIGHT_LABEL_OFFSET is added to the right labels.
+  """
+  import numpy as np
+  import SimpleITK as sitk
+
+  reference = out_l if out_l is not None else out_r
+  empty = np.zeros(sitk.GetArrayViewFromImage(reference).shape, np.uint8)
+  left = sitk.GetArrayViewFromImage(out_l) if out_l is not None else empty
+  right = sitk.GetArrayViewFromImage(out_r) if out_r is not None else empty
+  combined_img = sitk.GetImageFromArray(combineLabels(left, right))
+  combined_img.CopyInformation(reference)
+  return combined_img
+
+
+def splitThighs(combined_img, side):
+  """
+  Labelmap of one side ('l' or 'r') of a labelmap made by combineThighs.
+  """
+  import SimpleITK as sitk
+
+  label_img = sitk.GetImageFromArray(splitLabels(sitk.GetArrayViewFromImage(combined_img), side))
+  label_img.CopyInformation(combined_img)
+  return label_img
+
+
+def segmentThigh(fat_img, water_img, RangeSlice, numberOfPartitions, incomplete, master_img=None):
+  """
+  Run tisseglibrary.ThighSegmentation on a water/fat pair.
+  If master_img is given, its spatial information is copied to both inputs.
+  Returns a dictionary with the left/right labelmaps (see compactLabelmap) and the library flags.
+  """
+  from tisseglibrary import tisseglibrary
+
+  if master_img is not None:
+    fat_img.CopyInformation(master_img)
+    water_img.CopyInformation(master_img)
+
+  checkPartitions(RangeSlice, numberOfPartitions)
+
+  out_l, out_r, right_full_Q, left_full_Q, sum_left, sum_right = tisseglibrary.ThighSegmentation(fat_img, water_img,
+                                                                  RangeSlice, numberOfPartitions, incomplete)
+  return {
+    'out_l': compactLabelmap(out_l),
+    'out_r': compactLabelmap(out_r),
+    'right_full_Q': right_full_Q,
+    'left_full_Q': left_full_Q,
+    'sum_left': sum_left,
+    'sum_right': sum_right,
+    }
+
+
+def segmentAbdomen(fat_img, water_img, roi_img, RangeSlice_Abdo, numberOfPartitions_Abdo):
+  """
+  Run tisseglibrary.AbdomenSegmentation on a water/fat pair and the ROI labelmap.
+  Returns a dictionary with the abdomen labelmap (see compactLabelmap).
+  """
+  from tisseglibrary import tisseglibrary
+
+  checkPartitions(RangeSlice_Abdo, numberOfPartitions_Abdo)
+
+  classImage2_img = tisseglibrary.AbdomenSegmentation(fat_img, water_img, roi_img, RangeSlice_Abdo, numberOfPartitions_Abdo)
+  return {'out_Abdo': compactLabelmap(classImage2_img)}
+
+
+def segmentJob(job):
+  """
+  Segment the images of a job, a dictionary with the keys 'region', 'fat', 'water', 'RangeSlice', 'partitions'
+  and, depending on the region, 'incomplete' and 'master' (thigh) or 'roi' (abdomen).
+  """
+  if job['region'] == THIGH:
+    return segmentThigh(job['fat'], job['water'], job['RangeSlice'], job['partitions'], job.get('incomplete', False), job.get('master'))
+  return segmentAbdomen(job['fat'], job['water'], job['roi'], job['RangeSlice'], job['partitions'])
+
+
+def thighOutputPlan(result, incomplete):
+  """
+  Decide which thigh labelmaps are kept depending on whether the thighs are complete.
+  Returns (message, outputs). message is the information shown to the user (or None) and
+  outputs is the list of (side, suffix) tuples, in the order they are stored, where side is 'l' or 'r'
+  and suffix is the segment name suffix passed to ColorSegmentation (None if no segmentation is created).
+  """
+  left_full_Q = result['left_full_Q']
+  right_full_Q = result['right_full_Q']
+  sum_left = result['sum_left']
+  sum_right = result['sum_right']
+
+  message = None
+  outputs = []
+
+  if left_full_Q == True and right_full_Q == False:
+    if incomplete == False:
+      message = "Incomplete right thigh. \nTo have them processed check the box"
+      outputs.append(('r', None))
+    else:
+      outputs.append(('r', '_r'))
+    outputs.append(('l', '_l'))
+
+  elif left_full_Q == False and right_full_Q == True:
+    if incomplete == False:
+      message = "Incomplete left thigh. \nTo have them processed check the box"
+      outputs.append(('l', None))
+    else:
+      outputs.append(('l', '_r'))
+    outputs.append(('r', '_r'))
+
+  elif left_full_Q == True and right_full_Q == True:
+    outputs.append(('l', '_l'))
+    outputs.append(('r', '_r'))
+
+  elif left_full_Q == False and right_full_Q == False:
+    if incomplete == True:
+      if sum_left == 0 and sum_right != 0:
+        message = "Thighs could not be divided"
+        outputs.append(('r', ''))
+        outputs.append(('l', None))
+      elif sum_right == 0 and sum_left != 0:
+        message = "Thighs could not be divided"
+        outputs.append(('l', ''))
+        outputs.append(('r', None))
+      elif sum_right != 0 and sum_left != 0:
+        outputs.append(('l', ''))
+        outputs.append(('r', ''))
+    else:
+      message = "Incomplete thighs \nTo have them processed check the box"
+
+  return message, outputs
@@ -0,0 +1,62 @@
+"""
+Low-resolution preview of a segmentation.
+
+The images of a job are downsampled in-plane (the slices are kept, so the slice range and the number of
+partitions mean the same as in a full-resolution run), segmented, and the labels are upsampled back to the
+grid of the input with nearest-neighbour interpolation. The library uses structuring elements of a fixed
+number of voxels, so the preview is an approximation of the full-resolution result meant for checking the
+range and parameters before running it.
+"""
+from Tis_SegLib import Pipeline
+
+# In-plane downsampling factor of the preview
+DEFAULT_PREVIEW_FACTOR = 4
+
+
+def downsampleImage(image, factor, labels=False):
+  """
+  Downsample a SimpleITK image or Pipeline.SlabImage by factor along I and J.
+  Intensities are averaged over each block of voxels, labels are subsampled.
+  """
+  import SimpleITK as sitk
+
+  shrink = sitk.Shrink if labels else sitk.BinShrink
+  shrinkFactors = [int(factor), int(factor), 1]
+  if isinstance(image, Pipeline.SlabImage):
+    slab = shrink(image.slab, shrinkFactors)
+    return Pipeline.SlabImage(slab, image.first, slab.GetSize()[:2] + (image.GetSize()[2],))
+  return shrink(image, shrinkFactors)
+
+
+def downsampleJob(job, factor):
+  """
+  Same job (see Pipeline.segmentJob) with its images downsampled in-plane by factor.
+  """
+  previewJob = dict(job)
+  for key in ('fat', 'water', 'master', 'roi'):
+    if job.get(key) is not None:
+      previewJob[key] = downsampleImage(job[key], factor, labels=(key == 'roi'))
+  return previewJob
+
+
+def upsampleResult(result, job):
+  """
+  Resample the labelmaps of a preview result on the grid of the slices of RangeSlice of the full-resolution job.
+  """
+  import SimpleITK as sitk
+
+  reference = job.get('master') if job.get('master') is not None else job['fat']
+  reference_img = reference[:, :, int(job['RangeSlice'][0]):int(job['RangeSlice'][1])]
+  upsampled = {}
+  for key, value in result.items():
+    if hasattr(value, 'GetPixelID'):
+      value = sitk.Resample(value, reference_img, sitk.Transform(), sitk.sitkNearestNeighbor, 0, value.GetPixelID())
+    upsampled[key] = value
+  return upsampled
+
+
+def segmentPreview(job, factor=DEFAULT_PREVIEW_FACTOR):
+  """
+  Segment a job at low resolution and return the result on the full-resolution grid.
+  """
+  return upsampleResult(Pipeline.segmentJob(downsampleJob(job, factor)), job)
@@ -0,0 +1,141 @@
+"""
+Wall time, CPU time and memory of the stages of each segmentation run.
+
+A Profiler keeps the last runs. Each run is tagged (region, volume size, parameters, library version)
+and records its stages in order. A stage records its wall time, the CPU time of this process and the
+peak resident memory of the process when it ends. The runs can also be appended to a JSON-lines file.
+Stages can be nested and are ignored when no run is active, so instrumented code also works without profiling.
+"""
+import collections
+import contextlib
+import json
+import sys
+import time
+
+
+def peakMemory():
+  """
+  Peak resident set size of this process in bytes, or None if it cannot be read.
+  """
+  try:
+    import resource
+  except ImportError:
+    try:
+      import psutil
+      memory = psutil.Process().memory_info()
+      return getattr(memory, 'peak_wset', memory.rss)
+    except Exception:
+      return None
+  maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Kilobytes on Linux, bytes on macOS
+  return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+class Run:
+  """
+  Stages of one segmentation run.
+  """
+
+  def __init__(self, name, tags=None):
+    self.name = name
+    self.tags = dict(tags or {})
+    self.startTime = time.time()
+    self.stages = []
+    self.seconds = None
+    self.error = None
+    self._depth = 0
+
+  @contextlib.contextmanager
+  def stage(self, name):
+    stage = {'stage': name, 'depth': self._depth}
+    self.stages.append(stage)
+    self._depth += 1
+    wallStart = time.perf_counter()
+    cpuStart = time.process_time()
+    try:
+      yield stage
+    finally:
+      self._depth -= 1
+      stage['seconds'] = time.perf_counter() - wallStart
+      stage['cpuSeconds'] = time.process_time() - cpuStart
+      stage['peakMemory'] = peakMemory()
+
+  def toDict(self):
+    return {'run': self.name, 'time': self.startTime, 'seconds': self.seconds, 'error': self.error,
+      'tags': self.tags, 'stages': self.stages}
+
+  def summary(self):
+    """
+    One line per stage with its wall time, CPU time and peak memory.
+    """
+    lines = ['{0}: {1:.2f} s'.format(self.name, self.seconds or 0.0)]
+    for stage in self.stages:
+      memory = stage.get('peakMemory')
+      lines.append('{0}{1}: {2:.2f} s (CPU {3:.2f} s{4})'.format('  ' * (stage['depth'] + 1), stage['stage'],
+        stage.get('seconds', 0.0), stage.get('cpuSeconds', 0.0),
+        ', peak {0:.0f} MB'.format(memory / 1024 ** 2) if memory is not None else ''))
+    return '\n'.join(lines)
+
+
+class Profiler:
+  """
+  Record the last maximumNumberOfRuns runs and, if logPath is set, append each run to that JSON-lines file.
+  """
+
+  def __init__(self, maximumNumberOfRuns=50, logPath=None):
+    self.runs = collections.deque(maxlen=maximumNumberOfRuns)
+    self.logPath = logPath
+    self.currentRun = None
+
+  @contextlib.contextmanager
+  def run(self, name, tags=None):
+    run = Run(name, tags)
+    previousRun = self.currentRun
+    self.currentRun = run
+    wallStart = time.perf_counter()
+    try:
+      yield run
+    except Exception as e:
+      run.error = '{0}: {1}'.format(type(e).__name__, e)
+      raise
+    finally:
+      run.seconds = time.perf_counter() - wallStart
+      self.currentRun = previousRun
+      self.runs.append(run)
+      self.writeLog(run)
+
+  def stage(self, name):
+    """
+    Record a stage of the current run (does nothing if there is no current run).
+    """
+    if self.currentRun is None:
+      return contextlib.nullcontext()
+    return self.currentRun.stage(name)
+
+  def tag(self, **tags):
+    if self.currentRun is not None:
+      self.currentRun.tags.update(tags)
+
+  def record(self, name, stageSeconds, tags=None):
+    """
+    Add a run measured elsewhere (for example in another thread) from the seconds of each of its stages.
+    """
+    run = Run(name, tags)
+    run.stages = [{'stage': stage, 'depth': 0, 'seconds': seconds} for stage, seconds in stageSeconds.items()]
+    run.seconds = sum(stageSeconds.values())
+    self.runs.append(run)
+    self.writeLog(run)
+    return run
+
+  def lastRun(self):
+    return self.runs[-1] if self.runs else None
+
+  def writeLog(self, run):
+    if not self.logPath:
+      return
+    try:
+      with open(self.logPath, 'a') as logFile:
+        logFile.write(json.dumps(run.toDict(), default=str) + '\n')
+    except OSError as e:
+      import logging
+      logging.warning('Could not write the profiling log {0}: {1}'.format(self.logPath, e))
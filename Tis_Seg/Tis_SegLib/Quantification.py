@@ -0,0 +1,184 @@
+"""
+Volume and mean fat fraction of the tissues of the output labelmaps.
+
+All the tissues and slices of a labelmap are counted in one vectorized pass: the label of each voxel is
+mapped to the index of its tissue and combined with its slice, and np.bincount gives the number of voxels
+and the sum of the fat fractions of every (slice, tissue) pair. The partitions and the totals are sums of
+the slices, so they come without reading the voxels again. The fat fraction of a voxel is fat / (fat + water).
+
+The partitions of the table (scope 'nominalPartition') are consecutive blocks of numberOfPartitions slices from
+the first slice of the range. They are not the groups in which tisseglibrary runs its K-Means: these are made of
+equal numbers of masked voxels, not of whole slices, and are split further in the first and last 10% of the
+slices of the volume.
+"""
+import csv
+
+from Tis_SegLib import Pipeline
+from Tis_SegLib import SegmentationImport
+
+QUANTIFICATION_FIELDS = ['region', 'side', 'scope', 'index', 'firstSlice', 'lastSlice', 'label', 'tissue',
+  'voxels', 'volumeMl', 'meanFatFraction']
+
+# Side of the thigh labelmaps (output names of Pipeline.thighOutputPlan)
+SIDES = {'l': 'left', 'r': 'right', 'Abdo': ''}
+
+
+def tissueLabels(region):
+  """
+  Label values and names of the tissues of a region, in the order of the rows.
+  """
+  segments = SegmentationImport.THIGH_SEGMENTS if region == Pipeline.THIGH else SegmentationImport.ABDOMEN_SEGMENTS
+  return [(label, segments[label][0]) for label in sorted(segments)]
+
+
+def sliceStatistics(labels, fat, water, region):
+  """
+  Number of voxels and sum of the fat fractions of each tissue in each slice.
+  labels, fat and water are arrays (K, J, I) of the same slices. Returns two arrays (K, number of tissues).
+  """
+  import numpy as np
+
+  tissues = tissueLabels(region)
+  numberOfTissues = len(tissues)
+  labels = np.asarray(labels)
+  if labels.shape != np.shape(fat) or labels.shape != np.shape(water):
+    raise ValueError('The labelmap and the fat and water images do not have the same size: {0}, {1}, {2}'.format(
+      labels.shape, np.shape(fat), np.shape(water)))
+
+  # Index of the tissue of each label value, the other labels (background) go to an extra bin
+  lookup = np.full(max(int(labels.max(initial=0)), tissues[-1][0]) + 1, numberOfTissues, np.intp)
+  for index, (label, _) in enumerate(tissues):
+    lookup[label] = index
+  numberOfSlices = labels.shape[0]
+  bins = lookup[labels]
+  bins += (np.arange(numberOfSlices, dtype=np.intp) * (numberOfTissues + 1))[:, None, None]
+
+  fat = np.asarray(fat, np.float32)
+  total = fat + np.asarray(water, np.float32)
+  fatFraction = np.divide(fat, total, out=np.zeros_like(total), where=total > 0)
+
+  shape = (numberOfSlices, numberOfTissues + 1)
+  counts = np.bincount(bins.ravel(), minlength=shape[0] * shape[1]).reshape(shape)
+  fatFractionSums = np.bincount(bins.ravel(), weights=fatFraction.ravel(), minlength=shape[0] * shape[1]).reshape(shape)
+  return counts[:, :numberOfTissues], fatFractionSums[:, :numberOfTissues]
+
+
+def partitionStarts(numberOfSlices, numberOfPartitions):
+  """
+  First slice (relative to the range) of each nominal partition, a block of numberOfPartitions slices.
+  The slices that do not fill a whole partition go to the last one.
+  """
+  partitionSize = max(1, int(numberOfPartitions))
+  return list(range(0, max(1, numberOfSlices - partitionSize + 1), partitionSize))
+
+
+def statisticsRows(counts, fatFractionSums, spacing, RangeSlice, numberOfPartitions, region, side=''):
+  """
+  Rows of the quantification table from the slice statistics of a labelmap covering RangeSlice:
+  one row per tissue for each slice, each nominal partition (see partitionStarts) and the whole range.
+  Slices are numbered as in the volume and both end slices of a partition are included.
+  """
+  import numpy as np
+
+  tissues = tissueLabels(region)
+  voxelVolume = float(np.prod(spacing)) / 1000.0
+  first = int(RangeSlice[0])
+  numberOfSlices = counts.shape[0]
+  starts = partitionStarts(numberOfSlices, numberOfPartitions)
+  ends = starts[1:] + [numberOfSlices]
+
+  scopes = [('total', [0], [numberOfSlices], counts.sum(axis=0, keepdims=True), fatFractionSums.sum(axis=0, keepdims=True)),
+    ('nominalPartition', starts, ends, np.add.reduceat(counts, starts, axis=0), np.add.reduceat(fatFractionSums, starts, axis=0)),
+    ('slice', range(numberOfSlices), range(1, numberOfSlices + 1), counts, fatFractionSums)]
+
+  rows = []
+  for scope, scopeStarts, scopeEnds, scopeCounts, scopeSums in scopes:
+    for index, (start, end) in enumerate(zip(scopeStarts, scopeEnds)):
+      for column, (label, tissue) in enumerate(tissues):
+        voxels = int(scopeCounts[index, column])
+        rows.append({
+          'region': region,
+          'side': side,
+          'scope': scope,
+          'index': first + start if scope == 'slice' else index,
+          'firstSlice': first + start,
+          'lastSlice': first + end - 1,
+          'label': label,
+          'tissue': tissue,
+          'voxels': voxels,
+          'volumeMl': voxels * voxelVolume,
+          'meanFatFraction': float(scopeSums[index, column]) / voxels if voxels else None,
+          })
+  return rows
+
+
+def quantifyLabelmap(label_img, fat_img, water_img, RangeSlice, numberOfPartitions, region, side=''):
+  """
+  Quantification rows of a labelmap returned by tisseglibrary (it covers the slices of RangeSlice).
+  fat_img and water_img are the whole input images or SlabImages.
+  """
+  import SimpleITK as sitk
+
+  first, last = int(RangeSlice[0]), int(RangeSlice[1])
+  # The sliced images are kept while their array views are used
+  fatSlices = fat_img[:, :, first:last]
+  waterSlices = water_img[:, :, first:last]
+  counts, fatFractionSums = sliceStatistics(sitk.GetArrayViewFromImage(label_img), sitk.GetArrayViewFromImage(fatSlices),
+    sitk.GetArrayViewFromImage(waterSlices), region)
+  return statisticsRows(counts, fatFractionSums, label_img.GetSpacing(), RangeSlice, numberOfPartitions, region, side)
+
+
+def quantifyResult(job, result, names):
+  """
+  Quantification rows of the labelmaps of a segmentation result.
+  job is the segmented job (see Pipeline.segmentJob) and names the outputs to quantify ('l', 'r' or 'Abdo').
+  """
+  rows = []
+  for name in names:
+    rows.extend(quantifyLabelmap(result['out_' + name], job['fat'], job['water'], job['RangeSlice'],
+      job['partitions'], job['region'], SIDES[name]))
+  return rows
+
+
+def totalRows(rows):
+  return [row for row in rows if row['scope'] == 'total']
+
+
+def writeCsv(rows, path, extraFields=None):
+  """
+  Write quantification rows to a CSV file. extraFields are columns written before the standard ones.
+  """
+  fields = list(extraFields or []) + QUANTIFICATION_FIELDS
+  with open(path, 'w', newline='') as csvFile:
+    writer = csv.DictWriter(csvFile, fields, extrasaction='ignore')
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+def readCsv(path):
+  with open(path, newline='') as csvFile:
+    return list(csv.DictReader(csvFile))
+
+
+def updateTableNode(tableNode, rows):
+  """
+  Replace the content of a table node by quantification rows.
+  """
+  import vtk
+
+  columnTypes = {'index': vtk.vtkIntArray, 'firstSlice': vtk.vtkIntArray, 'lastSlice': vtk.vtkIntArray,
+    'label': vtk.vtkIntArray, 'voxels': vtk.vtkIntArray, 'volumeMl': vtk.vtkDoubleArray, 'meanFatFraction': vtk.vtkDoubleArray}
+  table = vtk.vtkTable()
+  for field in QUANTIFICATION_FIELDS:
+    column = columnTypes.get(field, vtk.vtkStringArray)()
+    column.SetName(field)
+    column.SetNumberOfValues(len(rows))
+    for index, row in enumerate(rows):
+      value = row[field]
+      if isinstance(column, vtk.vtkStringArray):
+        column.SetValue(index, str(value))
+      else:
+        column.SetValue(index, float('nan') if value is None else value)
+    table.AddColumn(column)
+  tableNode.SetAndObserveTable(table)
+  return tableNode
@@ -0,0 +1,81 @@
+"""
+Detection of the range of slices that contain the thighs or the abdomen.
+
+The fat and water signals are added and thresholded at a fraction of their bright level, estimated on a
+sparse sample of the voxels. The voxels above the threshold are then counted slice by slice in one
+vectorized pass (a projection of the foreground on the slice axis). The suggested range is the tightest
+one that contains every slice with enough foreground, extended to a whole number of partitions, so that
+the air and the coil-edge slices at both ends of the acquisition are not segmented.
+"""
+
+# Fraction of the bright signal level (99th percentile) above which a voxel is foreground
+FOREGROUND_LEVEL = 0.1
+# Fraction of the voxels of a slice that have to be foreground for the slice to contain tissue
+MINIMUM_FOREGROUND_FRACTION = 0.02
+# Slices counted at once, to bound the temporary memory
+BLOCK_SLICES = 16
+
+
+def _signal(fat, water):
+  import numpy as np
+
+  signal = np.asarray(fat, np.float32)
+  if water is not None:
+    signal = signal + np.asarray(water, np.float32)
+  return signal
+
+
+def foregroundThreshold(fat, water=None, level=FOREGROUND_LEVEL):
+  """
+  Threshold of the fat + water signal, from a sample of one voxel every 4 rows, 4 columns and 4 slices.
+  """
+  import numpy as np
+
+  sample = _signal(fat[::4, ::4, ::4], water[::4, ::4, ::4] if water is not None else None)
+  return level * float(np.percentile(sample, 99)) if sample.size else 0.0
+
+
+def sliceForeground(fat, water, threshold, blockSlices=BLOCK_SLICES):
+  """
+  Fraction of the voxels of each slice whose fat + water signal is above threshold.
+  fat and water are arrays (K, J, I) (NumPy arrays or memory maps), water can be None.
+  """
+  import numpy as np
+
+  numberOfSlices = fat.shape[0]
+  foreground = np.zeros(numberOfSlices)
+  for first in range(0, numberOfSlices, blockSlices):
+    last = min(numberOfSlices, first + blockSlices)
+    signal = _signal(fat[first:last], water[first:last] if water is not None else None)
+    foreground[first:last] = np.count_nonzero(signal > threshold, axis=(1, 2)) / float(signal[0].size)
+  return foreground
+
+
+def tightestRange(foreground, numberOfPartitions, minimumFraction=MINIMUM_FOREGROUND_FRACTION):
+  """
+  (minSlice, maxSlice), both included, of the tightest range containing the slices with at least minimumFraction
+  of foreground, extended to a whole number of partitions within the volume. None if no slice has tissue.
+  """
+  import numpy as np
+
+  slices = np.flatnonzero(np.asarray(foreground) >= minimumFraction)
+  if not slices.size:
+    return None
+  numberOfSlices = len(foreground)
+  first, last = int(slices[0]), int(slices[-1]) + 1
+  partitionSize = max(1, int(numberOfPartitions))
+  length = min(numberOfSlices, -(-(last - first) // partitionSize) * partitionSize)
+  last = min(numberOfSlices, first + length)
+  first = max(0, last - length)
+  return first, last - 1
+
+
+def detectSliceRange(fat, water, numberOfPartitions, level=FOREGROUND_LEVEL, minimumFraction=MINIMUM_FOREGROUND_FRACTION):
+  """
+  Suggested (minSlice, maxSlice) of a fat/water pair of arrays (K, J, I), or None if no tissue is found.
+  If the arrays do not have the same shape, only the fat signal is used.
+  """
+  if water is not None and tuple(water.shape) != tuple(fat.shape):
+    water = None
+  threshold = foregroundThreshold(fat, water, level)
+  return tightestRange(sliceForeground(fat, water, threshold), numberOfPartitions, minimumFraction)
@@ -0,0 +1,158 @@
+"""
+On-disk cache of segmentation results, addressed by the content of their inputs.
+
+The key of a job is a hash of the voxels and geometry of its input images (fat, water, ROI, master),
+of the segmentation parameters and of the version of tisseglibrary, so a result is only reused when
+the library would compute exactly the same thing. Each entry is a directory with the labelmaps
+(compressed NRRD) and a JSON file with the other values of the result. The least recently used entries
+are removed when the cache grows over its maximum size.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from Tis_SegLib import Pipeline
+
+# Increase when the content of the entries changes, so that old entries are not used
+CACHE_FORMAT_VERSION = 1
+
+RESULT_FILE = 'result.json'
+
+
+def libraryVersion():
+  """
+  Version of the installed tisseglibrary (read from the package metadata, without importing it).
+  """
+  try:
+    from importlib import metadata
+    return metadata.version('tisseglibrary')
+  except Exception:
+    return 'unknown'
+
+
+def _hashImage(hasher, image):
+  import SimpleITK as sitk
+
+  if isinstance(image, Pipeline.SlabImage):
+    hasher.update(repr(('slab', image.first, image.GetSize())).encode())
+    image = image.slab
+  array = sitk.GetArrayViewFromImage(image)
+  hasher.update(repr((array.shape, array.dtype.str, image.GetSpacing(), image.GetOrigin(), image.GetDirection())).encode())
+  hasher.update(array)
+
+
+def jobKey(job):
+  """
+  Hash of the images and parameters of a segmentation job (see ParallelRunner.segmentImages).
+  """
+  hasher = hashlib.blake2b(digest_size=20)
+  parameters = {
+    'format': CACHE_FORMAT_VERSION,
+    'library': libraryVersion(),
+    'region': job['region'],
+    'RangeSlice': [int(job['RangeSlice'][0]), int(job['RangeSlice'][1])],
+    'partitions': float(job['partitions']),
+    'incomplete': bool(job.get('incomplete', False)) if job['region'] == Pipeline.THIGH else None,
+    }
+  hasher.update(json.dumps(parameters, sort_keys=True).encode())
+  for key in ('fat', 'water', 'roi', 'master'):
+    if job.get(key) is not None:
+      hasher.update(key.encode())
+      _hashImage(hasher, job[key])
+  return hasher.hexdigest()
+
+
+class ResultCache:
+  """
+  Results of segmentation jobs stored in directory, limited to maximumSize bytes.
+  """
+
+  def __init__(self, directory, maximumSize=2 * 1024 ** 3):
+    self.directory = directory
+    self.maximumSize = maximumSize
+
+  def _entryDirectory(self, key):
+    return os.path.join(self.directory, key)
+
+  def get(self, key):
+    """
+    Return the result stored for key, or None.
+    """
+    import SimpleITK as sitk
+
+    entryDirectory = self._entryDirectory(key)
+    resultPath = os.path.join(entryDirectory, RESULT_FILE)
+    try:
+      with open(resultPath) as f:
+        stored = json.load(f)
+      result = dict(stored['values'])
+      for name in stored['images']:
+        result[name] = sitk.ReadImage(os.path.join(entryDirectory, name + '.nrrd'))
+    except (OSError, ValueError, KeyError, RuntimeError):
+      return None
+    # Mark the entry as recently used
+    os.utime(resultPath)
+    return result
+
+  def put(self, key, result):
+    """
+    Store a result (dictionary of SimpleITK images and JSON serializable values) and evict old entries.
+    """
+    import SimpleITK as sitk
+
+    if not os.path.isdir(self.directory):
+      os.makedirs(self.directory)
+    images = [name for name, value in result.items() if hasattr(value, 'GetPixelID')]
+    # NumPy scalars (flags and sums returned by the library) are stored as Python values
+    values = {name: value.item() if hasattr(value, 'item') else value for name, value in result.items() if name not in images}
+
+    # Written in a temporary directory and renamed, so a partially written entry is never read
+    temporaryDirectory = tempfile.mkdtemp(dir=self.directory, prefix='.tmp-')
+    try:
+      for name in images:
+        sitk.WriteImage(result[name], os.path.join(temporaryDirectory, name + '.nrrd'), True)
+      with open(os.path.join(temporaryDirectory, RESULT_FILE), 'w') as f:
+        json.dump({'images': images, 'values': values}, f)
+      entryDirectory = self._entryDirectory(key)
+      if os.path.isdir(entryDirectory):
+        shutil.rmtree(entryDirectory, ignore_errors=True)
+      os.rename(temporaryDirectory, entryDirectory)
+    except Exception:
+      shutil.rmtree(temporaryDirectory, ignore_errors=True)
+      raise
+    self.evict()
+
+  def entries(self):
+    """
+    List of (last use time, size in bytes, key) of the entries, least recently used first.
+    """
+    entries = []
+    if not os.path.isdir(self.directory):
+      return entries
+    for key in os.listdir(self.directory):
+      entryDirectory = self._entryDirectory(key)
+      resultPath = os.path.join(entryDirectory, RESULT_FILE)
+      if key.startswith('.') or not os.path.isfile(resultPath):
+        continue
+      size = sum(os.path.getsize(os.path.join(entryDirectory, name)) for name in os.listdir(entryDirectory))
+      entries.append((os.path.getmtime(resultPath), size, key))
+    entries.sort()
+    return entries
+
+  def evict(self):
+    """
+    Remove the least recently used entries until the cache fits in maximumSize.
+    """
+    entries = self.entries()
+    totalSize = sum(size for _, size, _ in entries)
+    for _, size, key in entries:
+      if totalSize <= self.maximumSize:
+        break
+      shutil.rmtree(self._entryDirectory(key), ignore_errors=True)
+      totalSize -= size
+
+  def clear(self):
+    if os.path.isdir(self.directory):
+      shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,166 @@
+"""
+Cores, threads and memory of the parallel segmentations.
+
+Each worker process would otherwise start as many ITK, OpenMP and BLAS threads as there are cores, so N
+workers run N times more threads than cores. limitThreads sets the thread count of all these libraries in
+a worker, and threadsPerWorker shares the physical cores between the workers.
+
+The peak memory of a job is estimated from the size of the slab of slices it segments and the pixel type
+of its inputs: the library converts the slab to float64 and keeps several copies of it (intermediate masks,
+features, left and right outputs). A ParallelRunner only starts a job while the estimates of the running
+jobs fit its memory budget, by default a fraction of the memory available when it starts.
+"""
+import os
+
+# Environment variables read by OpenMP, the BLAS libraries, numexpr and ITK when they are loaded
+THREAD_VARIABLES = [
+  'OMP_NUM_THREADS',
+  'OPENBLAS_NUM_THREADS',
+  'MKL_NUM_THREADS',
+  'VECLIB_MAXIMUM_THREADS',
+  'NUMEXPR_NUM_THREADS',
+  'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS',
+  ]
+
+# Float64 copies of the segmented slab alive at the peak of a segmentation (estimate)
+WORKING_COPIES = 12
+
+# Memory of a worker process with the segmentation libraries imported, before any job
+WORKER_MEMORY = 400 * 1024 ** 2
+
+# Fraction of the available memory used by default
+DEFAULT_MEMORY_FRACTION = 0.8
+
+
+def physicalCores():
+  """
+  Number of physical cores this process can run on (hyper-threads are not counted).
+  """
+  logical = os.cpu_count() or 1
+  if hasattr(os, 'sched_getaffinity'):
+    logical = len(os.sched_getaffinity(0)) or logical
+  cores = None
+  try:
+    import psutil
+    cores = psutil.cpu_count(logical=False)
+  except ImportError:
+    try:
+      with open('/proc/cpuinfo') as cpuInfo:
+        pairs = set()
+        physicalId = None
+        for line in cpuInfo:
+          name, _, value = line.partition(':')
+          name = name.strip()
+          if name == 'physical id':
+            physicalId = value.strip()
+          elif name == 'core id':
+            pairs.add((physicalId, value.strip()))
+        cores = len(pairs) or None
+    except OSError:
+      pass
+  return max(1, min(cores or logical, logical))
+
+
+def availableMemory():
+  """
+  Memory (bytes) that can be used without swapping, or None if it cannot be read.
+  """
+  try:
+    import psutil
+    return psutil.virtual_memory().available
+  except ImportError:
+    pass
+  try:
+    with open('/proc/meminfo') as memInfo:
+      for line in memInfo:
+        if line.startswith('MemAvailable:'):
+          return int(line.split()[1]) * 1024
+  except (OSError, ValueError, IndexError):
+    pass
+  return None
+
+
+def defaultMemoryBudget(fraction=DEFAULT_MEMORY_FRACTION):
+  memory = availableMemory()
+  return int(memory * fraction) if memory is not None else None
+
+
+def threadsPerWorker(numberOfWorkers):
+  """
+  Threads of each of numberOfWorkers workers so that all together they use the physical cores once.
+  """
+  return max(1, physicalCores() // max(1, numberOfWorkers))
+
+
+def limitThreads(numberOfThreads):
+  """
+  Limit the threads of ITK, OpenMP and the BLAS libraries of this process. The environment variables
+  cover the libraries that are not loaded yet, threadpoolctl (installed with scikit-learn) the others.
+  """
+  import SimpleITK as sitk
+
+  for variable in THREAD_VARIABLES:
+    os.environ[variable] = str(numberOfThreads)
+  sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(numberOfThreads)
+  try:
+    import threadpoolctl
+    threadpoolctl.threadpool_limits(numberOfThreads)
+  except ImportError:
+    pass
+
+
+def jobMemory(sliceVoxels, slabSlices, inputBytesPerVoxel):
+  """
+  Estimated peak memory (bytes) of the segmentation of a slab of slabSlices slices of sliceVoxels voxels,
+  whose inputs take inputBytesPerVoxel together.
+  """
+  return sliceVoxels * slabSlices * (inputBytesPerVoxel + WORKING_COPIES * 8)
+
+
+def imagesMemory(job):
+  """
+  Estimated peak memory of a job whose images are in memory (see ParallelRunner.segmentImages).
+  """
+  inputBytes = 0
+  size = None
+  for key in ('fat', 'water', 'roi', 'master'):
+    image = job.get(key)
+    if image is None:
+      continue
+    image = getattr(image, 'slab', image)
+    size = size or image.GetSize()
+    inputBytes += image.GetSizeOfPixelComponent() * image.GetNumberOfComponentsPerPixel()
+  if size is None:
+    return 0
+  return jobMemory(size[0] * size[1], size[2], inputBytes)
+
+
+def studyMemory(study):
+  """
+  Estimated peak memory of a normalized study (see BatchProcessing.readManifest), from the headers of its images.
+  """
+  import SimpleITK as sitk
+  from Tis_SegLib import Pipeline
+
+  inputBytes = 0
+  size = None
+  for key in ('fat', 'water', 'roi', 'master'):
+    if not study.get(key):
+      continue
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(study[key])
+    try:
+      reader.ReadImageInformation()
+    except RuntimeError:
+      # The study fails when it reads the image, it needs no memory
+      continue
+    size = size or reader.GetSize()
+    inputBytes += sitk.Image([1, 1, 1], reader.GetPixelID()).GetSizeOfPixelComponent() * reader.GetNumberOfComponents()
+  if size is None:
+    return 0
+  if study.get('autoRange'):
+    slabSlices = size[2]
+  else:
+    first, last = Pipeline.slabRange(Pipeline.sliceRange(study['minSlice'], study['maxSlice']), size[2])
+    slabSlices = last - first
+  return jobMemory(size[0] * size[1], slabSlices, inputBytes)
@@ -0,0 +1,87 @@
+"""
+Conversion of the output labelmaps to segmentations with the names and colors of the tissues.
+
+Same result as tisseglibrary.ColorSegmentation / ColorSegmentation_Abdo, but the segments are named
+from their label value in a single pass while the segmentation node is not modified, and the closed
+surfaces used for 3D display are only built when requested. Without them the segments are shown in
+the slice views, and the surfaces can be created later (Show 3D in the Segmentations module or
+createClosedSurfaces), with an optional decimation factor.
+"""
+from Tis_SegLib import Pipeline
+
+# Label value: (name, color) of the tissues of each region
+THIGH_SEGMENTS = {
+  2: ('Bone', (241, 214, 145)),
+  5: ('Vessels', (216, 101, 79)),
+  6: ('Skin', (177, 122, 101)),
+  7: ('Marrow', (144, 238, 144)),
+  8: ('Muscle', (192, 104, 88)),
+  11: ('IntraMAT', (250, 250, 225)),
+  15: ('SAT', (230, 220, 70)),
+  31: ('InterMAT', (140, 224, 228)),
+  }
+
+ABDOMEN_SEGMENTS = {
+  2: ('Bone/Air', (241, 214, 145)),
+  5: ('Other tissue', (216, 101, 79)),
+  6: ('Skin', (177, 122, 101)),
+  7: ('Air', (144, 238, 144)),
+  8: ('Muscle', (192, 104, 88)),
+  11: ('VAT', (250, 250, 225)),
+  15: ('SAT', (230, 220, 70)),
+  31: ('IMAT', (140, 224, 228)),
+  36: ('Edema + Vessels', (150, 98, 83)),
+  }
+
+SEGMENTATION_ERROR = "The segmentation couldn't be done correctly"
+
+
+def validNumberOfSegments(region, numberOfSegments):
+  """
+  Same check as tisseglibrary: 8 tissues for a thigh, 8 or 9 for the abdomen.
+  """
+  if region == Pipeline.THIGH:
+    return numberOfSegments == 8
+  return 8 <= numberOfSegments < 10
+
+
+def createClosedSurfaces(segmentationNode, decimation=None):
+  """
+  Build the closed surfaces of a segmentation (for 3D display), optionally decimated (0 to 1).
+  """
+  if decimation is not None:
+    segmentationNode.GetSegmentation().SetConversionParameter('Decimation factor', str(float(decimation)))
+  segmentationNode.CreateClosedSurfaceRepresentation()
+
+
+def importLabelmap(labelmapNode, segmentationNode, region, suffix='', closedSurfaces=True, decimation=None):
+  """
+  Replace the segments of segmentationNode by the tissues of a labelmap volume node.
+  suffix is appended to the segment names (thighs). Returns False if the labelmap does not
+  contain the expected tissues.
+  """
+  import numpy as np
+  import slicer
+
+  segments = THIGH_SEGMENTS if region == Pipeline.THIGH else ABDOMEN_SEGMENTS
+  segmentation = segmentationNode.GetSegmentation()
+  wasModified = segmentationNode.StartModify()
+  try:
+    segmentation.RemoveAllSegments()
+    # All the labels are imported at once in a shared labelmap
+    slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmapNode, segmentationNode)
+    if not validNumberOfSegments(region, segmentation.GetNumberOfSegments()):
+      return False
+    for index in range(segmentation.GetNumberOfSegments()):
+      segment = segmentation.GetNthSegment(index)
+      if segment.GetLabelValue() not in segments:
+        continue
+      name, color = segments[segment.GetLabelValue()]
+      segment.SetName(name + suffix)
+      segment.SetColor(np.array(color, float) / 255)
+  finally:
+    segmentationNode.EndModify(wasModified)
+
+  if closedSurfaces:
+    createClosedSurfaces(segmentationNode, decimation)
+  return True
@@ -0,0 +1,353 @@
+"""
+Local segmentation service that keeps a pool of warm worker processes.
+
+Starting Slicer and importing tisseglibrary, scikit-image and scikit-learn takes longer than segmenting
+a small study. The service pays that cost once: its workers import the segmentation modules when they
+start, then segment the studies posted to a small HTTP API, so each study only costs its own compute time.
+A job is a manifest entry (see BatchProcessing.MANIFEST_FIELDS) with the paths of the images on this
+machine. Its labelmaps (and quantification) are written to the output folder and the job returns the
+study record: output paths, status flags and, with quantify, the volume and fat fraction of the tissues.
+
+  POST /jobs        submit a job (JSON object). With "wait": true the answer is sent when the job finishes
+  GET  /jobs/<id>   state of a job: queued, running, done or failed, and its record when finished
+  GET  /health      number of workers and of jobs in each state
+
+The service has no authentication, so it only listens on a loopback address (127.0.0.1 by default) or on a
+Unix socket (--socket) that only its user can open, and the jobs can only write inside the output folder of
+the service: their outputDirectory and cohort store are paths relative to it and the study id, which starts
+the name of every output file, cannot contain folders. Run it with:
+
+  Slicer --no-main-window --python-script Tis_SegLib/SegmentationService.py --port 8765 --output-dir results --workers 2
+
+and submit a study with:
+
+  curl -X POST localhost:8765/jobs -d '{"region": "thigh", "water": "/data/s1_W.nrrd", "fat": "/data/s1_F.nrrd", "wait": true}'
+"""
+import argparse
+import collections
+import concurrent.futures
+import http.server
+import ipaddress
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+import uuid
+
+if __name__ == "__main__":
+  # Make Tis_SegLib importable when this file is run with --python-script
+  sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Tis_SegLib import BatchProcessing
+from Tis_SegLib import ParallelProcessing
+from Tis_SegLib import Pipeline
+from Tis_SegLib import Scheduling
+
+DEFAULT_PORT = 8765
+
+# Finished jobs kept in memory, the oldest are forgotten first
+MAXIMUM_FINISHED_JOBS = 1000
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def _initializeServiceWorker(threadsPerWorker):
+  """
+  Set the ITK threads of a worker and import the segmentation modules before the first job arrives.
+  """
+  import importlib
+  from Tis_SegLib import Dependencies
+
+  ParallelProcessing._initializeWorker(threadsPerWorker)
+  for moduleName in Dependencies.HEAVY_MODULES:
+    try:
+      importlib.import_module(moduleName)
+    except Exception as e:
+      # The error is reported by the jobs that need the module
+      logging.warning('Could not import {0}: {1}'.format(moduleName, e))
+
+
+def _warmWorker():
+  return os.getpid()
+
+
+def _processJob(study, outputDirectory, quantify=False, options=None):
+  """
+  Segment a study in a worker. The record gets the per-thigh (or abdomen) totals of the quantification.
+  """
+  record = BatchProcessing.processStudy(study, outputDirectory, writeSegmentations=False, quantify=quantify, options=options)
+  if 'quantification' in record['outputs']:
+    from Tis_SegLib import Quantification
+    record['quantification'] = Quantification.totalRows(Quantification.readCsv(record['outputs']['quantification']))
+  return record
+
+
+def isLoopback(host):
+  """
+  True if every address of host (name or IP address) is a loopback address.
+  """
+  try:
+    return ipaddress.ip_address(host).is_loopback
+  except ValueError:
+    pass
+  try:
+    addresses = socket.getaddrinfo(host, None)
+  except socket.gaierror:
+    return False
+  return bool(addresses) and all(ipaddress.ip_address(address[4][0].split('%')[0]).is_loopback for address in addresses)
+
+
+def _jsonDefault(value):
+  # NumPy scalars (flags of the thigh results)
+  if hasattr(value, 'item'):
+    return value.item()
+  return str(value)
+
+
+class SegmentationService:
+  """
+  Pool of numberOfWorkers warm worker processes that segment the submitted studies. The jobs write to
+  outputDirectory, or to the folder they give inside it. executor replaces the pool (for tests).
+  """
+
+  def __init__(self, outputDirectory, numberOfWorkers=1, threadsPerWorker=None, executor=None):
+    if not outputDirectory:
+      raise ValueError('The service needs an output folder')
+    self.outputDirectory = os.path.realpath(outputDirectory)
+    self.numberOfWorkers = max(1, numberOfWorkers)
+    self.threadsPerWorker = threadsPerWorker or Scheduling.threadsPerWorker(self.numberOfWorkers)
+    self.executor = executor or concurrent.futures.ProcessPoolExecutor(max_workers=self.numberOfWorkers,
+      mp_context=ParallelProcessing.multiprocessingContext(), initializer=_initializeServiceWorker, initargs=(self.threadsPerWorker,))
+    self.jobs = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def warmUp(self):
+    """
+    Start all the workers and wait until they have imported the segmentation modules.
+    Returns the time it took.
+    """
+    startTime = time.perf_counter()
+    futures = [self.executor.submit(_warmWorker) for _ in range(self.numberOfWorkers)]
+    concurrent.futures.wait(futures)
+    return time.perf_counter() - startTime
+
+  def outputPath(self, path, name):
+    """
+    Absolute path of a path given by a job, relative to the output folder of the service.
+    Raise ValueError if it is outside of it.
+    """
+    resolved = os.path.realpath(os.path.join(self.outputDirectory, str(path)))
+    if os.path.commonpath([resolved, self.outputDirectory]) != self.outputDirectory:
+      raise ValueError('The {0} of a job must be inside the output folder of the service'.format(name))
+    return resolved
+
+  def submit(self, request):
+    """
+    Queue a job. request is a manifest entry, optionally with 'outputDirectory', 'quantify' and
+    'options' (see BatchProcessing.labelmapOptions). The output folder and the cohort store of the
+    options are relative to the output folder of the service, and no output of the study may be outside of it.
+    Raise ValueError if it is not valid.
+    Returns the job id.
+    """
+    study = BatchProcessing.normalizeStudy(request)
+    options = BatchProcessing.labelmapOptions(request.get('options'))
+    if options['store']:
+      options['store'] = self.outputPath(options['store'], 'cohort store')
+    outputDirectory = self.outputPath(request.get('outputDirectory') or '', 'outputDirectory')
+    names = ('l', 'r', 'thighs') if study['region'] == Pipeline.THIGH else ('Abdo',)
+    outputPaths = [BatchProcessing.labelmapPath(outputDirectory, study['id'], name, options) for name in names]
+    outputPaths.append(os.path.join(outputDirectory, '{0}_quantification.csv'.format(study['id'])))
+    if options['store']:
+      outputPaths.append(os.path.join(options['store'], study['id']))
+    for path in outputPaths:
+      self.outputPath(path, 'output')
+    os.makedirs(outputDirectory, exist_ok=True)
+
+    jobId = uuid.uuid4().hex
+    job = {'id': jobId, 'study': study['id'], 'status': QUEUED, 'submitTime': time.time(), 'seconds': None, 'record': None, 'error': None,
+      'finished': threading.Event()}
+    with self._lock:
+      self.jobs[jobId] = job
+    future = self.executor.submit(_processJob, study, outputDirectory, BatchProcessing._parseBool(request.get('quantify', False)), options)
+    job['future'] = future
+    future.add_done_callback(lambda future: self._finish(job, future))
+    # The pool does not tell when a job starts, it is running as soon as it is not waiting for a worker
+    if future.running():
+      job['status'] = RUNNING
+    return jobId
+
+  def _finish(self, job, future):
+    try:
+      record = future.result()
+      job['record'] = record
+      job['status'] = DONE if record['status'] == 'done' else FAILED
+      job['error'] = record.get('error')
+    except Exception as e:
+      job['status'] = FAILED
+      job['error'] = '{0}: {1}'.format(type(e).__name__, e)
+    job['seconds'] = time.time() - job['submitTime']
+    job['finished'].set()
+    with self._lock:
+      finished = [jobId for jobId, other in self.jobs.items() if other['status'] in (DONE, FAILED)]
+      for jobId in finished[:max(0, len(finished) - MAXIMUM_FINISHED_JOBS)]:
+        del self.jobs[jobId]
+
+  def job(self, jobId, wait=False, timeout=None):
+    """
+    State of a job. If wait is True, wait (up to timeout seconds) for the job to finish.
+    Returns None if the job is unknown.
+    """
+    with self._lock:
+      job = self.jobs.get(jobId)
+    if job is None:
+      return None
+    if wait:
+      job['finished'].wait(timeout)
+    if job['status'] == QUEUED and job['future'].running():
+      job['status'] = RUNNING
+    return {key: value for key, value in job.items() if key not in ('future', 'finished')}
+
+  def counts(self):
+    with self._lock:
+      jobs = list(self.jobs.values())
+    counts = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+    for job in jobs:
+      status = RUNNING if job['status'] == QUEUED and job['future'].running() else job['status']
+      counts[status] += 1
+    return counts
+
+  def close(self):
+    self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+class ServiceRequestHandler(http.server.BaseHTTPRequestHandler):
+  """
+  JSON API of a SegmentationService (the server has a 'service' attribute).
+  """
+
+  def address_string(self):
+    # Unix sockets have no client address
+    return self.client_address[0] if isinstance(self.client_address, tuple) and self.client_address else 'local'
+
+  def _send(self, code, body):
+    data = json.dumps(body, default=_jsonDefault).encode()
+    self.send_response(code)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def do_GET(self):
+    service = self.server.service
+    path = self.path.rstrip('/')
+    if path == '/health':
+      self._send(200, {'status': 'ok', 'workers': service.numberOfWorkers, 'jobs': service.counts()})
+    elif path.startswith('/jobs/'):
+      job = service.job(path[len('/jobs/'):])
+      if job is None:
+        self._send(404, {'error': 'Unknown job'})
+      else:
+        self._send(200, job)
+    else:
+      self._send(404, {'error': 'Unknown path ' + self.path})
+
+  def do_POST(self):
+    service = self.server.service
+    if self.path.rstrip('/') != '/jobs':
+      self._send(404, {'error': 'Unknown path ' + self.path})
+      return
+    try:
+      request = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+      if not isinstance(request, dict):
+        raise ValueError('The job must be a JSON object')
+      jobId = service.submit(request)
+    except ValueError as e:
+      # json.JSONDecodeError is a ValueError
+      self._send(400, {'error': str(e)})
+      return
+    except Exception as e:
+      logging.exception('Could not submit the job')
+      self._send(500, {'error': '{0}: {1}'.format(type(e).__name__, e)})
+      return
+    if BatchProcessing._parseBool(request.get('wait', False)):
+      self._send(200, service.job(jobId, wait=True))
+    else:
+      self._send(202, service.job(jobId))
+
+  def log_message(self, format, *args):
+    logging.info('%s %s', self.address_string(), format % args)
+
+
+class ServiceHTTPServer(http.server.ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(self, address, service):
+    self.service = service
+    super().__init__(address, ServiceRequestHandler)
+
+
+if hasattr(socketserver, 'UnixStreamServer'):
+  class ServiceUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, service):
+      self.service = service
+      if os.path.exists(path):
+        os.remove(path)
+      super().__init__(path, ServiceRequestHandler)
+
+    def server_bind(self):
+      super().server_bind()
+      # Only the user of the service can connect, set before the server starts listening
+      os.chmod(self.server_address, 0o600)
+
+
+def createServer(service, host='127.0.0.1', port=DEFAULT_PORT, socketPath=None):
+  """
+  HTTP server of a service, on host:port or on the Unix socket socketPath. port 0 picks a free port.
+  Raise ValueError if host is not a loopback address, since the service has no authentication.
+  """
+  if socketPath:
+    if not hasattr(socketserver, 'UnixStreamServer'):
+      raise ValueError('Unix sockets are not available on this platform')
+    return ServiceUnixServer(socketPath, service)
+  if not isLoopback(host):
+    raise ValueError("The service has no authentication, it only listens on loopback addresses, not on '{0}'".format(host))
+  return ServiceHTTPServer((host, port), service)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Serve the thigh and abdomen segmentation to local clients.')
+  parser.add_argument('--host', default='127.0.0.1', help='Loopback address to listen on')
+  parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='Port to listen on')
+  parser.add_argument('--socket', default=None, help='Listen on this Unix socket instead of a TCP port')
+  parser.add_argument('--output-dir', required=True, help='Folder where the outputs of the jobs are written')
+  parser.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+  args = parser.parse_args(argv)
+
+  logging.basicConfig(level=logging.INFO)
+  if not args.socket and not isLoopback(args.host):
+    parser.error("--host must be a loopback address, the service has no authentication")
+  service = SegmentationService(args.output_dir, args.workers)
+  print('Warming up {0} workers: {1:.1f} s'.format(service.numberOfWorkers, service.warmUp()))
+  server = createServer(service, args.host, args.port, args.socket)
+  print('Listening on ' + (args.socket or '{0}:{1}'.format(*server.server_address[:2])))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    service.close()
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,379 @@
+"""
+Streaming segmentation of studies whose volumes do not fit in memory.
+
+The slice range is segmented chunk by chunk (see PartitionProcessing): only the slices of one chunk
+and its margins are read, and the labelmaps of the chunk are written straight to NRRD files mapped in
+memory. Peak memory depends on the chunk size, not on the length of the volume.
+As in the incremental segmentation, the chunks are clustered and masked on their own, so the labelmaps
+are the same as BatchProcessing.processStudy only when the range fits in one chunk. A thigh study whose
+chunks do not agree on which thighs are complete fails, since its labelmaps cannot be stitched.
+Uncompressed NRRD inputs are mapped in memory, other formats are read with the ITK region reader.
+The labelmaps are compressed (or converted to NIfTI) once they are complete, also slab by slab for NRRD.
+"""
+import gzip
+import logging
+import os
+import time
+
+from Tis_SegLib import BatchProcessing
+from Tis_SegLib import JobQueue
+from Tis_SegLib import PartitionProcessing
+from Tis_SegLib import Pipeline
+
+# Slices segmented at once (rounded up to whole partitions)
+DEFAULT_CHUNK_SLICES = 60
+
+CHUNKS_DISAGREE_ERROR = ('The chunks do not agree on which thighs are complete, the study cannot be streamed. '
+  'Run it without --stream or with larger chunks')
+
+# Bytes compressed at once when a labelmap is compressed
+COMPRESSION_BLOCK_SIZE = 64 * 1024 ** 2
+
+NRRD_TYPES = {
+  'signed char': 'i1', 'int8': 'i1', 'int8_t': 'i1',
+  'uchar': 'u1', 'unsigned char': 'u1', 'uint8': 'u1', 'uint8_t': 'u1',
+  'short': 'i2', 'short int': 'i2', 'signed short': 'i2', 'signed short int': 'i2', 'int16': 'i2', 'int16_t': 'i2',
+  'ushort': 'u2', 'unsigned short': 'u2', 'unsigned short int': 'u2', 'uint16': 'u2', 'uint16_t': 'u2',
+  'int': 'i4', 'signed int': 'i4', 'int32': 'i4', 'int32_t': 'i4',
+  'uint': 'u4', 'unsigned int': 'u4', 'uint32': 'u4', 'uint32_t': 'u4',
+  'longlong': 'i8', 'long long': 'i8', 'int64': 'i8', 'int64_t': 'i8',
+  'ulonglong': 'u8', 'unsigned long long': 'u8', 'uint64': 'u8', 'uint64_t': 'u8',
+  'float': 'f4', 'double': 'f8',
+  }
+
+NRRD_TYPE_NAMES = {'i1': 'int8', 'u1': 'uint8', 'i2': 'int16', 'u2': 'uint16', 'i4': 'int32', 'u4': 'uint32',
+  'i8': 'int64', 'u8': 'uint64', 'f4': 'float', 'f8': 'double'}
+
+
+def _readNrrdHeader(path):
+  """
+  Return the fields of the header of a NRRD file and the offset of its data.
+  """
+  fields = {}
+  with open(path, 'rb') as f:
+    if not f.readline().startswith(b'NRRD'):
+      raise ValueError(path + ' is not a NRRD file')
+    for line in iter(f.readline, b''):
+      line = line.decode('latin-1').rstrip('\r\n')
+      if not line:
+        break
+      if line.startswith('#') or ':' not in line:
+        continue
+      key, value = line.split(':', 1)
+      fields[key.strip().lower()] = value.lstrip('=').strip()
+    return fields, f.tell()
+
+
+def _parseVector(text):
+  return [float(value) for value in text.strip().strip('()').split(',')]
+
+
+def mapNrrd(path):
+  """
+  Map the voxels of an uncompressed 3D NRRD file in memory.
+  Returns (array (K, J, I), spacing, origin, direction) in LPS, or None if the file cannot be mapped.
+  """
+  import numpy as np
+
+  if not path.lower().endswith('.nrrd'):
+    return None
+  try:
+    fields, offset = _readNrrdHeader(path)
+    if fields.get('encoding') != 'raw' or 'data file' in fields or 'datafile' in fields or fields.get('dimension') != '3':
+      return None
+    size = [int(value) for value in fields['sizes'].split()]
+    dtype = np.dtype(NRRD_TYPES[fields['type'].lower()])
+    if dtype.itemsize > 1:
+      dtype = dtype.newbyteorder('<' if fields.get('endian', 'little') == 'little' else '>')
+    space = fields.get('space', 'left-posterior-superior').lower()
+    if space not in ('left-posterior-superior', 'right-anterior-superior', 'lps', 'ras'):
+      return None
+    axes = [_parseVector(axis) for axis in fields['space directions'].replace(') (', ')|(').split('|')]
+    origin = _parseVector(fields.get('space origin', '(0,0,0)'))
+  except (OSError, KeyError, ValueError):
+    return None
+
+  flip = (-1, -1, 1) if space in ('right-anterior-superior', 'ras') else (1, 1, 1)
+  spacing = tuple(float(np.linalg.norm(axis)) for axis in axes)
+  # Direction matrix row-major, column i is the direction of axis i
+  direction = tuple(flip[row] * axes[column][row] / spacing[column] for row in range(3) for column in range(3))
+  origin = tuple(flip[row] * origin[row] for row in range(3))
+  array = np.memmap(path, dtype, mode='r', offset=offset, shape=(size[2], size[1], size[0]))
+  return array, spacing, origin, direction
+
+
+def _imageFromMap(mapped, first=0, last=None):
+  import numpy as np
+  import SimpleITK as sitk
+
+  array, spacing, origin, direction = mapped
+  image = sitk.GetImageFromArray(np.ascontiguousarray(array[first:last], array.dtype.newbyteorder('=')))
+  image.SetSpacing(spacing)
+  image.SetOrigin(origin)
+  image.SetDirection(direction)
+  image.SetOrigin(image.TransformIndexToPhysicalPoint((0, 0, first)))
+  return image
+
+
+def readSlab(path, RangeSlice):
+  """
+  Same as BatchProcessing.readImageSlab, but uncompressed NRRD files are read through a memory map.
+  """
+  mapped = mapNrrd(path)
+  if mapped is None:
+    return BatchProcessing.readImageSlab(path, RangeSlice)
+  array = mapped[0]
+  first, last = Pipeline.slabRange(RangeSlice, array.shape[0])
+  image = _imageFromMap(mapped, first, last)
+  size = (array.shape[2], array.shape[1], array.shape[0])
+  del array, mapped
+  return Pipeline.SlabImage(image, first, size)
+
+
+class LabelFile:
+  """
+  Uncompressed NRRD file written slab by slab through a memory map.
+  reference gives the geometry of the first slice of the file.
+  """
+
+  def __init__(self, path, reference, numberOfSlices, dtype):
+    import numpy as np
+
+    self.path = path
+    self.dtype = np.dtype(dtype).newbyteorder('<') if np.dtype(dtype).itemsize > 1 else np.dtype(dtype)
+    size = reference.GetSize()[:2] + (numberOfSlices,)
+    spacing = reference.GetSpacing()
+    direction = reference.GetDirection()
+    axes = ['({0})'.format(','.join(repr(direction[3 * row + column] * spacing[column]) for row in range(3))) for column in range(3)]
+    header = '\n'.join([
+      'NRRD0004',
+      'type: ' + NRRD_TYPE_NAMES[self.dtype.kind + str(self.dtype.itemsize)],
+      'dimension: 3',
+      'space: left-posterior-superior',
+      'sizes: {0} {1} {2}'.format(*size),
+      'space directions: ' + ' '.join(axes),
+      'kinds: domain domain domain',
+      'endian: little',
+      'encoding: raw',
+      'space origin: ({0})'.format(','.join(repr(value) for value in reference.GetOrigin())),
+      '', '']).encode('latin-1')
+    with open(path, 'wb') as f:
+      f.write(header)
+      f.truncate(len(header) + size[0] * size[1] * size[2] * self.dtype.itemsize)
+    self.array = np.memmap(path, self.dtype, mode='r+', offset=len(header), shape=(size[2], size[1], size[0]))
+
+  def write(self, first, image):
+    """
+    Write the slices of a SimpleITK image starting at slice first of the file.
+    """
+    import SimpleITK as sitk
+
+    slab = sitk.GetArrayViewFromImage(image)
+    self.array[first:first + slab.shape[0]] = slab
+    self.array.flush()
+
+  def close(self):
+    if self.array is not None:
+      self.array.flush()
+      self.array = None
+
+
+def compressNrrd(rawPath, outputPath, compressionLevel=-1):
+  """
+  Write a raw NRRD file with gzip encoding, a block at a time.
+  """
+  fields, offset = _readNrrdHeader(rawPath)
+  with open(rawPath, 'rb') as rawFile, open(outputPath, 'wb') as outputFile:
+    header = rawFile.read(offset).decode('latin-1')
+    outputFile.write(header.replace('encoding: ' + fields['encoding'], 'encoding: gzip', 1).encode('latin-1'))
+    with gzip.GzipFile(fileobj=outputFile, mode='wb', compresslevel=6 if compressionLevel < 0 else compressionLevel) as compressedFile:
+      for block in iter(lambda: rawFile.read(COMPRESSION_BLOCK_SIZE), b''):
+        compressedFile.write(block)
+
+
+def finishLabelmap(rawPath, outputPath, compressionLevel=-1):
+  """
+  Move a labelmap written by LabelFile to outputPath, compressed unless compressionLevel is 0.
+  NRRD files are compressed slab by slab, NIfTI files are written with SimpleITK.
+  The file is renamed to outputPath when complete (see JobQueue.atomicPath).
+  """
+  if outputPath.lower().endswith('.nrrd'):
+    if compressionLevel == 0:
+      os.replace(rawPath, outputPath)
+      return
+    with JobQueue.atomicPath(outputPath) as partialPath:
+      compressNrrd(rawPath, partialPath, compressionLevel)
+  else:
+    BatchProcessing.writeLabelmap(_imageFromMap(mapNrrd(rawPath)), outputPath, compressionLevel)
+  os.remove(rawPath)
+
+
+def combineLabelFiles(rawPaths, combinedPath, chunkSlices=DEFAULT_CHUNK_SLICES):
+  """
+  Write the thigh labelmaps of rawPaths (dictionary indexed by 'l' and 'r') to one raw labelmap, chunk by chunk
+  (see Pipeline.combineThighs).
+  """
+  import numpy as np
+
+  mapped = {side: mapNrrd(path) for side, path in rawPaths.items()}
+  arrays = {side: mapped[side][0] for side in mapped}
+  maximum = max(int(array.max(initial=0)) for array in arrays.values())
+  dtype = np.uint8 if maximum + Pipeline.RIGHT_LABEL_OFFSET <= 255 else np.uint16
+  reference = _imageFromMap(next(iter(mapped.values())), 0, 1)
+  numberOfSlices = next(iter(arrays.values())).shape[0]
+  combinedFile = LabelFile(combinedPath, reference, numberOfSlices, dtype)
+  try:
+    for first in range(0, numberOfSlices, chunkSlices):
+      last = min(numberOfSlices, first + chunkSlices)
+      slabs = {side: array[first:last] for side, array in arrays.items()}
+      empty = np.zeros(next(iter(slabs.values())).shape, np.uint8)
+      combinedFile.array[first:last] = Pipeline.combineLabels(slabs.get('l', empty), slabs.get('r', empty))
+  finally:
+    combinedFile.close()
+  del arrays, mapped
+
+
+def processStudy(study, outputDirectory, chunkSlices=DEFAULT_CHUNK_SLICES, quantify=False, options=None):
+  """
+  Same as BatchProcessing.processStudy, but the study is read, segmented and written chunk by chunk.
+  The chunks are segmented independently (see PartitionProcessing), so the labelmaps are only the same as
+  BatchProcessing.processStudy when the range fits in one chunk of chunkSlices slices. If the chunks of a thigh
+  study do not agree on which thighs are complete, the study fails and no labelmap is written.
+  With quantify, the slice statistics of each chunk are computed while it is in memory (see Quantification).
+  With autoRange, the range is detected on memory-mapped images when they are uncompressed NRRD files.
+  """
+  import numpy as np
+  import SimpleITK as sitk
+  from Tis_SegLib import Quantification
+
+  options = BatchProcessing.labelmapOptions(options)
+  startTime = time.time()
+  record = {'id': study['id'], 'region': study['region'], 'minSlice': study['minSlice'], 'maxSlice': study['maxSlice'],
+    'status': 'done', 'message': None, 'error': None, 'outputs': {}, 'segmentSuffixes': {}}
+  names = ['l', 'r'] if study['region'] == Pipeline.THIGH else ['Abdo']
+  labelFiles = {}
+  statistics = {name: [] for name in names}
+
+  try:
+    if study.get('autoRange'):
+      study = BatchProcessing.detectStudyRange(study)
+      record['minSlice'], record['maxSlice'] = study['minSlice'], study['maxSlice']
+    RangeSlice = Pipeline.sliceRange(study['minSlice'], study['maxSlice'])
+    Pipeline.checkPartitions(RangeSlice, study['partitions'])
+    if study['region'] == Pipeline.THIGH and study['master']:
+      from Tis_SegLib import Alignment
+      masterGeometry = BatchProcessing.readGeometry(study['master'])
+      for field in ('fat', 'water'):
+        if not Alignment.sameVoxelGrid(BatchProcessing.readGeometry(study[field]), masterGeometry):
+          raise ValueError('The {0} image is not on the voxel grid of the master volume, it cannot be streamed. '
+            'Run the study without --stream to resample it'.format(field))
+    margin = PartitionProcessing.chunkMargin(study['partitions'])
+    flags = []
+    for first, last in PartitionProcessing.incrementalChunkRanges(RangeSlice, study['partitions'], chunkSlices):
+      chunkRange = [max(RangeSlice[0], first - margin), min(RangeSlice[1], last + margin)]
+      fat_img = readSlab(study['fat'], chunkRange)
+      water_img = readSlab(study['water'], chunkRange)
+      if study['region'] == Pipeline.THIGH:
+        master_img = readSlab(study['master'], chunkRange) if study['master'] else None
+        result = Pipeline.segmentThigh(fat_img, water_img, chunkRange, study['partitions'], study['incomplete'], master_img)
+        flags.append(result)
+        if len(set((chunk['left_full_Q'], chunk['right_full_Q'], chunk['sum_left'] == 0, chunk['sum_right'] == 0) for chunk in flags)) > 1:
+          raise ValueError(CHUNKS_DISAGREE_ERROR)
+      else:
+        roi_img = BatchProcessing.readRoi(study['roi'], fat_img)
+        result = Pipeline.segmentAbdomen(fat_img, water_img, roi_img, chunkRange, study['partitions'])
+
+      for name in names:
+        piece = result['out_' + name][:, :, first - chunkRange[0]:last - chunkRange[0]]
+        if name not in labelFiles:
+          rawPath = os.path.join(outputDirectory, '{0}_{1}.raw.nrrd'.format(study['id'], name))
+          labelFiles[name] = LabelFile(rawPath, piece, RangeSlice[1] - RangeSlice[0], sitk.GetArrayViewFromImage(piece).dtype)
+        labelFiles[name].write(first - RangeSlice[0], piece)
+        if quantify:
+          spacing = piece.GetSpacing()
+          fatSlices = fat_img[:, :, first:last]
+          waterSlices = water_img[:, :, first:last]
+          statistics[name].append(Quantification.sliceStatistics(sitk.GetArrayViewFromImage(piece),
+            sitk.GetArrayViewFromImage(fatSlices), sitk.GetArrayViewFromImage(waterSlices), study['region']))
+      del fat_img, water_img, result
+
+    for labelFile in labelFiles.values():
+      labelFile.close()
+
+    if study['region'] == Pipeline.THIGH:
+      result = {
+        'left_full_Q': flags[0]['left_full_Q'],
+        'right_full_Q': flags[0]['right_full_Q'],
+        'sum_left': sum(chunk['sum_left'] for chunk in flags),
+        'sum_right': sum(chunk['sum_right'] for chunk in flags),
+        }
+      message, outputs = Pipeline.thighOutputPlan(result, study['incomplete'])
+      record['message'] = message
+      record.update(result)
+    else:
+      outputs = [('Abdo', '')]
+
+    kept = {}
+    for name, suffix in outputs:
+      kept[name] = labelFiles[name].path
+      if suffix is not None:
+        record['segmentSuffixes'][name] = suffix
+    if options['combineThighs'] and study['region'] == Pipeline.THIGH and kept:
+      combinedPath = os.path.join(outputDirectory, '{0}_thighs.raw.nrrd'.format(study['id']))
+      combineLabelFiles(kept, combinedPath, chunkSlices)
+      kept = {'thighs': combinedPath}
+
+    if quantify:
+      rows = []
+      for name in record['segmentSuffixes']:
+        counts = np.concatenate([chunk[0] for chunk in statistics[name]])
+        fatFractionSums = np.concatenate([chunk[1] for chunk in statistics[name]])
+        rows.extend(Quantification.statisticsRows(counts, fatFractionSums, spacing, RangeSlice,
+          study['partitions'], study['region'], Quantification.SIDES[name]))
+      BatchProcessing.writeQuantification(record, rows, outputDirectory)
+    if options['store']:
+      # The store is written chunk by chunk from the uncompressed labelmaps
+      from Tis_SegLib import CohortStore
+      mapped = {name: mapNrrd(labelFiles[name].path) for name in record['segmentSuffixes']}
+      record['outputs']['store'] = CohortStore.writeStudy(options['store'], record, mapped)
+      del mapped
+
+    for name, rawPath in kept.items():
+      outputPath = BatchProcessing.labelmapPath(outputDirectory, study['id'], name, options)
+      finishLabelmap(rawPath, outputPath, options['compressionLevel'])
+      record['outputs'][name] = outputPath
+    for labelFile in labelFiles.values():
+      if os.path.exists(labelFile.path):
+        os.remove(labelFile.path)
+  except Exception as e:
+    logging.exception('Study {0} failed'.format(study['id']))
+    record['status'] = 'failed'
+    record['error'] = str(e)
+    # The labelmaps written so far are incomplete
+    for labelFile in labelFiles.values():
+      labelFile.close()
+      if os.path.exists(labelFile.path):
+        os.remove(labelFile.path)
+  finally:
+    for labelFile in labelFiles.values():
+      labelFile.close()
+
+  record['seconds'] = time.time() - startTime
+  return record
+
+
+def processManifest(studies, outputDirectory, writeSegmentations=False, chunkSlices=DEFAULT_CHUNK_SLICES, quantify=False, options=None):
+  """
+  Stream the studies one after the other. Yields the record of each study as soon as it is written.
+  """
+  if not os.path.isdir(outputDirectory):
+    os.makedirs(outputDirectory)
+  for study in studies:
+    record = processStudy(study, outputDirectory, chunkSlices, quantify, options)
+    if writeSegmentations and record['status'] == 'done':
+      try:
+        BatchProcessing.writeStudySegmentations(record, outputDirectory)
+      except Exception as e:
+        record['status'] = 'failed'
+        record['error'] = str(e)
+    yield record
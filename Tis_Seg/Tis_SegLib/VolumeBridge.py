@@ -0,0 +1,172 @@
+"""
+Exchange of voxels between volume nodes and SimpleITK images through NumPy views of the node memory.
+
+Reading wraps the node voxels with slicer.util.arrayFromVolume (no copy) and makes the single copy
+SimpleITK needs to own its buffer. Writing takes a NumPy view of the SimpleITK image and copies it
+straight into the node image data, reusing the existing buffer when shape and type match.
+The geometry is converted between the LPS convention of SimpleITK and the RAS convention of Slicer.
+Segments are read from the binary labelmaps stored in the segmentation node, without exporting them to a volume node.
+"""
+from Tis_SegLib import Pipeline
+from Tis_SegLib import VolumeGeometry
+
+
+def arrayView(volumeNode):
+  """
+  NumPy view (K, J, I) of the voxels of a volume node. Call slicer.util.arrayFromVolumeModified
+  after modifying it.
+  """
+  import slicer
+  return slicer.util.arrayFromVolume(volumeNode)
+
+
+def imageFromVolume(volumeNode, RangeSlice=None):
+  """
+  SimpleITK image with the voxels and geometry of a volume node.
+  If RangeSlice is given, only the slices needed to segment that range are copied and
+  a Pipeline.SlabImage is returned.
+  """
+  array = arrayView(volumeNode)
+  geometry = VolumeGeometry.volumeGeometry(volumeNode)
+  if RangeSlice is None:
+    first, last = 0, array.shape[0]
+  else:
+    first, last = Pipeline.slabRange(RangeSlice, array.shape[0])
+  return _imageFromSlices(array[first:last], geometry, first, RangeSlice)
+
+
+def _imageFromSlices(slices, geometry, first, RangeSlice):
+  """
+  Image of the slices [first, ...) of a volume with the given geometry (SlabImage if RangeSlice is given).
+  """
+  import SimpleITK as sitk
+
+  image = sitk.GetImageFromArray(slices)
+  image.SetSpacing(geometry.spacing)
+  image.SetOrigin(geometry.origin)
+  image.SetDirection(geometry.direction)
+  if RangeSlice is None:
+    return image
+  image.SetOrigin(image.TransformIndexToPhysicalPoint((0, 0, first)))
+  return Pipeline.SlabImage(image, first, geometry.size)
+
+
+def _indexOffset(imageToWorld, referenceIJKToRAS, tolerance=1e-3):
+  """
+  Integer offset from the voxel indexes of a labelmap to those of the reference volume,
+  or None if the labelmap voxels are not on the grid of the reference volume.
+  """
+  import numpy as np
+
+  matrix = np.linalg.inv(referenceIJKToRAS) @ imageToWorld
+  offset = np.round(matrix[:3, 3])
+  if not np.allclose(matrix[:3, :3], np.eye(3), atol=tolerance) or not np.allclose(matrix[:3, 3], offset, atol=tolerance):
+    return None
+  return offset.astype(int)
+
+
+def imageFromSegments(segmentationNode, referenceVolumeNode, RangeSlice=None):
+  """
+  Same labelmap as ExportVisibleSegmentsToLabelmapNode (visible segments numbered from 1 in their order,
+  on the grid of referenceVolumeNode), read straight from the binary labelmaps of the segments.
+  Only the voxels of each segment extent that fall in the slices needed for RangeSlice are copied.
+  Returns None if the segments cannot be read this way (no binary labelmap, transforms, or a
+  labelmap grid that is not the one of the reference volume), the caller then exports them.
+  """
+  import numpy as np
+  import vtk
+  import slicer
+  from vtk.util import numpy_support
+
+  segmentation = segmentationNode.GetSegmentation()
+  binaryLabelmapName = slicer.vtkSegmentationConverter.GetBinaryLabelmapRepresentationName()
+  if segmentationNode.GetParentTransformNode() is not None or referenceVolumeNode.GetParentTransformNode() is not None \
+      or not segmentation.ContainsRepresentation(binaryLabelmapName):
+    return None
+
+  displayNode = segmentationNode.GetDisplayNode()
+  if displayNode is not None:
+    segmentIds = vtk.vtkStringArray()
+    displayNode.GetVisibleSegmentIDs(segmentIds)
+    segmentIds = [segmentIds.GetValue(index) for index in range(segmentIds.GetNumberOfValues())]
+  else:
+    segmentIds = list(segmentation.GetSegmentIDs())
+
+  geometry = VolumeGeometry.volumeGeometry(referenceVolumeNode)
+  size = geometry.size
+  if RangeSlice is None:
+    first, last = 0, size[2]
+  else:
+    first, last = Pipeline.slabRange(RangeSlice, size[2])
+  referenceIJKToRAS = vtk.vtkMatrix4x4()
+  referenceVolumeNode.GetIJKToRASMatrix(referenceIJKToRAS)
+  referenceIJKToRAS = slicer.util.arrayFromVTKMatrix(referenceIJKToRAS)
+
+  slices = np.zeros((last - first, size[1], size[0]), np.uint8 if len(segmentIds) < 256 else np.uint16)
+  for segmentNumber, segmentId in enumerate(segmentIds, 1):
+    segment = segmentation.GetSegment(segmentId)
+    labelmap = segment.GetRepresentation(binaryLabelmapName)
+    if labelmap is None:
+      return None
+    extent = labelmap.GetExtent()
+    if extent[1] < extent[0] or extent[3] < extent[2] or extent[5] < extent[4]:
+      continue
+    imageToWorld = vtk.vtkMatrix4x4()
+    labelmap.GetImageToWorldMatrix(imageToWorld)
+    offset = _indexOffset(slicer.util.arrayFromVTKMatrix(imageToWorld), referenceIJKToRAS)
+    if offset is None:
+      return None
+
+    # Overlap of the segment extent with the slab, in the indexes of the reference volume
+    start = [max(0, extent[0] + offset[0]), max(0, extent[2] + offset[1]), max(first, extent[4] + offset[2])]
+    stop = [min(size[0], extent[1] + offset[0] + 1), min(size[1], extent[3] + offset[1] + 1), min(last, extent[5] + offset[2] + 1)]
+    if any(stop[axis] <= start[axis] for axis in range(3)):
+      continue
+    dimensions = [extent[1] - extent[0] + 1, extent[3] - extent[2] + 1, extent[5] - extent[4] + 1]
+    voxels = numpy_support.vtk_to_numpy(labelmap.GetPointData().GetScalars()).reshape(dimensions[::-1])
+    inside = voxels[start[2] - extent[4] - offset[2]:stop[2] - extent[4] - offset[2],
+      start[1] - extent[2] - offset[1]:stop[1] - extent[2] - offset[1],
+      start[0] - extent[0] - offset[0]:stop[0] - extent[0] - offset[0]] == segment.GetLabelValue()
+    slices[start[2] - first:stop[2] - first, start[1]:stop[1], start[0]:stop[0]][inside] = segmentNumber
+
+  return _imageFromSlices(slices, geometry, first, RangeSlice)
+
+
+def setVolumeGeometry(volumeNode, image):
+  """
+  Set the spacing, origin and directions of a volume node from a SimpleITK image.
+  """
+  import vtk
+
+  origin = image.GetOrigin()
+  direction = image.GetDirection()
+  directions = vtk.vtkMatrix4x4()
+  # LPS to RAS: flip the sign of the first two axes
+  for row, sign in enumerate((-1, -1, 1)):
+    for column in range(3):
+      directions.SetElement(row, column, sign * direction[3 * row + column])
+  volumeNode.SetIJKToRASDirectionMatrix(directions)
+  volumeNode.SetSpacing(image.GetSpacing())
+  volumeNode.SetOrigin(-origin[0], -origin[1], origin[2])
+
+
+def updateVolumeFromImage(volumeNode, image):
+  """
+  Write the voxels and geometry of a SimpleITK image to a volume node.
+  The voxels are copied in place if the node already has image data of the same shape and type.
+  """
+  import SimpleITK as sitk
+  import slicer
+
+  array = sitk.GetArrayViewFromImage(image)
+  wasModified = volumeNode.StartModify()
+  try:
+    view = arrayView(volumeNode) if volumeNode.GetImageData() is not None else None
+    if view is not None and view.shape == array.shape and view.dtype == array.dtype:
+      view[...] = array
+      slicer.util.arrayFromVolumeModified(volumeNode)
+    else:
+      slicer.util.updateVolumeFromArray(volumeNode, array)
+    setVolumeGeometry(volumeNode, image)
+  finally:
+    volumeNode.EndModify(wasModified)
@@ -0,0 +1,91 @@
+"""
+Spatial information of volume nodes read without touching their voxels.
+
+The geometry is returned in the convention of SimpleITK images (LPS), so it can be compared
+with the geometry of images pulled with sitkUtils.PullVolumeFromSlicer.
+"""
+import collections
+
+
+class Geometry(collections.namedtuple('Geometry', ['size', 'spacing', 'origin', 'direction'])):
+  """
+  Size (I, J, K), spacing, origin and row-major direction matrix of a volume (LPS).
+  """
+
+  def sameSpace(self, other):
+    return self.size == other.size and self.spacing == other.spacing and \
+      self.origin == other.origin and self.direction == other.direction
+
+
+def volumeGeometry(volumeNode):
+  """
+  Read the geometry of a volume node from its image data dimensions and IJK to RAS matrix.
+  """
+  import vtk
+
+  imageData = volumeNode.GetImageData()
+  size = tuple(imageData.GetDimensions()) if imageData is not None else (0, 0, 0)
+  spacing = tuple(volumeNode.GetSpacing())
+  origin = volumeNode.GetOrigin()
+  directions = vtk.vtkMatrix4x4()
+  volumeNode.GetIJKToRASDirectionMatrix(directions)
+
+  # RAS to LPS: flip the sign of the first two axes
+  origin = (-origin[0], -origin[1], origin[2])
+  direction = []
+  for row, sign in enumerate((-1, -1, 1)):
+    for column in range(3):
+      direction.append(sign * directions.GetElement(row, column))
+  return Geometry(size, spacing, origin, tuple(direction))
+
+
+class GeometryCache:
+  """
+  Geometry of the most recently used volume nodes. An entry is dropped as soon as its node
+  is modified or its image data changes, so the geometry is only read again when needed.
+  """
+
+  def __init__(self, maximumNumberOfNodes=16):
+    self.maximumNumberOfNodes = maximumNumberOfNodes
+    self._entries = collections.OrderedDict()
+
+  def geometry(self, volumeNode):
+    """
+    Return the Geometry of volumeNode (a node or a node ID), or None if there is no such volume.
+    """
+    if isinstance(volumeNode, str):
+      import slicer
+      volumeNode = slicer.mrmlScene.GetNodeByID(volumeNode) if volumeNode else None
+    if volumeNode is None:
+      return None
+
+    nodeID = volumeNode.GetID()
+    entry = self._entries.get(nodeID)
+    if entry is not None:
+      self._entries.move_to_end(nodeID)
+      return entry[0]
+
+    geometry = volumeGeometry(volumeNode)
+    tags = [volumeNode.AddObserver(event, lambda caller, event, nodeID=nodeID: self.invalidate(nodeID))
+      for event in self._invalidatingEvents()]
+    self._entries[nodeID] = (geometry, volumeNode, tags)
+    while len(self._entries) > self.maximumNumberOfNodes:
+      self.invalidate(next(iter(self._entries)))
+    return geometry
+
+  def _invalidatingEvents(self):
+    import vtk
+    import slicer
+    return (vtk.vtkCommand.ModifiedEvent, slicer.vtkMRMLVolumeNode.ImageDataModifiedEvent)
+
+  def invalidate(self, nodeID):
+    entry = self._entries.pop(nodeID, None)
+    if entry is None:
+      return
+    _, volumeNode, tags = entry
+    for tag in tags:
+      volumeNode.RemoveObserver(tag)
+
+  def clear(self):
+    for nodeID in list(self._entries):
+      self.invalidate(nodeID)
@@ -0,0 +1,5 @@
+"""
+Helper modules of the Tis_Seg module that do not depend on the module widget.
+They can be used from the Slicer Python console, from scripts run with
+``Slicer --no-main-window --python-script`` and from worker processes.
+"""